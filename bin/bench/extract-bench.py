@@ -0,0 +1,163 @@
+#!/usr/bin/python
+
+# Copyright 2016, Fabien Boucher
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Compare the commits extraction modes of the indexer (see
+# indexer_extract_mode in config.py) on a synthetic repository created
+# with git fast-import. Commits are extracted by chunks like the
+# indexer workers do.
+
+import os
+import time
+import random
+import shutil
+import argparse
+import tempfile
+import subprocess
+
+from repoxplorer.indexer.git import backends
+from repoxplorer.indexer.git import commits_cache
+from repoxplorer.indexer.git import indexer
+
+REF_IDS = ['file:///synthetic:synthetic:master']
+
+
+def gen_fast_import(amount, files):
+    """ Generate a fast-import stream of amount commits touching a
+    pool of files. Some commits rename files and some are merges.
+    """
+    random.seed(0)
+    contents = dict(
+        ('dir%s/file%s.txt' % (i % 10, i),
+         ['line %s\n' % j for j in range(random.randint(10, 200))])
+        for i in range(files))
+    out = []
+
+    def data(raw):
+        out.append('data %s\n%s\n' % (len(raw.encode()), raw))
+
+    date = 1476633000
+    for mark in range(1, amount + 1):
+        date += random.randint(1, 3600)
+        branch = 'refs/heads/%s' % (
+            'devel' if mark % 50 in (1, 2, 3) and mark > 50 else 'master')
+        out.append('commit %s\nmark :%s\n' % (branch, mark))
+        out.append('author Author %s <author%s@test> %s +0000\n' % (
+            mark % 30, mark % 30, date))
+        out.append('committer Committer <committer@test> %s +0000\n' % (
+            date))
+        data('Commit %s\n\nChange-Id: I%040d\nCloses-Bug: #%s\n' % (
+            mark, mark, mark))
+        if mark > 1:
+            out.append('from :%s\n' % (mark - 1))
+        if mark % 50 == 4 and mark > 50:
+            # Merge the devel branch
+            out.append('merge :%s\n' % (mark - 1))
+        for path in random.sample(sorted(contents), random.randint(1, 3)):
+            lines = contents[path]
+            for _ in range(random.randint(1, 10)):
+                idx = random.randint(0, len(lines))
+                if random.random() < 0.3 and lines:
+                    del lines[min(idx, len(lines) - 1)]
+                else:
+                    lines.insert(idx, 'line %s-%s\n' % (mark, idx))
+            if mark % 20 == 0:
+                new = path.replace('.txt', '-%s.txt' % mark)
+                out.append('D %s\n' % path)
+                contents[new] = contents.pop(path)
+                path = new
+            out.append('M 100644 inline %s\n' % path)
+            data(''.join(contents[path]))
+        out.append('\n')
+        if branch == 'refs/heads/devel':
+            # Keep devel on top of master for the next commit
+            out.append('reset refs/heads/master\nfrom :%s\n\n' % mark)
+    return ''.join(out)
+
+
+def create_repo(amount, files):
+    path = tempfile.mkdtemp()
+    subprocess.check_call(['git', 'init', '-q', '--bare', path])
+    process = subprocess.Popen(['git', 'fast-import', '--quiet'],
+                               stdin=subprocess.PIPE, cwd=path)
+    process.communicate(gen_fast_import(amount, files).encode())
+    return path
+
+
+def extract(path, shas, mode, chunk):
+    indexer.conf['indexer_extract_mode'] = mode
+    amount = 0
+    for i in range(0, len(shas), chunk):
+        amount += len(list(indexer.iter_commits(
+            path, REF_IDS, shas[i:i + chunk])))
+    return amount
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Commits extraction modes benchmark')
+    parser.add_argument(
+        '--commits', type=int, default=10000,
+        help='Amount of commits of the synthetic repository')
+    parser.add_argument(
+        '--files', type=int, default=500,
+        help='Amount of files of the synthetic repository')
+    parser.add_argument(
+        '--chunk', type=int, default=1000,
+        help='Amount of commits extracted at once (1000 in the indexer, '
+             'lower values simulate small incremental updates)')
+    parser.add_argument(
+        '--modes', default='show,stream,batch,dulwich',
+        help='Comma separated list of extraction modes to compare')
+    parser.add_argument(
+        '--parsed-cache', action='store_true',
+        help='Also measure the stream mode with a cold then a warm '
+             'parsed commits cache')
+    args = parser.parse_args()
+    path = create_repo(args.commits, args.files)
+    try:
+        shas = indexer.get_all_shas(path, 'refs/heads/master')
+        print("Synthetic repository of %s commits in %s" % (
+            len(shas), path))
+        for mode in args.modes.split(','):
+            if mode == 'dulwich' and backends.Repo is None:
+                print("%-8s skipped: dulwich is not installed" % mode)
+                continue
+            start = time.time()
+            amount = extract(path, shas, mode, args.chunk)
+            elapsed = time.time() - start
+            print("%-8s %8d commits in %6.2fs: %9.0f commits/s" % (
+                mode, amount, elapsed, amount / elapsed))
+            backends.close_readers()
+        if args.parsed_cache:
+            cache_path = tempfile.mkdtemp()
+            indexer.conf['db_cache_path'] = cache_path
+            indexer.conf['indexer_parsed_cache'] = True
+            try:
+                for run in ('cold', 'warm'):
+                    start = time.time()
+                    amount = extract(path, shas, 'stream', args.chunk)
+                    elapsed = time.time() - start
+                    print("%-8s %8d commits in %6.2fs: %9.0f commits/s" % (
+                        'cache-%s' % run, amount, elapsed,
+                        amount / elapsed))
+                print("Parsed commits cache of %.1f MB" % (
+                    os.path.getsize(os.path.join(
+                        cache_path, commits_cache.CACHE_FILE)) / 1e6))
+            finally:
+                indexer.conf['indexer_parsed_cache'] = False
+                shutil.rmtree(cache_path)
+    finally:
+        shutil.rmtree(path)
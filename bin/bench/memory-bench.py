@@ -0,0 +1,174 @@
+#!/usr/bin/python
+
+# Copyright 2016, Fabien Boucher
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Measure the peak RSS of the indexer computing the commits to index of
+# a ref of a synthetic repository (one million commits by default)
+# created with git fast-import. Half of the history is in the commits
+# catalog as already indexed by a previous run. The commits to create
+# are streamed by chunks like they are to the indexer workers. Each
+# measure runs in its own process; "legacy" runs the former computation
+# on lists and sets of str for comparison.
+
+import time
+import shutil
+import argparse
+import resource
+import tempfile
+import subprocess
+import multiprocessing as mp
+
+from repoxplorer.indexer.git import catalog
+from repoxplorer.indexer.git import indexer
+from repoxplorer.indexer.git import shaset
+
+REF = 'refs/heads/master'
+REF_ID = 'file:///synthetic:synthetic:master'
+
+
+def gen_fast_import(amount):
+    """ Yield a fast-import stream of amount small commits
+    """
+    date = 1476633000
+    for mark in range(1, amount + 1):
+        msg = 'Commit %s\n' % mark
+        content = '%s\n' % mark
+        yield ('commit %s\nmark :%s\n'
+               'author Author <author@test> %s +0000\n'
+               'committer Committer <committer@test> %s +0000\n'
+               'data %s\n%s\n%s'
+               'M 100644 inline f\ndata %s\n%s\n\n' % (
+                   REF, mark, date + mark, date + mark, len(msg), msg,
+                   'from :%s\n' % (mark - 1) if mark > 1 else '',
+                   len(content), content))
+
+
+def create_repo(amount):
+    path = tempfile.mkdtemp()
+    subprocess.check_call(['git', 'init', '-q', '--bare', path])
+    process = subprocess.Popen(['git', 'fast-import', '--quiet'],
+                               stdin=subprocess.PIPE, cwd=path)
+    for chunk in gen_fast_import(amount):
+        process.stdin.write(chunk.encode())
+    process.stdin.close()
+    if process.wait() != 0:
+        raise Exception('git fast-import failed')
+    return path
+
+
+def fill_catalog(path, cache_path):
+    """ Mark the oldest half of the history and unknown commits as
+    indexed in the commits catalog.
+    """
+    indexer.conf['db_cache_path'] = cache_path
+    shas = indexer.get_all_shas(path, REF)
+    indexed = shas[len(shas) // 2:] + ['%040x' % i for i in range(1000)]
+    c = catalog.CommitsCatalog()
+    for chunk in shaset.chunks(indexed, 10000):
+        c.add_refs(chunk, [REF_ID])
+    c.close()
+    return len(shas)
+
+
+def get_rss():
+    with open('/proc/self/status') as status:
+        for line in status:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1]) * 1024
+    return 0
+
+
+def measure(mode, path, cache_path, memory_cap, extract, queue):
+    indexer.conf['db_cache_path'] = cache_path
+    indexer.conf['indexer_memory_cap_bytes'] = memory_cap
+    indexer.conf['indexer_extract_mode'] = 'stream'
+    start_rss = get_rss()
+    start = time.time()
+    c = catalog.CommitsCatalog()
+    if mode == 'legacy':
+        commits = indexer.get_all_shas(path, REF)
+        already_indexed = c.get_ref_shas(REF_ID)
+        to_delete = set(already_indexed) - set(commits)
+        to_index = set(commits) - set(already_indexed)
+        existing = c.get_refs(to_index)
+        to_create = [sha for sha in to_index if sha not in existing]
+    else:
+        commits = indexer.get_shas_set(path, REF)
+        already_indexed = shaset.ShaSet.from_iterable(c.iter_ref_shas(REF_ID))
+        to_delete = already_indexed.difference(commits)
+        to_index = commits.difference(already_indexed)
+        existing = shaset.ShaSet.from_iterable(
+            sha for chunk in shaset.chunks(to_index, indexer.IMPORT_CHUNK)
+            for sha in c.get_refs(chunk))
+        to_create = to_index.difference(existing)
+    created = 0
+    for chunk in shaset.chunks(to_create, indexer.IMPORT_CHUNK):
+        if extract:
+            created += len(list(indexer.iter_commits(path, [REF_ID], chunk)))
+        else:
+            created += len(chunk)
+    c.close()
+    queue.put({
+        'mode': mode,
+        'commits': len(commits),
+        'to_delete': len(to_delete),
+        'created': created,
+        'elapsed': time.time() - start,
+        'start_rss': start_rss,
+        # Kilobytes on Linux
+        'peak_rss': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+    })
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Indexer memory benchmark')
+    parser.add_argument(
+        '--commits', type=int, default=1000000,
+        help='Amount of commits of the synthetic repository')
+    parser.add_argument(
+        '--memory-cap', type=int, default=512 * 1024 ** 2,
+        help='indexer_memory_cap_bytes in bytes')
+    parser.add_argument(
+        '--modes', default='compact,legacy',
+        help='Comma separated list of computations to measure')
+    parser.add_argument(
+        '--extract', action='store_true',
+        help='Also extract the commits to create (slow)')
+    args = parser.parse_args()
+    start = time.time()
+    path = create_repo(args.commits)
+    cache_path = tempfile.mkdtemp()
+    try:
+        amount = fill_catalog(path, cache_path)
+        print("Synthetic repository of %s commits created in %.1fs" % (
+            amount, time.time() - start))
+        ctx = mp.get_context('spawn')
+        for mode in args.modes.split(','):
+            queue = ctx.Queue()
+            process = ctx.Process(target=measure, args=(
+                mode, path, cache_path, args.memory_cap, args.extract,
+                queue))
+            process.start()
+            ret = queue.get()
+            process.join()
+            print("%-8s %8d commits, %8d to create, %5d to delete in "
+                  "%6.2fs: peak RSS %7.1f MB (%.1f MB at start)" % (
+                      ret['mode'], ret['commits'], ret['created'],
+                      ret['to_delete'], ret['elapsed'],
+                      ret['peak_rss'] / 1e6, ret['start_rss'] / 1e6))
+    finally:
+        shutil.rmtree(path)
+        shutil.rmtree(cache_path)
@@ -0,0 +1,105 @@
+#!/usr/bin/python
+
+# Copyright 2016, Fabien Boucher
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Compare the commits parsing throughput of the buffered "git show"
+# extraction path and of the streamed "git log" extraction path. Both
+# paths are fed with the commits of repoxplorer/tests/gitshow.sample
+# repeated --repeat times.
+
+import io
+import os
+import time
+import argparse
+import tracemalloc
+
+from repoxplorer.indexer.git import indexer
+
+SAMPLE = os.path.join(
+    os.path.dirname(os.path.realpath(__file__)),
+    '..', '..', 'repoxplorer', 'tests', 'gitshow.sample')
+REF_IDS = ['file:///gitshow.sample:gitshow.sample:master']
+
+
+def sample_to_stream(raw):
+    """ Convert the git show sample into the git log stream format
+    """
+    lines = raw.decode(errors='replace').splitlines()
+    records = []
+    offset = 0
+    while offset < len(lines):
+        cmt, offset = indexer.parse_commit(lines, offset)
+        parents = ['0' * 40] * (2 if cmt['merge_commit'] else 1)
+        header = "\n".join((
+            cmt['sha'], " ".join(parents),
+            cmt['author_name'], cmt['author_email'],
+            str(cmt['author_date']),
+            cmt['committer_name'], cmt['committer_email'],
+            str(cmt['committer_date']),
+            cmt['commit_msg_full'] + "\n"))
+        stats = "".join([
+            "%s\t%s\t%s\n" % (s['lines_added'], s['lines_removed'], f)
+            for f, s in cmt['files_stats'].items()])
+        records.append("\0%s\0\n\n%s" % (header, stats))
+    return "".join(records).encode()
+
+
+def bench_show(raw):
+    return len(indexer.process_commits_desc_output(
+        raw.decode(errors='replace').splitlines(), REF_IDS))
+
+
+def bench_stream(raw):
+    amount = 0
+    for _ in indexer.process_commits_stream(
+            indexer.iter_stream_records(io.BytesIO(raw)), REF_IDS):
+        amount += 1
+    return amount
+
+
+def run(name, func, raw, memory):
+    if memory:
+        tracemalloc.start()
+    start = time.time()
+    amount = func(raw)
+    elapsed = time.time() - start
+    peak = None
+    if memory:
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    print("%-7s %8d commits in %6.2fs: %9.0f commits/s%s" % (
+        name, amount, elapsed, amount / elapsed,
+        " (peak %.1f MB)" % (peak / 1024.0 ** 2) if memory else ""))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Commits parser benchmark')
+    parser.add_argument(
+        '--repeat', type=int, default=5000,
+        help='Amount of times the sample is repeated')
+    parser.add_argument(
+        '--memory', action='store_true', default=False,
+        help='Also report the peak of allocated memory (slower)')
+    args = parser.parse_args()
+    raw = open(SAMPLE, 'rb').read()
+    # The last commit of the sample has no message and cannot be
+    # followed by another commit in a git show output.
+    raw = raw[:raw.rindex(b'\ncommit ') + 1]
+    stream = sample_to_stream(raw)
+    raw = raw * args.repeat
+    stream = stream * args.repeat
+    run('show', bench_show, raw, args.memory)
+    run('stream', bench_stream, stream, args.memory)
@@ -0,0 +1,132 @@
+#!/usr/bin/python
+
+# Copyright 2016, Fabien Boucher
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Compare the per message cost of the commit message metadata
+# extraction (repoxplorer/indexer/git/trailers.py) with the previous
+# implementation trying every regex on every line. Messages are read
+# from a local Git repository (--repo) or from the commits of
+# repoxplorer/tests/gitshow.sample completed with usual trailers.
+
+import os
+import re
+import time
+import argparse
+import subprocess
+
+from repoxplorer.indexer.git import indexer
+from repoxplorer.indexer.git import metadata_re
+from repoxplorer.indexer.git import trailers
+
+SAMPLE = os.path.join(
+    os.path.dirname(os.path.realpath(__file__)),
+    '..', '..', 'repoxplorer', 'tests', 'gitshow.sample')
+# Trailers added to the sample messages as found in the messages of
+# projects using Gerrit and Launchpad
+TRAILERS = [
+    '',
+    '\n\nCloses-Bug: #1645620\nChange-Id: I2a5a1c4dd6d5d1c9bd1b9b7f3a2d0b',
+    '\n\nImplements: blueprint bp-feature-cool\n'
+    'Co-Authored-By: Author C <author.c@test>\n'
+    'Change-Id: I8f0dbfd0a1a5c1a7a57d0b9c1d6c9d2f6d1a8b3c',
+    '\n\nRelated-Bug: #1645621\nDepends-On: I6d1a8b3c\n'
+    'Signed-off-by: Author A <author.a@test>',
+]
+PARSERS = [
+    '.*(blueprint) ([^ .]+).*',
+    '.*(bug) ([^ .]+).*',
+]
+
+
+def parse_commit_msg(msg, extra_parsers):
+    """ The previous implementation of indexer.parse_commit_msg
+    """
+    metadatas = []
+    lines = msg.split('\n')
+    for line in lines[1:]:
+        for key, parser in metadata_re.METADATA_REs.items():
+            m = parser.match(line)
+            if m:
+                metadatas.append(
+                    (key, m.groups()[0].strip().replace('#', '')))
+        for parser in extra_parsers:
+            m = parser.match(line)
+            if m and m.groups()[0] not in trailers.RESERVED_METADATA_KEYS:
+                metadatas.append(
+                    (m.groups()[0].strip(),
+                     m.groups()[1].strip().replace('#', '')))
+    return lines[0], metadatas
+
+
+def load_repo_messages(path, amount):
+    out = subprocess.check_output(
+        ['git', 'log', '-n', str(amount), '--format=%B%x00'], cwd=path)
+    return [msg.strip('\n') for msg in
+            out.decode(errors='replace').split('\0') if msg.strip()]
+
+
+def load_sample_messages():
+    raw = open(SAMPLE, 'rb').read()
+    # The last commit of the sample has no message
+    raw = raw[:raw.rindex(b'\ncommit ') + 1]
+    lines = raw.decode(errors='replace').splitlines()
+    messages = []
+    offset = 0
+    while offset < len(lines):
+        cmt, offset = indexer.parse_commit(lines, offset)
+        messages.append(
+            cmt['commit_msg_full'] + TRAILERS[len(messages) % len(TRAILERS)])
+    return messages
+
+
+def run(name, func, messages, extra_parsers):
+    start = time.time()
+    found = 0
+    for msg in messages:
+        found += len(func(msg, extra_parsers)[1])
+    elapsed = time.time() - start
+    print("%-10s %8d messages in %6.2fs: %6.2f us/message "
+          "(%s metadata)" % (
+              name, len(messages), elapsed,
+              elapsed * 10 ** 6 / len(messages), found))
+
+
+def extract(msg, extra_parsers):
+    return trailers.get_extractor(extra_parsers).extract(msg)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Commit message metadata extraction benchmark')
+    parser.add_argument(
+        '--repo', help='Read the messages from this local Git repository')
+    parser.add_argument(
+        '--amount', type=int, default=100000,
+        help='Amount of messages to extract')
+    parser.add_argument(
+        '--parsers', default=','.join(PARSERS),
+        help='Comma separated list of project parsers')
+    args = parser.parse_args()
+    if args.repo:
+        messages = load_repo_messages(args.repo, args.amount)
+    else:
+        messages = load_sample_messages()
+    messages = (messages * (args.amount // len(messages) + 1))[:args.amount]
+    for name, extra_parsers in (
+            ('builtin', []),
+            ('projects', [re.compile(p) for p in args.parsers.split(',')])):
+        print("With the %s parsers:" % name)
+        run('previous', parse_commit_msg, messages, extra_parsers)
+        run('trailers', extract, messages, extra_parsers)
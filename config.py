@@ -82,6 +82,126 @@ elasticsearch_user = None
 elasticsearch_password = None
 indexer_loop_delay = 60
 indexer_skip_projects = []
+# Commits extraction mode: 'stream' to stream commits out of git log,
+# 'show' to use buffered git show calls (previous behavior), 'batch' to
+# read commits with persistent git cat-file and diff-tree processes per
+# repository or 'dulwich' to read commits in process (requires the
+# dulwich module)
+indexer_extract_mode = 'stream'
+# Amount of repositories fetched and indexed concurrently
+indexer_repo_workers = 1
+# Maximum amount of repositories fetched concurrently from the same host
+indexer_max_jobs_per_host = 2
+# Keep a local catalog of the indexed commits (in db_cache_path) to avoid
+# reading the commits from the index when computing what to index
+indexer_commits_catalog = False
+# Chunking of the bulk requests sent to the index
+indexer_bulk_chunk_size = 500
+indexer_bulk_max_chunk_bytes = 100 * 1024 * 1024
+# Amount of dedicated bulk writers threads. When set, the extraction
+# workers only parse the commits and the writers adapt the amount of
+# concurrent bulk requests (up to indexer_bulk_writers) and their size
+# (between indexer_bulk_min_batch and indexer_bulk_max_batch) to the
+# bulk latency (indexer_bulk_target_latency in seconds) and to the
+# cluster rejections.
+indexer_bulk_writers = 0
+indexer_bulk_min_batch = 100
+indexer_bulk_max_batch = 5000
+indexer_bulk_target_latency = 2.0
+# Ingest mode for large imports: the commits index refresh is disabled
+# during the run and the index is force merged at the end. The index is
+# refreshed after each indexed ref ('ref') or once at the end ('run').
+# Set indexer_ingest_replicas to 0 to drop the replicas during the run.
+# Only the one-shot runs and the first cycle of the "--forever" mode use
+# the ingest mode, the index is only force merged when the run created at
+# least indexer_ingest_min_commits commits.
+indexer_ingest_mode = False
+indexer_ingest_refresh = 'ref'
+indexer_ingest_replicas = None
+indexer_ingest_max_segments = 1
+indexer_ingest_min_commits = 10000
+# Two-phase import of the refs with at least indexer_two_phase_min_commits
+# commits to create (0 to disable): the commits are indexed without their
+# line statistics (line_modifieds and files_list) then the statistics are
+# computed, newest commits first, by up to indexer_stats_backfill_budget
+# commits per ref and per run.
+indexer_two_phase_min_commits = 0
+# The commits to create are imported by chunks checkpointed in
+# db_cache_path, an interrupted import is resumed by the next run. Failed
+# chunks are retried indexer_import_retries times in a run with an
+# exponential backoff starting at indexer_import_retry_delay seconds.
+indexer_import_retries = 3
+indexer_import_retry_delay = 5
+indexer_stats_backfill_budget = 20000
+# Fetch the repositories without the files contents (partial clone) when
+# the Git server allows it. The contents are fetched on demand when the
+# line statistics are computed.
+indexer_blobless_fetch = False
+# Amount of days the history horizon of the refs having an index-since
+# date is moved backwards per run when they are up to date (0 to disable).
+# The older commits are fetched and indexed slice by slice.
+indexer_horizon_backfill_days = 0
+# Maintenance of the repositories of git_store during the loop delay of
+# the indexer daemon (or with the "--maintenance" argument). The tasks are
+# run at most once per interval (in seconds, 0 to disable a task): move of
+# the objects to the objects pools, commit-graph update, geometric repack
+# with multi-pack-index, and pruning of the branches no longer indexed and
+# of the unreachable objects. Disabled by default as the pruning deletes
+# branches and objects of the git store.
+indexer_maintenance = False
+indexer_maintenance_pool_interval = 3600
+indexer_maintenance_commit_graph_interval = 3600
+indexer_maintenance_pack_interval = 24 * 3600
+indexer_maintenance_prune_interval = 7 * 24 * 3600
+indexer_maintenance_prune_expire = '2.weeks.ago'
+# Share the objects of the repositories having the same root commit in
+# objects pools (object-pool can also be set in the projects definition)
+indexer_object_pools_auto = False
+# Cache of the parsed commits in db_cache_path, keyed by sha and parsers,
+# consulted before reading the commits from git. Commits shared by several
+# repositories (forks, mirrors) or extracted again (after a failure or a
+# reindex) are not parsed again. The least recently used commits are
+# evicted above indexer_parsed_cache_max_bytes.
+indexer_parsed_cache = False
+indexer_parsed_cache_max_bytes = 2 * 1024 ** 3
+# Memory used to sort the shas of the history of a ref. The histories are
+# held and diffed as sorted arrays of binary shas; the shas above this cap
+# are sorted by runs spilled to temporary files.
+indexer_memory_cap_bytes = 512 * 1024 ** 2
+# Only poll the repositories due according to the changes of their refs
+# in --forever mode. A ref that moved is polled again after
+# indexer_poll_min_interval seconds, the interval of a ref that did not
+# move is multiplied by indexer_poll_backoff up to
+# indexer_poll_max_interval seconds. New refs are polled first.
+indexer_adaptive_polling = False
+indexer_poll_min_interval = 300
+indexer_poll_max_interval = 24 * 3600
+indexer_poll_backoff = 2
+# Listen for push notifications (GitHub, GitLab, Gerrit or a generic
+# {"uri": ..., "branch": ...} JSON) in --forever mode and index the pushed
+# repositories at once. 0 disables the receiver. When set, the polling
+# can be made less frequent (indexer_loop_delay, indexer_poll_*).
+indexer_webhook_host = '127.0.0.1'
+indexer_webhook_port = 0
+# Secret of the GitHub signatures, GitLab token or X-Repoxplorer-Token
+# header of the notifications. None to accept any notification.
+indexer_webhook_secret = None
+# Share the repositories between several indexers (--forever mode) through
+# leases stored in the <elasticsearch_index>-leases index. A lease not
+# renewed for indexer_lease_ttl seconds (crashed indexer) is taken over by
+# another indexer. indexer_node_id (or --node-id) defaults to host-pid.
+indexer_leases = False
+indexer_lease_ttl = 300
+indexer_node_id = None
+# Prometheus metrics of the indexer (stages timings, counters, failures by
+# stage) served at http://indexer_metrics_host:indexer_metrics_port/metrics
+# in --forever mode (0 disables it) and/or written at the end of each cycle
+# to indexer_metrics_textfile (node_exporter textfile collector). The JSON
+# summary of the last cycle is written to indexer_metrics_summary.
+indexer_metrics_host = '127.0.0.1'
+indexer_metrics_port = 0
+indexer_metrics_textfile = None
+indexer_metrics_summary = None
 index_custom_html = ""
 users_endpoint = False
 admin_token = 'admin_token'
@@ -54,6 +54,10 @@ class InfosController(object):
 
         infos['line_modifieds_amount'] = int(
             commits_index.get_line_modifieds_stats(**query_kwargs)[1]['sum'])
+        # False while the indexer computes the line statistics of
+        # commits indexed without them (two-phase import)
+        infos['line_stats_complete'] = not commits_index.get_commits_amount(
+            stats_pending=True, **query_kwargs)
 
         repos = [r for r in commits_index.get_repos(**query_kwargs)[1]
                  if not r.startswith('meta_ref: ')]
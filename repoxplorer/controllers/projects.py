@@ -18,7 +18,9 @@ from collections import OrderedDict
 from pecan import abort
 from pecan import expose
 
+from repoxplorer import index
 from repoxplorer import version
+from repoxplorer.index.commits import Commits
 from repoxplorer.index.projects import Projects
 
 rx_version = version.get_version()
@@ -59,4 +61,13 @@ class ProjectsController(object):
         if not project:
             abort(404,
                   detail='Project ID or Tag ID has not been found')
-        return project['refs']
+        refs = project['refs']
+        ref_ids = ['%s:%s:%s' % (r['uri'], r['name'], r['branch'])
+                   for r in refs]
+        pending = Commits(index.Connector()).get_repos(
+            repos=ref_ids, stats_pending=True)[1]
+        # Commits indexed without line statistics (two-phase import).
+        # The refs of the projects cache are not modified.
+        return [dict(ref, line_stats_pending=pending.get(ref_id, 0),
+                     line_stats_complete=not pending.get(ref_id, 0))
+                for ref, ref_id in zip(refs, ref_ids)]
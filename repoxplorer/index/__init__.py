@@ -48,6 +48,16 @@ def add_params(es):
         return {}
 
 
+def get_bulk_params():
+    """ Return the chunking parameters of the bulk helpers
+    """
+    return {
+        'chunk_size': getattr(conf, 'indexer_bulk_chunk_size', 500),
+        'max_chunk_bytes': getattr(
+            conf, 'indexer_bulk_max_chunk_bytes', 100 * 1024 * 1024),
+    }
+
+
 # From https://stackoverflow.com/a/27974027/1966658
 def clean_empty(d):
     if not isinstance(d, (dict, list)):
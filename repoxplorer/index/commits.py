@@ -13,6 +13,7 @@
 #  limitations under the License.
 
 
+import time
 import logging
 import itertools
 
@@ -21,7 +22,10 @@ from datetime import timedelta
 
 from elasticsearch.helpers import scan as scanner
 from elasticsearch.helpers import bulk
+from elasticsearch.helpers import streaming_bulk
+from elasticsearch.helpers import BulkIndexError
 from repoxplorer.index import add_params
+from repoxplorer.index import get_bulk_params
 from repoxplorer.index import clean_empty
 
 logger = logging.getLogger(__name__)
@@ -41,8 +45,48 @@ PROPERTIES = {
     "merge_commit": {"type": "boolean"},
     "commit_msg": {"type": "text"},
     "files_list": {"type": "keyword"},
+    # Set when the line statistics (line_modifieds and files_list)
+    # are not yet computed by the indexer
+    "stats_pending": {"type": "boolean"},
 }
 
+# Add params.refs to the repos field of a commit. Nothing is
+# written when the commit already belongs to all the refs.
+ADD_REFS_SCRIPT = """
+boolean changed = false;
+for (ref in params.refs) {
+  if (!ctx._source.repos.contains(ref)) {
+    ctx._source.repos.add(ref);
+    changed = true;
+  }
+}
+if (!changed) {
+  ctx.op = 'noop';
+}
+"""
+
+# Remove params.ref from the repos field of a commit. The commit is
+# deleted when it no longer belongs to a ref (a remaining meta ref
+# does not count).
+REMOVE_REF_SCRIPT = """
+if (!ctx._source.repos.contains(params.ref)) {
+  ctx.op = 'noop';
+} else {
+  String ref = params.ref;
+  ctx._source.repos.removeIf(r -> r == ref);
+  if (ctx._source.repos.isEmpty() ||
+      (ctx._source.repos.size() == 1 &&
+       ctx._source.repos[0].startsWith('meta_ref: '))) {
+    ctx.op = 'delete';
+  }
+}
+"""
+
+# Attempts of remove_ref_by_query when commits are updated concurrently
+# and delay in seconds before the first retry, doubled at each retry
+REMOVE_REF_ATTEMPTS = 6
+REMOVE_REF_RETRY_DELAY = 1
+
 DYNAMIC_TEMPLATES = [
     {
         "strings": {
@@ -61,6 +105,9 @@ class Commits(object):
         self.ic = connector.ic
         self.index = connector.index
         self.dbname = 'commits'
+        # The index is refreshed after each write unless disabled
+        # (see the indexer ingest mode)
+        self.auto_refresh = True
         self.mapping = {
             self.dbname: {
                 "properties": PROPERTIES,
@@ -73,18 +120,69 @@ class Commits(object):
             self.ic.put_mapping(index=self.index, doc_type=self.dbname,
                                 body=self.mapping, **kwargs)
 
+    def refresh(self, force=False):
+        if self.auto_refresh or force:
+            self.es.indices.refresh(index=self.index)
+
+    def create_actions(self, source_it):
+        for source in source_it:
+            d = {}
+            d['_index'] = self.index
+            d['_type'] = self.dbname
+            d['_op_type'] = 'create'
+            d['_id'] = source['sha']
+            d['_source'] = source
+            yield d
+
+    def upsert_actions(self, source_it):
+        # A commit already indexed, for instance by another ref
+        # sharing it, gets the refs of the source added
+        for source in source_it:
+            d = {}
+            d['_index'] = self.index
+            d['_type'] = self.dbname
+            d['_op_type'] = 'update'
+            d['_id'] = source['sha']
+            d['retry_on_conflict'] = 5
+            d['_source'] = {
+                'script': {
+                    'source': ADD_REFS_SCRIPT,
+                    'lang': 'painless',
+                    'params': {'refs': source['repos']},
+                },
+                'upsert': source,
+            }
+            yield d
+
     def add_commits(self, source_it):
-        def gen(it):
-            for source in it:
-                d = {}
-                d['_index'] = self.index
-                d['_type'] = self.dbname
-                d['_op_type'] = 'create'
-                d['_id'] = source['sha']
-                d['_source'] = source
-                yield d
-        bulk(self.es, gen(source_it))
-        self.es.indices.refresh(index=self.index)
+        bulk(self.es, self.create_actions(source_it), **get_bulk_params())
+        self.refresh()
+
+    def bulk_create(self, sources):
+        """ Create the commits of sources with a single bulk request
+        and without retries nor refresh. Return the created shas, the
+        sources rejected because the cluster is overloaded (429) and
+        the failed items. Commits already indexed count as created,
+        the refs of their sources are added to them.
+        A request rejected as a whole raises a TransportError.
+        """
+        created = []
+        rejected = []
+        errors = []
+        by_sha = dict((source['sha'], source) for source in sources)
+        for ok, item in streaming_bulk(
+                self.es, self.upsert_actions(sources),
+                chunk_size=len(sources) or 1,
+                max_chunk_bytes=get_bulk_params()['max_chunk_bytes'],
+                raise_on_error=False, max_retries=0):
+            item = item['update']
+            if ok:
+                created.append(item['_id'])
+            elif item.get('status') == 429:
+                rejected.append(by_sha[item['_id']])
+            else:
+                errors.append(item)
+        return created, rejected, errors
 
     def update_commits(self, source_it, field='repos'):
         """ Take the sha from each doc and use
@@ -102,8 +200,155 @@ class Commits(object):
                 d['_id'] = source['sha']
                 d['_source'] = {'doc': {field: source[field]}}
                 yield d
-        bulk(self.es, gen(source_it))
-        self.es.indices.refresh(index=self.index)
+        bulk(self.es, gen(source_it), **get_bulk_params())
+        self.refresh()
+
+    def script_update_commits(self, sha_list, script, params):
+        """ Run a script update on each commit of sha_list. Return a
+        dict sha -> result where result is one of 'updated', 'noop',
+        'deleted' or 'not_found'.
+        """
+        def gen(it):
+            for sha in it:
+                d = {}
+                d['_index'] = self.index
+                d['_type'] = self.dbname
+                d['_op_type'] = 'update'
+                d['_id'] = sha
+                d['retry_on_conflict'] = 5
+                d['_source'] = {
+                    'script': {
+                        'source': script,
+                        'lang': 'painless',
+                        'params': params,
+                    }
+                }
+                yield d
+        ret = {}
+        errors = []
+        for ok, item in streaming_bulk(self.es, gen(sha_list),
+                                       raise_on_error=False,
+                                       **get_bulk_params()):
+            item = item['update']
+            if ok:
+                ret[item['_id']] = item['result']
+            elif item.get('status') == 404:
+                ret[item['_id']] = 'not_found'
+            else:
+                errors.append(item)
+        self.refresh()
+        if errors:
+            raise BulkIndexError(
+                "%i document(s) failed to update." % len(errors), errors)
+        return ret
+
+    def add_refs(self, sha_list, refs):
+        """ Add refs to the repos field of the commits of sha_list
+        """
+        return self.script_update_commits(
+            sha_list, ADD_REFS_SCRIPT, {'refs': refs})
+
+    def remove_ref(self, sha_list, ref):
+        """ Remove ref from the repos field of the commits of
+        sha_list. Commits that no longer belong to a ref are deleted.
+        """
+        return self.script_update_commits(
+            sha_list, REMOVE_REF_SCRIPT, {'ref': ref})
+
+    def remove_ref_by_query(self, ref):
+        """ Remove ref from all the commits that belong to it.
+        Return the amounts of updated and deleted commits.
+        """
+        body = {
+            'query': {
+                'term': {'repos': ref}
+            },
+            'script': {
+                'source': REMOVE_REF_SCRIPT,
+                'lang': 'painless',
+                'params': {'ref': ref},
+            }
+        }
+        ret = {'updated': 0, 'deleted': 0}
+        for attempt in range(REMOVE_REF_ATTEMPTS):
+            if attempt:
+                time.sleep(REMOVE_REF_RETRY_DELAY * 2 ** (attempt - 1))
+            res = self.es.update_by_query(
+                index=self.index, body=body,
+                conflicts='proceed', refresh=self.auto_refresh)
+            if res.get('failures'):
+                raise Exception(
+                    'Unable to remove ref %s from commits: %s' % (
+                        ref, res['failures']))
+            ret['updated'] += res['updated']
+            ret['deleted'] += res['deleted']
+            # Documents updated concurrently are processed again
+            if not res['version_conflicts']:
+                return ret
+            logger.info("Ref %s: %s commits updated concurrently" % (
+                ref, res['version_conflicts']))
+        raise Exception(
+            'Unable to remove ref %s from commits: still updated '
+            'concurrently after %s attempts' % (ref, REMOVE_REF_ATTEMPTS))
+
+    def set_stats(self, sources):
+        """ Set the line statistics of commits indexed without them.
+        Each source is a dict with the sha of the commit and the fields
+        to set.
+        """
+        def gen(it):
+            for source in it:
+                doc = dict(source)
+                d = {}
+                d['_index'] = self.index
+                d['_type'] = self.dbname
+                d['_op_type'] = 'update'
+                d['_id'] = doc.pop('sha')
+                doc['stats_pending'] = False
+                d['_source'] = {'doc': doc}
+                yield d
+        bulk(self.es, gen(sources), **get_bulk_params())
+        self.refresh()
+
+    def get_stats_pending(self, ref, size):
+        """ Return the shas of at most size commits of ref without line
+        statistics. The newest commits are returned first.
+        """
+        body = {
+            'query': {
+                'bool': {
+                    'filter': [
+                        {'term': {'repos': ref}},
+                        {'term': {'stats_pending': True}},
+                    ]
+                }
+            }
+        }
+        res = self.es.search(index=self.index, body=body, size=size,
+                             _source=False, sort='committer_date:desc')
+        return [hit['_id'] for hit in res['hits']['hits']]
+
+    def get_existing_ids(self, sha_list):
+        """ Return the set of sha of sha_list that are indexed
+        """
+        body = {"ids": list(sha_list)}
+        res = self.es.mget(index=self.index,
+                           doc_type=self.dbname,
+                           _source=False,
+                           body=body)
+        return set(c['_id'] for c in res['docs'] if c['found'])
+
+    def get_commits_repos(self, sha_list):
+        """ Return a dict sha -> repos field of the commits of sha_list
+        that are indexed
+        """
+        body = {"ids": list(sha_list)}
+        res = self.es.mget(index=self.index,
+                           doc_type=self.dbname,
+                           _source_includes=['repos'],
+                           body=body)
+        return dict((c['_id'], c['_source'].get('repos', []))
+                    for c in res['docs'] if c['found'])
 
     def get_commit(self, sha, silent=False):
         try:
@@ -127,6 +372,42 @@ class Commits(object):
         except Exception as e:
             logger.error('Unable to get mulitple commits. %s' % e)
 
+    def get_all_commits_repos(self):
+        """ Return an iterator over all commits documents with only
+        the repos field as source.
+        """
+        query = {
+            '_source': ['repos'],
+            'query': {
+                'match_all': {}
+            }
+        }
+        return scanner(self.es, query=query, index=self.index)
+
+    def iter_refs(self, size=1000):
+        """ Yield the refs of the indexed commits. The meta refs are
+        not returned.
+        """
+        after = None
+        while True:
+            composite = {
+                'size': size,
+                'sources': [{'ref': {'terms': {'field': 'repos'}}}],
+            }
+            if after:
+                composite['after'] = after
+            res = self.es.search(
+                index=self.index,
+                body={'size': 0,
+                      'aggs': {'refs': {'composite': composite}}})
+            agg = res['aggregations']['refs']
+            for bucket in agg['buckets']:
+                if not bucket['key']['ref'].startswith('meta_ref: '):
+                    yield bucket['key']['ref']
+            after = agg.get('after_key')
+            if not after or len(agg['buckets']) < size:
+                return
+
     def del_commits(self, sha_list):
         def gen(it):
             for sha in it:
@@ -136,8 +417,8 @@ class Commits(object):
                 d['_op_type'] = 'delete'
                 d['_id'] = sha
                 yield d
-        bulk(self.es, gen(sha_list))
-        self.es.indices.refresh(index=self.index)
+        bulk(self.es, gen(sha_list), **get_bulk_params())
+        self.refresh()
 
     def get_filter(self, mails, repos, metadata,
                    mails_neg=False, domains=None, blacklisted_mails=None):
@@ -312,8 +593,10 @@ class Commits(object):
                            fromdate=None, todate=None,
                            merge_commit=None, metadata=[],
                            mails_neg=False, domains=None,
-                           blacklisted_mails=None):
+                           blacklisted_mails=None, stats_pending=None):
         """ Return the amount of commits for authors and/or repos.
+        If stats_pending is True only the commits without line
+        statistics are counted.
         """
         params = {'index': self.index, 'doc_type': self.dbname}
 
@@ -342,6 +625,10 @@ class Commits(object):
             body["query"]["bool"]["filter"]["bool"]["must"].append(
                 {"term": {"merge_commit": merge_commit}})
 
+        if stats_pending is not None:
+            body["query"]["bool"]["filter"]["bool"]["must"].append(
+                {"term": {"stats_pending": stats_pending}})
+
         params['body'] = body
         params = clean_empty(params)
         res = self.es.count(**params)
@@ -625,10 +912,12 @@ class Commits(object):
     def get_repos(self, mails=[], repos=[],
                   fromdate=None, todate=None,
                   merge_commit=None, metadata={},
-                  mails_neg=False, domains=None, blacklisted_mails=None):
+                  mails_neg=False, domains=None, blacklisted_mails=None,
+                  stats_pending=None):
         """ Return the repos (removed duplicated) also
         this return the amount of hits. The hits value is
-        the amount of commit for an uniq repo.
+        the amount of commit for an uniq repo. If stats_pending
+        is True only the commits without line statistics are counted.
         """
         params = {'index': self.index}
 
@@ -666,6 +955,10 @@ class Commits(object):
             body["query"]["bool"]["filter"]["bool"]["must"].append(
                 {"term": {"merge_commit": merge_commit}})
 
+        if stats_pending is not None:
+            body["query"]["bool"]["filter"]["bool"]["must"].append(
+                {"term": {"stats_pending": stats_pending}})
+
         params['body'] = body
         params['size'] = 0
         params = clean_empty(params)
@@ -88,6 +88,10 @@ properties:
               $ref: "#/definitions/release"
           index-tags:
             type: boolean
+          index-since:
+            type: string
+          object-pool:
+            type: string
 """
 
 project_templates_example = """
@@ -114,6 +118,7 @@ templates:
     paths:
     - project/tests/
     index-tags: true
+    index-since: 2014-01-01
 """
 
 projects_schema = r"""
@@ -187,6 +192,10 @@ properties:
                     items:
                       type: string
                       minItems: 1
+                  index-since:
+                    type: string
+                  object-pool:
+                    type: string
 """
 
 projects_example = """
@@ -258,6 +267,8 @@ class EProjects(object):
                 "paths": {"type": "keyword"},
                 "parsers": {"type": "keyword"},
                 "index-tags": {"type": "boolean"},
+                "index-since": {"type": "long"},
+                "object-pool": {"type": "keyword"},
                 "releases": {
                     "type": "nested",
                     "properties": {
@@ -491,6 +502,10 @@ class Projects(YAMLDefinition):
                 paths = []
                 if 'paths' in repo:
                     paths = copy.copy(repo['paths'])
+                # Save history horizon mentioned for a repo
+                index_since = repo.get('index-since')
+                # Save objects pool mentioned for a repo
+                object_pool = repo.get('object-pool')
                 # Apply the template
                 if 'template' in repo:
                     repo.update(copy.deepcopy(
@@ -511,6 +526,12 @@ class Projects(YAMLDefinition):
                 # Restore defined paths at repo level
                 if paths:
                     repo['paths'] = paths
+                # Restore defined history horizon at repo level
+                if index_since:
+                    repo['index-since'] = index_since
+                # Restore defined objects pool at repo level
+                if object_pool:
+                    repo['object-pool'] = object_pool
                 # Apply default values
                 if 'parsers' not in repo:
                     repo['parsers'] = []
@@ -521,6 +542,8 @@ class Projects(YAMLDefinition):
                 # Transform date to epoch
                 for release in repo['releases']:
                     release['date'] = date2epoch(release['date'])
+                if 'index-since' in repo:
+                    repo['index-since'] = date2epoch(repo['index-since'])
 
     def _flatten_projects(self):
         flatten = {}
@@ -574,6 +597,14 @@ class Projects(YAMLDefinition):
                         except Exception:
                             issues.append("Wrong date format %s defined "
                                           "in template %s" % (r['date'], tid))
+                if 'index-since' in templates:
+                    try:
+                        datetime.strptime(
+                            templates['index-since'], "%Y-%m-%d")
+                    except Exception:
+                        issues.append("Wrong date format %s defined "
+                                      "in template %s" % (
+                                          templates['index-since'], tid))
         return ids, issues
 
     def _validate_projects(self, tids):
@@ -594,6 +625,15 @@ class Projects(YAMLDefinition):
                         issues.append("Project ID '%s' Repo ID '%s' "
                                       "references an unknown template %s" % (
                                           pid, rid, template))
+                    if 'index-since' in repo:
+                        try:
+                            datetime.strptime(
+                                repo['index-since'], "%Y-%m-%d")
+                        except Exception:
+                            issues.append("Wrong date format %s defined "
+                                          "in Project ID '%s' Repo ID "
+                                          "'%s'" % (repo['index-since'],
+                                                    pid, rid))
         return issues
 
     def validate(self):
@@ -19,6 +19,7 @@ from elasticsearch.helpers import bulk
 from elasticsearch.helpers import scan as scanner
 
 from repoxplorer.index import add_params
+from repoxplorer.index import get_bulk_params
 from repoxplorer.index import clean_empty
 
 logger = logging.getLogger(__name__)
@@ -57,7 +58,7 @@ class Tags(object):
                 d['_op_type'] = 'index'
                 d['_source'] = source
                 yield d
-        bulk(self.es, gen(source_it))
+        bulk(self.es, gen(source_it), **get_bulk_params())
         self.es.indices.refresh(index=self.index)
 
     def del_tags(self, id_list):
@@ -69,7 +70,7 @@ class Tags(object):
                 d['_op_type'] = 'delete'
                 d['_id'] = i
                 yield d
-        bulk(self.es, gen(id_list))
+        bulk(self.es, gen(id_list), **get_bulk_params())
         self.es.indices.refresh(index=self.index)
 
     def get_tags(self, repos, fromdate=None, todate=None):
@@ -0,0 +1,386 @@
+# Copyright 2016, Fabien Boucher
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+""" Readers of the commits of a local Git repository. A reader yields
+(header, stats) records in the format produced by the git log stream
+of the indexer (see indexer.STREAM_FORMAT).
+"""
+
+import os
+import re
+import difflib
+import logging
+import threading
+import subprocess
+
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+# Amount of commits requested to the persistent processes before
+# reading their outputs. This keeps the writes under the pipe capacity.
+BATCH_WINDOW = 256
+# Maximum amount of readers kept open by a process
+MAX_READERS = 8
+# Git considers a blob as binary if a NUL char is found in its first
+# bytes
+BINARY_CHECK_SIZE = 8000
+
+IDENT_RE = re.compile(rb'(.*?) ?<(.*)> (\d+)')
+
+_readers = OrderedDict()
+_readers_lock = threading.Lock()
+
+
+def get_reader(mode, path):
+    """ Return the reader of the repository at path. Readers are kept
+    open and reused by the next calls for the same repository.
+    """
+    key = (mode, path)
+    with _readers_lock:
+        reader = _readers.pop(key, None)
+        if reader is None or not reader.is_alive():
+            if reader:
+                reader.close()
+            reader = READERS[mode](path)
+        _readers[key] = reader
+        while len(_readers) > MAX_READERS:
+            _, evicted = _readers.popitem(last=False)
+            evicted.close()
+        return reader
+
+
+def iter_lines(cmd, path):
+    """ Yield the lines of the output of cmd as they are produced so
+    large outputs (the history of a ref) are not held in memory.
+    """
+    process = subprocess.Popen(cmd, stdout=subprocess.PIPE,
+                               stderr=subprocess.PIPE, cwd=path)
+    try:
+        for line in process.stdout:
+            yield line.decode(errors='replace').rstrip('\n')
+        err = process.stderr.read()
+        if process.wait() != 0:
+            logger.debug(err)
+            raise Exception(
+                '%s exited with code %s' % (cmd, process.returncode))
+    finally:
+        if process.poll() is None:
+            process.kill()
+            process.wait()
+        process.stdout.close()
+        process.stderr.close()
+
+
+def drop_reader(reader):
+    with _readers_lock:
+        for key, _reader in list(_readers.items()):
+            if _reader is reader:
+                del _readers[key]
+    reader.close()
+
+
+def close_readers():
+    with _readers_lock:
+        while _readers:
+            _readers.popitem()[1].close()
+
+
+def make_header(sha, parents, author, committer, message):
+    """ Build a record header from the raw author and committer ident
+    lines ("name <email> timestamp tz").
+    """
+    fields = [sha, b' '.join(parents)]
+    for ident in (author, committer):
+        m = IDENT_RE.match(ident or b'')
+        if m:
+            fields.extend(m.groups())
+        else:
+            # Malformed ident
+            fields.extend((ident or b'', b'', b'0'))
+    fields.append(message)
+    return b'\n'.join(fields)
+
+
+def format_rename(a, b):
+    """ Format a renamed path like git diff --numstat does
+    ("dir/{old => new}/file").
+    """
+    pfx = 0
+    i = 0
+    while i < len(a) and i < len(b) and a[i] == b[i]:
+        if a[i] == '/':
+            pfx = i + 1
+        i += 1
+    sfx = 0
+    ia, ib = len(a), len(b)
+    # A common prefix ends with a slash that may also start the common
+    # suffix. Indexes past the end stand for the string terminators.
+    adjust = 1 if pfx else 0
+    while (pfx - adjust <= ia and pfx - adjust <= ib and
+           a[ia:ia + 1] == b[ib:ib + 1]):
+        if a[ia:ia + 1] == '/':
+            sfx = len(a) - ia
+        ia -= 1
+        ib -= 1
+    a_mid = max(len(a) - pfx - sfx, 0)
+    b_mid = max(len(b) - pfx - sfx, 0)
+    if pfx + sfx:
+        return '%s{%s => %s}%s' % (
+            a[:pfx], a[pfx:pfx + a_mid], b[pfx:pfx + b_mid],
+            a[len(a) - sfx:])
+    return '%s => %s' % (a, b)
+
+
+class GitReader(object):
+    """ Base of the readers listing the commits of the repository at
+    path. The readers read the commits with iter_records(shas).
+    """
+    def __init__(self, path):
+        self.path = path
+
+    def is_alive(self):
+        return True
+
+    def close(self):
+        pass
+
+    def get_all_shas(self, ref, exclude=None):
+        return list(self.iter_all_shas(ref, exclude))
+
+    def iter_all_shas(self, ref, exclude=None):
+        cmd = ['git', 'rev-list', ref]
+        if exclude:
+            cmd.append('^%s' % exclude)
+        return iter_lines(cmd, self.path)
+
+
+class CatFileReader(GitReader):
+    """ Read the commits with a persistent git cat-file --batch process
+    and a persistent git diff-tree --stdin process for the numstat of
+    the commits. The processes are started by the first read.
+    """
+    def __init__(self, path):
+        super(CatFileReader, self).__init__(path)
+        self.cat = None
+        self.diff = None
+
+    def start(self):
+        if self.cat is not None:
+            return
+        self.cat = self.spawn(['git', 'cat-file', '--batch'])
+        # Each commit is followed by an empty line echoed by diff-tree
+        # to delimit its numstat lines.
+        self.diff = self.spawn(
+            ['git', 'diff-tree', '--stdin', '--root', '-r', '-M',
+             '--numstat', '--no-commit-id'])
+
+    def spawn(self, cmd):
+        env = dict(os.environ)
+        env['GIT_FLUSH'] = '1'
+        return subprocess.Popen(cmd,
+                                stdin=subprocess.PIPE,
+                                stdout=subprocess.PIPE,
+                                stderr=subprocess.DEVNULL,
+                                cwd=self.path, env=env)
+
+    def is_alive(self):
+        if self.cat is None:
+            return True
+        return self.cat.poll() is None and self.diff.poll() is None
+
+    def close(self):
+        processes = [p for p in (self.cat, self.diff) if p is not None]
+        self.cat = None
+        self.diff = None
+        for process in processes:
+            try:
+                process.stdin.close()
+            except Exception:
+                pass
+            try:
+                process.wait(timeout=5)
+            except subprocess.TimeoutExpired:
+                process.kill()
+                process.wait()
+            process.stdout.close()
+
+    def read_commit(self, sha):
+        header = self.cat.stdout.readline()
+        if not header:
+            raise Exception('git cat-file exited in %s' % self.path)
+        parts = header.split()
+        if len(parts) != 3:
+            # Missing object
+            return None
+        data = self.cat.stdout.read(int(parts[2]) + 1)[:-1]
+        if parts[1] != b'commit':
+            return None
+        headers, _, message = data.partition(b'\n\n')
+        parents = []
+        author = committer = None
+        for line in headers.split(b'\n'):
+            if line.startswith(b'parent '):
+                parents.append(line[7:])
+            elif line.startswith(b'author '):
+                author = line[7:]
+            elif line.startswith(b'committer '):
+                committer = line[10:]
+        return make_header(sha, parents, author, committer, message)
+
+    def read_stats(self):
+        lines = []
+        while True:
+            line = self.diff.stdout.readline()
+            if not line:
+                raise Exception('git diff-tree exited in %s' % self.path)
+            if line == b'\n':
+                return b''.join(lines)
+            lines.append(line)
+
+    def iter_records(self, shas):
+        self.start()
+        for i in range(0, len(shas), BATCH_WINDOW):
+            window = [sha.encode() for sha in shas[i:i + BATCH_WINDOW]]
+            self.cat.stdin.write(b''.join(sha + b'\n' for sha in window))
+            self.cat.stdin.flush()
+            headers = []
+            for sha in window:
+                header = self.read_commit(sha)
+                if header is None:
+                    logger.warning("Commit %s not found in %s" % (
+                        sha.decode(), self.path))
+                    continue
+                headers.append(header)
+            # diff-tree dies on unknown objects so only the found
+            # commits are requested
+            self.diff.stdin.write(b''.join(
+                header.split(b'\n', 1)[0] + b'\n\n' for header in headers))
+            self.diff.stdin.flush()
+            for header in headers:
+                yield header, self.read_stats()
+
+
+class DulwichReader(GitReader):
+    """ Read the commits in process with dulwich. The numstat of the
+    commits are computed with difflib so line counts can slightly
+    differ from git ones on complex diffs.
+    """
+    def __init__(self, path):
+        # dulwich is an optional dependency (the dulwich extra)
+        try:
+            from dulwich.repo import Repo
+            from dulwich.objects import S_ISGITLINK
+            from dulwich import diff_tree
+        except ImportError:
+            raise Exception("The dulwich extract mode requires the "
+                            "dulwich module")
+        super(DulwichReader, self).__init__(path)
+        self.is_gitlink = S_ISGITLINK
+        self.diff_tree = diff_tree
+        self.repo = Repo(path)
+        self.renames = diff_tree.RenameDetector(
+            self.repo.object_store, rename_threshold=50)
+
+    def close(self):
+        self.repo.close()
+
+    def resolve(self, ref):
+        ref = ref.encode()
+        if ref in self.repo.refs:
+            sha = self.repo.refs[ref]
+        else:
+            sha = ref
+        obj = self.repo[sha]
+        # Peel annotated tags
+        while obj.type_name == b'tag':
+            obj = self.repo[obj.object[1]]
+        return obj.id
+
+    def iter_all_shas(self, ref, exclude=None):
+        exclude = [self.resolve(exclude)] if exclude else None
+        walker = self.repo.get_walker(
+            include=[self.resolve(ref)], exclude=exclude)
+        for entry in walker:
+            yield entry.commit.id.decode()
+
+    def get_lines(self, entry):
+        if entry is None or entry.sha is None:
+            return []
+        if self.is_gitlink(entry.mode):
+            return [b'Subproject commit ' + entry.sha + b'\n']
+        data = self.repo.object_store[entry.sha].as_raw_string()
+        if b'\0' in data[:BINARY_CHECK_SIZE]:
+            return None
+        return data.splitlines(True)
+
+    def get_stats(self, commit):
+        if len(commit.parents) > 1:
+            # git log does not show the diff of merge commits
+            return b''
+        parent_tree = None
+        if commit.parents:
+            parent_tree = self.repo[commit.parents[0]].tree
+        stats = []
+        for change in self.diff_tree.tree_changes(
+                self.repo.object_store, parent_tree, commit.tree,
+                rename_detector=self.renames):
+            old, new = change.old, change.new
+            if change.type == self.diff_tree.CHANGE_COPY:
+                # Copies are not detected by git log
+                old = None
+            if old is None or old.path is None:
+                path = new.path.decode(errors='replace')
+            elif new is None or new.path is None:
+                path = old.path.decode(errors='replace')
+            elif old.path != new.path:
+                path = format_rename(old.path.decode(errors='replace'),
+                                     new.path.decode(errors='replace'))
+            else:
+                path = new.path.decode(errors='replace')
+            a = self.get_lines(old)
+            b = self.get_lines(new)
+            if a is None or b is None:
+                stats.append('-\t-\t%s\n' % path)
+                continue
+            added = removed = 0
+            matcher = difflib.SequenceMatcher(None, a, b, autojunk=False)
+            for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+                if tag in ('replace', 'delete'):
+                    removed += i2 - i1
+                if tag in ('replace', 'insert'):
+                    added += j2 - j1
+            stats.append('%s\t%s\t%s\n' % (added, removed, path))
+        return ''.join(stats).encode()
+
+    def iter_records(self, shas):
+        for sha in shas:
+            try:
+                commit = self.repo[sha.encode()]
+            except KeyError:
+                logger.warning("Commit %s not found in %s" % (
+                    sha, self.path))
+                continue
+            header = make_header(
+                commit.id, commit.parents,
+                commit.author + b' %d' % commit.author_time,
+                commit.committer + b' %d' % commit.commit_time,
+                commit.message)
+            yield header, self.get_stats(commit)
+
+
+READERS = {
+    'batch': CatFileReader,
+    'dulwich': DulwichReader,
+}
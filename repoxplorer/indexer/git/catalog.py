@@ -0,0 +1,195 @@
+# Copyright 2016, Fabien Boucher
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+import os
+import sqlite3
+import logging
+import threading
+
+from pecan import conf
+
+from repoxplorer import index
+from repoxplorer.index.commits import Commits
+
+logger = logging.getLogger(__name__)
+
+CATALOG_FILE = 'commits-catalog.sqlite'
+# Max amount of variables in a SQLite statement
+QUERY_CHUNK = 500
+# Amount of shas read at once by CommitsCatalog.iter_ref_shas
+REF_SHAS_PAGE = 10000
+
+_catalog = None
+_catalog_lock = threading.Lock()
+
+
+def get_catalog():
+    """ Return the commits catalog of the process or None if the
+    catalog is not activated. The catalog is built from the index at
+    first use.
+    """
+    global _catalog
+    if not getattr(conf, 'indexer_commits_catalog', False):
+        return None
+    with _catalog_lock:
+        if _catalog is None:
+            catalog = CommitsCatalog()
+            if not catalog.is_built():
+                logger.info("Commits catalog %s is not built. Build it "
+                            "from the index." % catalog.path)
+                catalog.rebuild(Commits(index.Connector()))
+            _catalog = catalog
+    return _catalog
+
+
+def chunks(items, size=QUERY_CHUNK):
+    items = list(items)
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+class CommitsCatalog(object):
+    """ Local catalog of the indexed commits. It maps each commit sha
+    to the refs the commit belongs to (the repos field of the commit
+    documents) so the indexer can decide which commits to create,
+    update or delete without reading from the index.
+    """
+    def __init__(self, path=None, index_name=None):
+        self.path = path or os.path.join(conf.db_cache_path, CATALOG_FILE)
+        self.index_name = (index_name or
+                           getattr(conf, 'elasticsearch_index', None) or
+                           'repoxplorer')
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(
+            self.path, timeout=60, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        with self.db:
+            self.db.execute(
+                'CREATE TABLE IF NOT EXISTS refs ('
+                'sha TEXT NOT NULL, ref TEXT NOT NULL, '
+                'PRIMARY KEY (sha, ref)) WITHOUT ROWID')
+            self.db.execute(
+                'CREATE INDEX IF NOT EXISTS refs_ref ON refs (ref)')
+            self.db.execute(
+                'CREATE TABLE IF NOT EXISTS meta ('
+                'key TEXT PRIMARY KEY, value TEXT)')
+
+    def close(self):
+        self.db.close()
+
+    def is_built(self):
+        with self.lock:
+            row = self.db.execute(
+                "SELECT value FROM meta WHERE key = 'index'").fetchone()
+        return bool(row) and row[0] == self.index_name
+
+    def get_ref_shas(self, ref):
+        return list(self.iter_ref_shas(ref))
+
+    def iter_ref_shas(self, ref, size=REF_SHAS_PAGE):
+        """ Yield the shas of ref, in sha order, read by pages of size
+        shas so the catalog is not locked while they are consumed.
+        """
+        last = ''
+        while True:
+            with self.lock:
+                rows = self.db.execute(
+                    'SELECT sha FROM refs WHERE ref = ? AND sha > ? '
+                    'ORDER BY sha LIMIT ?', (ref, last, size)).fetchall()
+            if not rows:
+                return
+            last = rows[-1][0]
+            for row in rows:
+                yield row[0]
+
+    def get_refs(self, shas):
+        """ Return a dict sha -> set of refs for the known shas
+        """
+        ret = {}
+        with self.lock:
+            for chunk in chunks(shas):
+                for sha, ref in self.db.execute(
+                        'SELECT sha, ref FROM refs WHERE sha IN (%s)' % (
+                            ",".join('?' * len(chunk))), chunk):
+                    ret.setdefault(sha, set()).add(ref)
+        return ret
+
+    def add_refs(self, shas, refs):
+        with self.lock, self.db:
+            self.db.executemany(
+                'INSERT OR IGNORE INTO refs (sha, ref) VALUES (?, ?)',
+                ((sha, ref) for sha in shas for ref in refs))
+
+    def remove_ref(self, shas, ref):
+        with self.lock, self.db:
+            self.db.executemany(
+                'DELETE FROM refs WHERE sha = ? AND ref = ?',
+                ((sha, ref) for sha in shas))
+
+    def remove_shas(self, shas):
+        with self.lock, self.db:
+            self.db.executemany(
+                'DELETE FROM refs WHERE sha = ?', ((sha,) for sha in shas))
+
+    def rebuild(self, commits):
+        """ Rebuild the catalog from the commits of the index
+        """
+        logger.info("Rebuild the commits catalog from index %s" % (
+            commits.index))
+        with self.lock, self.db:
+            self.db.execute('DELETE FROM refs')
+            self.db.execute("DELETE FROM meta WHERE key = 'index'")
+            amount = 0
+            for hit in commits.get_all_commits_repos():
+                self.db.executemany(
+                    'INSERT OR IGNORE INTO refs (sha, ref) VALUES (?, ?)',
+                    ((hit['_id'], ref) for ref in hit['_source']['repos']))
+                amount += 1
+            self.db.execute(
+                "INSERT INTO meta (key, value) VALUES ('index', ?)",
+                (self.index_name,))
+        logger.info("Commits catalog rebuilt with %s commits" % amount)
+        return amount
+
+    def check(self, commits, samples=10):
+        """ Compare the catalog with the commits of the index. Return
+        the (sha, ref) couples only found in the index (missing) and
+        those only found in the catalog (extra). At most samples
+        couples of each are returned with the total amounts.
+        """
+        with self.lock, self.db:
+            self.db.execute(
+                'CREATE TEMP TABLE IF NOT EXISTS indexed ('
+                'sha TEXT NOT NULL, ref TEXT NOT NULL, '
+                'PRIMARY KEY (sha, ref)) WITHOUT ROWID')
+            self.db.execute('DELETE FROM indexed')
+            for hit in commits.get_all_commits_repos():
+                self.db.executemany(
+                    'INSERT OR IGNORE INTO indexed (sha, ref) '
+                    'VALUES (?, ?)',
+                    ((hit['_id'], ref) for ref in hit['_source']['repos']))
+            ret = {}
+            for key, query in (
+                    ('missing',
+                     'SELECT sha, ref FROM indexed EXCEPT '
+                     'SELECT sha, ref FROM refs'),
+                    ('extra',
+                     'SELECT sha, ref FROM refs EXCEPT '
+                     'SELECT sha, ref FROM indexed')):
+                rows = self.db.execute(query).fetchall()
+                ret[key] = len(rows)
+                ret['%s_samples' % key] = rows[:samples]
+            self.db.execute('DROP TABLE indexed')
+        return ret
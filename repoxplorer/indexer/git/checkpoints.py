@@ -0,0 +1,188 @@
+# Copyright 2016, Fabien Boucher
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+import os
+import time
+import sqlite3
+import logging
+import threading
+
+from pecan import conf
+
+logger = logging.getLogger(__name__)
+
+CHECKPOINTS_FILE = 'import-checkpoints.sqlite'
+
+_checkpoints = None
+_checkpoints_lock = threading.Lock()
+
+
+def get_checkpoints():
+    """ Return the import checkpoints of the process
+    """
+    global _checkpoints
+    path = os.path.join(conf.db_cache_path, CHECKPOINTS_FILE)
+    with _checkpoints_lock:
+        if _checkpoints is None or _checkpoints.path != path:
+            _checkpoints = ImportCheckpoints(path)
+    return _checkpoints
+
+
+class ImportCheckpoints(object):
+    """ Durable progress of the commits imports. The chunks of commits
+    to create of a ref are recorded when its import starts and each
+    chunk is removed once all its commits are indexed. An import
+    interrupted by a crash or by failed chunks is resumed from its
+    remaining chunks.
+    """
+    def __init__(self, path=None):
+        self.path = path or os.path.join(conf.db_cache_path, CHECKPOINTS_FILE)
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(
+            self.path, timeout=60, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        with self.db:
+            self.db.execute(
+                'CREATE TABLE IF NOT EXISTS imports ('
+                'ref TEXT PRIMARY KEY, tip TEXT NOT NULL, '
+                'stats INTEGER NOT NULL, started INTEGER NOT NULL)')
+            self.db.execute(
+                'CREATE TABLE IF NOT EXISTS chunks ('
+                'ref TEXT NOT NULL, chunk INTEGER NOT NULL, '
+                'shas TEXT NOT NULL, attempts INTEGER NOT NULL, '
+                'PRIMARY KEY (ref, chunk)) WITHOUT ROWID')
+
+    def close(self):
+        self.db.close()
+
+    def start(self, ref, tip, stats, chunks):
+        """ Record the import of the chunks (lists of shas) of ref up
+        to tip. A previous import of ref is replaced.
+        """
+        with self.lock, self.db:
+            self.db.execute('DELETE FROM chunks WHERE ref = ?', (ref,))
+            self.db.execute(
+                'INSERT OR REPLACE INTO imports (ref, tip, stats, started) '
+                'VALUES (?, ?, ?, ?)', (ref, tip, int(stats), time.time()))
+            self.db.executemany(
+                'INSERT INTO chunks (ref, chunk, shas, attempts) '
+                'VALUES (?, ?, ?, 0)',
+                ((ref, i, " ".join(shas)) for i, shas in enumerate(chunks)))
+
+    def get(self, ref):
+        """ Return the tip, stats flag and start time of the import of
+        ref in progress or None.
+        """
+        with self.lock:
+            row = self.db.execute(
+                'SELECT tip, stats, started FROM imports WHERE ref = ?',
+                (ref,)).fetchone()
+        if not row:
+            return None
+        return {'tip': row[0], 'stats': bool(row[1]), 'started': row[2]}
+
+    def get_chunks(self, ref):
+        """ Return the remaining chunks of the import of ref as a dict
+        chunk id -> (shas, attempts).
+        """
+        with self.lock:
+            return dict(
+                (chunk, (shas.split(), attempts))
+                for chunk, shas, attempts in self.db.execute(
+                    'SELECT chunk, shas, attempts FROM chunks '
+                    'WHERE ref = ? ORDER BY chunk', (ref,)))
+
+    def iter_chunks(self, ref, size):
+        """ Yield the remaining chunks of the import of ref as dicts of
+        at most size chunks chunk id -> shas.
+        """
+        last = -1
+        while True:
+            with self.lock:
+                rows = self.db.execute(
+                    'SELECT chunk, shas FROM chunks '
+                    'WHERE ref = ? AND chunk > ? ORDER BY chunk LIMIT ?',
+                    (ref, last, size)).fetchall()
+            if not rows:
+                return
+            last = rows[-1][0]
+            yield dict((chunk, shas.split()) for chunk, shas in rows)
+
+    def count_chunks(self, ref):
+        with self.lock:
+            return self.db.execute(
+                'SELECT COUNT(*) FROM chunks WHERE ref = ?',
+                (ref,)).fetchone()[0]
+
+    def set_done(self, ref, chunk):
+        with self.lock, self.db:
+            self.db.execute(
+                'DELETE FROM chunks WHERE ref = ? AND chunk = ?',
+                (ref, chunk))
+
+    def set_failed(self, ref, chunks):
+        with self.lock, self.db:
+            self.db.executemany(
+                'UPDATE chunks SET attempts = attempts + 1 '
+                'WHERE ref = ? AND chunk = ?',
+                ((ref, chunk) for chunk in chunks))
+
+    def finish(self, ref):
+        with self.lock, self.db:
+            self.db.execute('DELETE FROM chunks WHERE ref = ?', (ref,))
+            self.db.execute('DELETE FROM imports WHERE ref = ?', (ref,))
+
+
+class ChunksTracker(object):
+    """ Mark the chunks of an import as done once all their commits
+    are reported as indexed. Indexed commits are reported by the
+    extraction workers or by the bulk writers threads.
+    """
+    def __init__(self, checkpoints, ref, chunks):
+        self.checkpoints = checkpoints
+        self.ref = ref
+        self.lock = threading.Lock()
+        self.remaining = {}
+        self.chunks = {}
+        for chunk, shas in chunks.items():
+            self.remaining[chunk] = set(shas)
+            for sha in shas:
+                self.chunks[sha] = chunk
+        self.done = []
+        for chunk, shas in list(self.remaining.items()):
+            if not shas:
+                self.set_done(chunk)
+
+    def set_done(self, chunk):
+        del self.remaining[chunk]
+        self.checkpoints.set_done(self.ref, chunk)
+        self.done.append(chunk)
+
+    def indexed(self, shas):
+        with self.lock:
+            for sha in shas:
+                chunk = self.chunks.pop(sha, None)
+                if chunk is None:
+                    continue
+                remaining = self.remaining[chunk]
+                remaining.discard(sha)
+                if not remaining:
+                    self.set_done(chunk)
+
+    def get_failed(self):
+        """ Return the chunks having commits not indexed
+        """
+        with self.lock:
+            return list(self.remaining)
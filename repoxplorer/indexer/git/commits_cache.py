@@ -0,0 +1,187 @@
+# Copyright 2016, Fabien Boucher
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+import os
+import json
+import time
+import zlib
+import sqlite3
+import hashlib
+import logging
+import threading
+
+from pecan import conf
+
+logger = logging.getLogger(__name__)
+
+CACHE_FILE = 'parsed-commits.sqlite'
+# Bump when the parsing of the commits changes to invalidate the cache
+PARSER_VERSION = 1
+# Max amount of variables in a SQLite statement
+QUERY_CHUNK = 500
+# Part of the maximum size freed by an eviction
+EVICTION_RATIO = 0.1
+
+_cache = None
+_cache_pid = None
+_cache_lock = threading.Lock()
+
+
+def get_cache():
+    """ Return the parsed commits cache of the process or None if the
+    cache is not activated. Each process (the extraction workers are
+    forked) opens its own connection to the database.
+    """
+    global _cache, _cache_pid
+    if not getattr(conf, 'indexer_parsed_cache', False):
+        return None
+    with _cache_lock:
+        path = os.path.join(conf.db_cache_path, CACHE_FILE)
+        if (_cache is None or _cache_pid != os.getpid() or
+                _cache.path != path):
+            _cache = ParsedCommitsCache(path)
+            _cache_pid = os.getpid()
+    return _cache
+
+
+def get_version(extra_parsers=None):
+    """ Return the key of the parsed commits produced by the parsers.
+    The metadata of a commit depend on the parsers of its project.
+    """
+    patterns = [getattr(parser, 'pattern', parser)
+                for parser in extra_parsers or []]
+    return hashlib.sha1(json.dumps(
+        [PARSER_VERSION, patterns]).encode()).hexdigest()[:16]
+
+
+def chunks(items, size=QUERY_CHUNK):
+    items = list(items)
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+class ParsedCommitsCache(object):
+    """ On disk cache of the parsed commits (the commits documents
+    without their repos field) keyed by sha and parser version. The
+    least recently used commits are evicted when the cache exceeds
+    max_bytes of compressed documents.
+    """
+    def __init__(self, path=None, max_bytes=None):
+        self.path = path or os.path.join(conf.db_cache_path, CACHE_FILE)
+        self.max_bytes = max_bytes or getattr(
+            conf, 'indexer_parsed_cache_max_bytes', 2 * 1024 ** 3)
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(
+            self.path, timeout=60, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        with self.db:
+            self.db.execute(
+                'CREATE TABLE IF NOT EXISTS commits ('
+                'sha TEXT NOT NULL, version TEXT NOT NULL, '
+                'atime INTEGER NOT NULL, size INTEGER NOT NULL, '
+                'data BLOB NOT NULL, '
+                'PRIMARY KEY (sha, version)) WITHOUT ROWID')
+            self.db.execute(
+                'CREATE INDEX IF NOT EXISTS commits_atime '
+                'ON commits (atime)')
+            self.db.execute(
+                'CREATE TABLE IF NOT EXISTS meta ('
+                'key TEXT PRIMARY KEY, value INTEGER)')
+            self.db.execute(
+                "INSERT OR IGNORE INTO meta (key, value) "
+                "VALUES ('size', 0)")
+
+    def close(self):
+        self.db.close()
+
+    def get_size(self):
+        with self.lock:
+            return self.db.execute(
+                "SELECT value FROM meta WHERE key = 'size'").fetchone()[0]
+
+    def get_many(self, shas, version):
+        """ Return a dict sha -> commit document for the cached shas
+        """
+        ret = {}
+        with self.lock, self.db:
+            for chunk in chunks(shas):
+                rows = self.db.execute(
+                    'SELECT sha, data FROM commits WHERE version = ? '
+                    'AND sha IN (%s)' % ",".join('?' * len(chunk)),
+                    [version] + chunk).fetchall()
+                for sha, data in rows:
+                    ret[sha] = json.loads(zlib.decompress(data))
+            if ret:
+                now = int(time.time())
+                self.db.executemany(
+                    'UPDATE commits SET atime = ? '
+                    'WHERE sha = ? AND version = ?',
+                    ((now, sha, version) for sha in ret))
+        return ret
+
+    def put_many(self, cmts, version):
+        """ Cache the commits documents then evict the least recently
+        used ones if the cache is too large.
+        """
+        now = int(time.time())
+        rows = {}
+        for cmt in cmts:
+            data = zlib.compress(json.dumps(cmt).encode())
+            rows[cmt['sha']] = (cmt['sha'], version, now, len(data), data)
+        if not rows:
+            return
+        rows = list(rows.values())
+        with self.lock, self.db:
+            freed = 0
+            for chunk in chunks(rows):
+                args = [version] + [row[0] for row in chunk]
+                where = 'version = ? AND sha IN (%s)' % (
+                    ",".join('?' * len(chunk)))
+                freed += self.db.execute(
+                    'SELECT COALESCE(SUM(size), 0) FROM commits '
+                    'WHERE %s' % where, args).fetchone()[0]
+                self.db.execute('DELETE FROM commits WHERE %s' % where, args)
+            self.db.executemany(
+                'INSERT INTO commits (sha, version, atime, size, data) '
+                'VALUES (?, ?, ?, ?, ?)', rows)
+            size = self.update_size(sum(row[3] for row in rows) - freed)
+            if size > self.max_bytes:
+                self.evict(size - self.max_bytes * (1 - EVICTION_RATIO))
+
+    def update_size(self, delta):
+        self.db.execute(
+            "UPDATE meta SET value = value + ? WHERE key = 'size'", (delta,))
+        return self.db.execute(
+            "SELECT value FROM meta WHERE key = 'size'").fetchone()[0]
+
+    def evict(self, amount):
+        """ Delete the least recently used commits until amount bytes
+        are freed.
+        """
+        freed = 0
+        evicted = []
+        cursor = self.db.execute(
+            'SELECT sha, version, size FROM commits ORDER BY atime')
+        for sha, version, size in cursor:
+            if freed >= amount:
+                break
+            evicted.append((sha, version))
+            freed += size
+        cursor.close()
+        self.db.executemany(
+            'DELETE FROM commits WHERE sha = ? AND version = ?', evicted)
+        self.update_size(-freed)
+        logger.debug("Evicted %s commits (%s bytes) from the parsed "
+                     "commits cache" % (len(evicted), freed))
@@ -16,9 +16,10 @@ import os
 import re
 import sys
 import copy
+import time
 import shutil
-import pickle
 import logging
+import threading
 import subprocess
 import multiprocessing as mp
 
@@ -27,9 +28,17 @@ from pecan import conf
 from repoxplorer import index
 from repoxplorer.index.tags import Tags
 from repoxplorer.index.commits import Commits
-from repoxplorer.index.tags import PROPERTIES as T_PROPERTIES
-from repoxplorer.index.commits import PROPERTIES as C_PROPERTIES
-from repoxplorer.indexer.git import metadata_re
+from repoxplorer.indexer.git import backends
+from repoxplorer.indexer.git import catalog
+from repoxplorer.indexer.git import checkpoints
+from repoxplorer.indexer.git import commits_cache
+from repoxplorer.indexer.git import ingest
+from repoxplorer.indexer.git import metrics
+from repoxplorer.indexer.git import pools
+from repoxplorer.indexer.git import pipeline
+from repoxplorer.indexer.git import shaset
+from repoxplorer.indexer.git import state_store
+from repoxplorer.indexer.git import trailers
 
 logger = logging.getLogger(__name__)
 
@@ -38,29 +47,34 @@ COMMITTER_RE = re.compile('committer (.*) <(.*)> (.*) (.*)')
 STATSL_RE = re.compile('(.*)\t(.*)\t(.*)')
 FILE_RENAME_RE = re.compile(r"(.*){(.*)\s=>\s(.*)}(.*)")
 
-EL_RESERVED_FIELDS = [
-    '_index',
-    '_uid',
-    '_type',
-    '_id',
-    '_source',
-    '_size',
-    '_all',
-    '_field_names',
-    '_timestamp',
-    '_ttl',
-    '_parent',
-    '_routing',
-    '_meta',
-]
-
-RESERVED_METADATA_KEYS = (
-    list(C_PROPERTIES.keys()) +
-    list(T_PROPERTIES.keys()) +
-    EL_RESERVED_FIELDS
-)
-
-SEEN_REFS_CACHED = 'seen-refs.cached'
+# Amount of commits whose line statistics are computed at once by
+# RepoIndexer.backfill_stats
+BACKFILL_CHUNK = 5000
+# Amount of parsed commits written at once to the parsed commits cache
+PARSED_CACHE_CHUNK = 500
+# Amount of commits extracted by a worker job and checkpointed at once
+IMPORT_CHUNK = 1000
+# Amount of checkpointed chunks of commits loaded and indexed at once
+IMPORT_WINDOW = 100
+
+# Pool of extraction workers shared by all the refs of an indexer run
+_workers_pool = None
+_workers_pool_lock = threading.Lock()
+# Connection to the commits index of an extraction worker
+_worker_commits = None
+
+# Fields computed by parse_commit but not yet supported by the index
+UNSUPPORTED_FIELDS = (
+    "author_date_tz", "committer_date_tz",
+    "committer_email_domain", "files_stats",
+    "signed", "commit_msg_full")
+
+# Format of a commit record when the history is streamed out of git log.
+# Each record starts with a NUL char and the commit message is terminated
+# by a NUL char, the numstat lines of the commit follow.
+STREAM_FORMAT = '%x00' + '%n'.join(
+    ('%H', '%P', '%an', '%ae', '%at', '%cn', '%ce', '%ct', '%B')) + '%x00'
+STREAM_READ_SIZE = 64 * 1024
 
 
 def run(cmd, path):
@@ -75,43 +89,114 @@ def run(cmd, path):
     return out.decode(errors='replace')
 
 
-def parse_commit_line(line, re, key=None):
-    m = re.match(line)
-    if m:
-        if key:
-            value = m.groups()[0]
-            return key, value.strip().replace('#', '')
-        key = m.groups()[0]
-        if key not in RESERVED_METADATA_KEYS:
-            value = m.groups()[1]
-            # Remove space before and after the string and remove
-            # the \# that will cause trouble when metadata are queried
-            # via the URL arguments
-            return key.strip(), value.strip().replace('#', '')
+def parse_commit_msg(msg, extra_parsers=None):
+    """ Return the subject and the metadata of a commit message
+    """
+    return trailers.get_extractor(extra_parsers).extract(msg)
 
 
-def parse_commit_msg(msg, extra_parsers=None):
-    metadatas = []
-    lines = msg.split('\n')
-    subject = lines[0]
-    for line in lines[1:]:
-        for key, parser in metadata_re.METADATA_REs.items():
-            metadata = parse_commit_line(line, parser, key=key)
-            if metadata:
-                metadatas.append(metadata)
-        if not extra_parsers:
-            continue
-        for parser in extra_parsers:
-            metadata = parse_commit_line(line, parser)
-            if metadata:
-                metadatas.append(metadata)
-    return subject, metadatas
+def get_extract_mode():
+    """ Return the way commits are read from the repositories: 'show'
+    (buffered git show), 'stream' (git log stream), 'batch' (persistent
+    git cat-file and diff-tree processes) or 'dulwich' (in process).
+    """
+    return getattr(conf, 'indexer_extract_mode', 'stream')
+
+
+def get_all_shas(path, ref='FETCH_HEAD', exclude=None, since=None):
+    """ Return the shas reachable from ref. If exclude is
+    set then shas reachable from exclude are not returned. If since
+    is set only the commits committed since that epoch are returned.
+    """
+    return list(iter_all_shas(path, ref, exclude, since))
+
+
+def iter_all_shas(path, ref='FETCH_HEAD', exclude=None, since=None):
+    """ Yield the shas of get_all_shas as they are read from git
+    """
+    if get_extract_mode() == 'dulwich' and not since:
+        # Walk the history in process, the other modes run rev-list
+        return backends.get_reader(
+            get_extract_mode(), path).iter_all_shas(ref, exclude)
+    cmd = ['git', 'rev-list', ref]
+    if exclude:
+        cmd.append('^%s' % exclude)
+    if since:
+        cmd.append('--max-age=%d' % since)
+    return backends.iter_lines(cmd, path)
+
+
+def get_shas_set(path, ref='FETCH_HEAD', exclude=None, since=None):
+    """ Return the shas of get_all_shas as a compact shaset.ShaSet
+    """
+    return shaset.ShaSet.from_iterable(
+        iter_all_shas(path, ref, exclude, since))
+
+
+def get_repo_path(name, uri):
+    """ Return the path of the bare repository of name in git_store.
+    """
+    return os.path.join(conf.git_store, name, uri.replace('/', '_'))
+
+
+def get_branch_ref(branch):
+    """ Return the local ref where a fetched branch is stored.
+    """
+    if branch.startswith('refs/'):
+        return branch
+    return 'refs/heads/%s' % branch
+
+
+def get_tip(path, ref='FETCH_HEAD'):
+    return run(['git', 'rev-parse', '%s^{commit}' % ref], path).strip()
+
+
+def is_ancestor(path, ancestor, sha):
+    """ Return True if ancestor is reachable from sha. False is
+    returned when ancestor is not or no longer known in the repository.
+    """
+    return subprocess.call(
+        ['git', 'merge-base', '--is-ancestor', ancestor, sha],
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+        cwd=path) == 0
+
+
+def has_refs(path):
+    return bool(run(['git', 'for-each-ref', '--count=1'], path).strip())
+
+
+def get_packs_size(path):
+    """ Return the size in bytes of the loose and packed objects of the
+    repository.
+    """
+    sizes = dict(
+        line.split(': ', 1) for line in
+        run(['git', 'count-objects', '-v'], path).splitlines()
+        if ': ' in line)
+    return (int(sizes.get('size', 0)) + int(sizes.get('size-pack', 0))) * 1024
+
 
+def get_shallow_commits(path):
+    """ Return the boundary commits of a shallow repository. Their
+    parents are not fetched so they look like root commits.
+    """
+    shallow = os.path.join(path, 'shallow')
+    if not os.path.isfile(shallow):
+        return set()
+    with open(shallow) as fd:
+        return set(fd.read().split())
 
-def get_all_shas(path):
-    out = run(['git', 'log', '--format=format:%H', 'FETCH_HEAD'], path)
-    shas = out.splitlines()
-    return shas
+
+def get_known_commits(path, shas):
+    """ Return the shas of the commits of shas found in the
+    repository.
+    """
+    out = subprocess.run(
+        ['git', 'cat-file', '--batch-check=%(objectname) %(objecttype)'],
+        input=("\n".join(shas) + "\n").encode(), stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL, cwd=path, check=True).stdout
+    return [line.split()[0] for line in out.decode().splitlines()
+            if line.endswith(' commit')]
 
 
 def get_commits_desc(path, shas):
@@ -126,6 +211,143 @@ def get_commits_desc(path, shas):
     return out.splitlines()
 
 
+def get_commits_stream(path, shas, stats=True):
+    """ Stream the description of the given commits from git log.
+
+    The shas are passed through stdin and the output is consumed
+    from the pipe by blocks so memory usage does not depend of the
+    amount of commits. This yields (header, stats) tuples of bytes
+    for each commit record. The stats are empty when stats is False.
+    """
+    if not shas:
+        return
+    cmd = ['git', 'log', '--no-walk=unsorted', '--stdin']
+    if stats:
+        cmd.append('--numstat')
+    cmd.append('--format=%s' % STREAM_FORMAT)
+    process = subprocess.Popen(cmd,
+                               stdin=subprocess.PIPE,
+                               stdout=subprocess.PIPE,
+                               stderr=subprocess.DEVNULL,
+                               cwd=path)
+    try:
+        # git log reads all revisions from stdin before starting
+        # to output so this does not block.
+        process.stdin.write(("\n".join(shas) + "\n").encode())
+        process.stdin.close()
+        for record in iter_stream_records(process.stdout):
+            yield record
+        process.wait()
+        if process.returncode != 0:
+            raise Exception('%s exited with code %s' % (
+                cmd, process.returncode))
+    finally:
+        if process.poll() is None:
+            process.kill()
+            process.wait()
+        process.stdout.close()
+
+
+def iter_stream_records(stream, read_size=STREAM_READ_SIZE):
+    """ Split a NUL delimited git log stream into (header, stats)
+    tuples. The stream is read by blocks of read_size bytes.
+    """
+    pending = []
+    header = None
+    started = False
+    while True:
+        data = stream.read(read_size)
+        if not data:
+            break
+        parts = data.split(b'\0')
+        for part in parts[:-1]:
+            pending.append(part)
+            token = b''.join(pending)
+            pending = []
+            if not started:
+                # Discard what is before the first record
+                started = True
+            elif header is None:
+                header = token
+            else:
+                yield header, token
+                header = None
+        pending.append(parts[-1])
+    if header is not None:
+        yield header, b''.join(pending)
+
+
+def parse_numstat_line(cmt, line):
+    m = STATSL_RE.match(line)
+    if m.groups()[0] != '-':
+        # '-' means binary file - so skip it
+        l_added = int(m.groups()[0])
+        l_removed = int(m.groups()[1])
+        file = m.groups()[2]
+        file = FILE_RENAME_RE.sub(r'\1\3\4', file)
+        cmt['files_list'].add(file)
+        pe = file.split('/')
+        for pei in range(1, len(pe)+1):
+            cmt['files_list'].add('/'.join(pe[0:pei]))
+        cmt['files_stats'][file] = {
+            'lines_added': l_added,
+            'lines_removed': l_removed}
+        cmt['line_modifieds'] += l_added + l_removed
+
+
+def parse_stream_record(header, stats, extra_parsers=None):
+    """ Parse a commit record as produced by get_commits_stream.
+    """
+    fields = header.decode(errors='replace').split('\n', 8)
+    cmt = {}
+    cmt['sha'] = fields[0]
+    cmt['merge_commit'] = len(fields[1].split()) > 1
+    for i, field in ((2, 'author'), (5, 'committer')):
+        cmt['%s_name' % field] = fields[i]
+        cmt['%s_email' % field] = fields[i + 1]
+        cmt['%s_email_domain' % field] = fields[i + 1].split('@')[-1]
+        cmt['%s_date' % field] = int(fields[i + 2])
+    cmt['ttl'] = cmt['committer_date'] - cmt['author_date']
+    # Avoid weird negative TTL (personal computers may not be sync on NTP)
+    cmt['ttl'] = cmt['ttl'] if cmt['ttl'] >= 0 else 0
+    cmt['line_modifieds'] = 0
+    cmt['files_stats'] = {}
+    cmt['files_list'] = set()
+    cmt['commit_msg_full'] = "\n".join(
+        [line.strip() for line in fields[8].rstrip('\n').split('\n')])
+    subject, metadatas = parse_commit_msg(
+        cmt['commit_msg_full'], extra_parsers)
+    cmt['commit_msg'] = subject
+    for metadata in metadatas:
+        if metadata[0] not in cmt:
+            cmt[metadata[0]] = []
+        cmt[metadata[0]].append(metadata[1])
+    if not cmt['merge_commit']:
+        for line in stats.decode(errors='replace').splitlines():
+            if line:
+                parse_numstat_line(cmt, line)
+    cmt['files_list'] = sorted(cmt['files_list'])
+    return cmt
+
+
+def process_commits_stream(records, ref_ids, extra_parsers=None):
+    """ Generator of commit documents ready to be indexed from
+    (header, stats) records.
+    """
+    for header, stats in records:
+        try:
+            cmt = parse_stream_record(header, stats, extra_parsers)
+        except Exception as e:
+            logger.warning("A commit failed to be parsed. Skip it !")
+            logger.debug("Record of the failed commit: %s" % header[:1000])
+            logger.exception("Issue was: %s" % e)
+            continue
+        cmt['repos'] = ref_ids
+        for f in UNSUPPORTED_FIELDS:
+            cmt.pop(f, None)
+        yield cmt
+
+
 def parse_commit(input, offset, extra_parsers=None):
     cmt = {}
     cmt['sha'] = input[offset].split()[-1]
@@ -221,21 +443,7 @@ def parse_commit(input, offset, extra_parsers=None):
             break
         if (len(input[offset + i]) and input[offset + i][0] != ' ' and not
                 cmt['merge_commit']):
-            m = STATSL_RE.match(input[offset + i])
-            if m.groups()[0] != '-':
-                # '-' means binary file - so skip it
-                l_added = int(m.groups()[0])
-                l_removed = int(m.groups()[1])
-                file = m.groups()[2]
-                file = FILE_RENAME_RE.sub(r'\1\3\4', file)
-                cmt['files_list'].add(file)
-                pe = file.split('/')
-                for pei in range(1, len(pe)+1):
-                    cmt['files_list'].add('/'.join(pe[0:pei]))
-                cmt['files_stats'][file] = {
-                    'lines_added': l_added,
-                    'lines_removed': l_removed}
-                cmt['line_modifieds'] += l_added + l_removed
+            parse_numstat_line(cmt, input[offset + i])
         i += 1
     cmt['files_list'] = sorted(list(cmt['files_list']))
     return cmt, offset + i
@@ -253,9 +461,7 @@ def process_commits_desc_output(input, ref_ids, extra_parsers=None):
             cmt, offset = parse_commit(input, offset, extra_parsers)
             cmt['repos'] = ref_ids
             # Remove atm un-supported fields
-            for f in ("author_date_tz", "committer_date_tz",
-                      "committer_email_domain", "files_stats",
-                      "signed", "commit_msg_full"):
+            for f in UNSUPPORTED_FIELDS:
                 del cmt[f]
             ret.append(cmt)
         except Exception as e:
@@ -269,58 +475,266 @@ def process_commits_desc_output(input, ref_ids, extra_parsers=None):
     return ret
 
 
-def process_commits(options):
-    path, ref_ids, shas = options
+def get_workers_amount(workers):
+    if workers == 0:
+        # Default value (auto)
+        return mp.cpu_count() - 1 or 1
+    return workers
+
+
+def init_worker():
+    """ Connect an extraction worker to the index. This is done once
+    when the worker process starts.
+    """
+    global _worker_commits
+    try:
+        _worker_commits = Commits(index.Connector())
+        # In ingest mode the index is refreshed by the main process
+        _worker_commits.auto_refresh = not ingest.is_enabled()
+    except Exception:
+        # The connection is retried at the first job
+        logger.exception("Worker %s unable to connect to the index" % (
+            mp.current_process()))
+        _worker_commits = None
+
+
+def get_worker_commits():
+    if _worker_commits is None:
+        init_worker()
+        if _worker_commits is None:
+            raise Exception("Unable to connect to the index")
+    return _worker_commits
+
+
+def start_workers_pool(workers=0):
+    """ Start the extraction workers pool if not yet started and
+    return it. The pool is kept until stop_workers_pool is called.
+    It should be started before the indexer starts threads as the
+    workers are forked.
+    """
+    global _workers_pool
+    with _workers_pool_lock:
+        if _workers_pool is None:
+            workers = get_workers_amount(workers)
+            logger.info("Start a pool of %s extraction workers" % workers)
+            _workers_pool = mp.Pool(workers, initializer=init_worker)
+        return _workers_pool
+
+
+def stop_workers_pool():
+    global _workers_pool
+    with _workers_pool_lock:
+        if _workers_pool is not None:
+            _workers_pool.terminate()
+            _workers_pool.join()
+            _workers_pool = None
+
+
+def read_commits_records(mode, path, shas):
+    """ Yield the (header, stats) records of shas read by the
+    persistent reader of the repository.
+    """
+    reader = backends.get_reader(mode, path)
+    try:
+        for record in reader.iter_records(shas):
+            yield record
+    except BaseException:
+        # The reader state is unknown
+        backends.drop_reader(reader)
+        raise
+
+
+def mark_stats_pending(cmts):
+    """ Remove the empty line statistics of commits extracted without
+    them and flag the commits for RepoIndexer.backfill_stats.
+    """
+    for cmt in cmts:
+        if not cmt['merge_commit']:
+            # Merge commits do not have line statistics
+            del cmt['line_modifieds']
+            del cmt['files_list']
+            cmt['stats_pending'] = True
+        yield cmt
+
+
+def iter_commits(path, ref_ids, shas, extra_parsers=None, stats=True):
+    """ Return an iterable over the commits documents of shas. If
+    stats is False the line statistics are not computed and the
+    commits are flagged with stats_pending.
+    """
+    cache = commits_cache.get_cache()
+    if cache:
+        return iter_cached_commits(
+            cache, path, ref_ids, shas, extra_parsers, stats)
+    return read_commits(path, ref_ids, shas, extra_parsers, stats)
+
+
+def iter_cached_commits(cache, path, ref_ids, shas, extra_parsers=None,
+                        stats=True):
+    """ Yield the commits of shas found in the parsed commits cache
+    then read the others from the repository and add them to the
+    cache. The cached commits have their line statistics even if
+    stats is False.
+    """
+    version = commits_cache.get_version(extra_parsers)
+    cached = cache.get_many(shas, version)
+    for cmt in cached.values():
+        cmt['repos'] = ref_ids
+        yield cmt
+    missing = [sha for sha in shas if sha not in cached]
+    if not missing:
+        return
+    to_cache = []
+    for cmt in read_commits(path, ref_ids, missing, extra_parsers, stats):
+        if stats:
+            doc = dict(cmt)
+            del doc['repos']
+            to_cache.append(doc)
+            if len(to_cache) >= PARSED_CACHE_CHUNK:
+                cache.put_many(to_cache, version)
+                to_cache = []
+        yield cmt
+    cache.put_many(to_cache, version)
+
+
+def read_commits(path, ref_ids, shas, extra_parsers=None, stats=True):
+    """ Return an iterable over the commits documents of shas read
+    from the repository.
+    """
+    if not stats:
+        # Computing the diffs is most of the extraction cost so this
+        # is done with the cheap git log stream whatever the mode.
+        records = get_commits_stream(path, shas, stats=False)
+        return mark_stats_pending(
+            process_commits_stream(records, ref_ids, extra_parsers))
+    mode = get_extract_mode()
+    if mode == 'show':
+        buf = get_commits_desc(path, shas)
+        return process_commits_desc_output(buf, ref_ids, extra_parsers)
+    if mode == 'stream':
+        records = get_commits_stream(path, shas)
+    else:
+        records = read_commits_records(mode, path, shas)
+    return process_commits_stream(records, ref_ids, extra_parsers)
+
+
+def write_commits(c, cmts, bulks=None):
+    """ Create the commits with a single bulk request. Return the shas
+    of the commits confirmed written by the index. The (latency, docs,
+    rejected) of the request is appended to bulks to be recorded by
+    the main process (see metrics.record_bulks).
+    """
+    start = time.time()
+    created, rejected, errors = [], [], []
+    try:
+        created, rejected, errors = c.bulk_create(cmts)
+    finally:
+        if bulks is not None:
+            bulks.append((time.time() - start, len(created), len(rejected)))
+    if rejected or errors:
+        logger.warning("Worker %s: %s commits rejected and %s failed to "
+                       "be indexed" % (mp.current_process(), len(rejected),
+                                       len(errors)))
+    return created
+
+
+def process_commits(options, bulks=None):
+    """ Extract and index commits. Return the shas of the commits
+    confirmed written by the index. The bulk requests are appended to
+    bulks (see write_commits).
+    """
+    path, ref_ids, shas, extra_parsers, stats = options
     if not isinstance(ref_ids, list):
         ref_ids = [ref_ids]
-    c = Commits(index.Connector())
+    c = get_worker_commits()
     logger.info("Worker %s started to extract and index %s commits" % (
         mp.current_process(), len(shas)))
-    buf = get_commits_desc(path, shas)
-    c.add_commits(process_commits_desc_output(buf, ref_ids))
-
-
-def delete_commits(commits, name, to_delete, ref_id):
-    res = commits.get_commits_by_id(list(to_delete))
-    docs = [c['_source'] for
-            c in res['docs'] if c['found'] is True]
-    # If it remains the meta_ref + ref (to delete) we can process
-    # with the deletion
-    to_delete = [
-        c['sha'] for c in docs if (
-            len(c['repos']) == 1 or
-            (len(c['repos']) == 2 and
-             [x for x in c['repos'] if x.startswith('meta_ref: ')]
-             )
-        )
-    ]
-    to_delete_update = [
-        c['sha'] for c in docs if (
-            (len(c['repos']) > 1 and not
-             [x for x in c['repos'] if x.startswith('meta_ref: ')]
-             ) or
-            (len(c['repos']) > 2 and
-             [x for x in c['repos'] if x.startswith('meta_ref: ')]
-             )
-         )
-    ]
-
-    if to_delete:
-        logger.info("%s: %s commits will be deleted ..." % (
-            name, len(to_delete)))
-        commits.del_commits(to_delete)
-
-    if to_delete_update:
+    start = time.time()
+    size = index.get_bulk_params()['chunk_size']
+    indexed = []
+    cmts = []
+    for cmt in iter_commits(path, ref_ids, shas, extra_parsers, stats):
+        cmts.append(cmt)
+        if len(cmts) >= size:
+            indexed.extend(write_commits(c, cmts, bulks))
+            cmts = []
+    if cmts:
+        indexed.extend(write_commits(c, cmts, bulks))
+    c.refresh()
+    elapsed = time.time() - start
+    logger.info("Worker %s indexed %s commits in %.1fs (%.0f commits/s)" % (
+        mp.current_process(), len(indexed), elapsed,
+        len(indexed) / elapsed if elapsed else 0))
+    return indexed
+
+
+def process_chunk(options):
+    """ process_commits for the checkpointed imports. Return the shas
+    of the commits indexed and the bulk requests sent. A failure is
+    logged and reported as no commit indexed, the chunk is retried.
+    """
+    bulks = []
+    try:
+        return process_commits(options, bulks), bulks
+    except Exception:
+        logger.exception("Worker %s unable to index commits" % (
+            mp.current_process()))
+        return [], bulks
+
+
+def extract_chunk(options):
+    """ extract_commits for the checkpointed imports (see process_chunk)
+    """
+    try:
+        return extract_commits(options)
+    except Exception:
+        logger.exception("Worker %s unable to extract commits" % (
+            mp.current_process()))
+        return []
+
+
+def extract_commits(options):
+    """ Extract commits. Return the commits documents to be indexed
+    by the bulk writers of the main process.
+    """
+    path, ref_ids, shas, extra_parsers, stats = options
+    logger.info("Worker %s started to extract %s commits" % (
+        mp.current_process(), len(shas)))
+    return list(iter_commits(path, ref_ids, shas, extra_parsers, stats))
+
+
+def extract_stats(options):
+    """ Compute the line statistics of commits. Return the fields
+    to set on the commits documents.
+    """
+    path, shas = options
+    logger.info("Worker %s started to compute the stats of %s commits" % (
+        mp.current_process(), len(shas)))
+    return [
+        {'sha': cmt['sha'],
+         'line_modifieds': cmt['line_modifieds'],
+         'files_list': cmt['files_list']}
+        for cmt in iter_commits(path, [], shas)]
+
+
+def delete_commits(commits, name, to_delete, ref_id, catalog=None):
+    """ Remove ref_id from the repos field of the commits of to_delete.
+    The update is done server side and the commits no longer
+    belonging to a ref are deleted.
+    """
+    res = commits.remove_ref(to_delete, ref_id)
+    deleted = [sha for sha, r in res.items() if r == 'deleted']
+    updated = [sha for sha, r in res.items() if r == 'updated']
+    if deleted:
+        logger.info("%s: %s commits have been deleted" % (
+            name, len(deleted)))
+    if updated:
         logger.info("%s: %s commits belonging to other repos "
-                    "will be updated ..." % (
-                        name, len(to_delete_update)))
-        res = commits.get_commits_by_id(to_delete_update)
-        if res:
-            original_commits = [c['_source'] for
-                                c in res['docs']]
-            for c in original_commits:
-                c['repos'].remove(ref_id)
-            commits.update_commits(original_commits)
+                    "have been updated" % (name, len(updated)))
+    metrics.incr('commits_deleted', len(deleted))
+    if catalog:
+        catalog.remove_ref(to_delete, ref_id)
+        catalog.remove_shas(deleted)
 
 
 class RefsCleaner():
@@ -333,26 +747,26 @@ class RefsCleaner():
         self.c = Commits(self.con)
         self.t = Tags(index.Connector(
             index=self.con.index, index_suffix='tags'))
-        self.seen_refs_path = os.path.join(
-            conf.db_cache_path, SEEN_REFS_CACHED)
+        self.catalog = catalog.get_catalog()
+        self.state = state_store.get_store()
         self.current_base_ids = set()
 
-    def find_refs_to_clean(self):
+    def find_refs_to_clean(self, indexed=False):
+        """ Return the refs seen by the indexer and no longer in the
+        projects definition. With indexed, the refs of the commits
+        index are also checked, like the ones indexed by the other
+        indexers of a fleet (see leases.py).
+        """
         projects = self.projects.get_projects(source=['refs'])
         refs_ids = set()
         for project in projects.values():
             for ref in project['refs']:
                 self.current_base_ids.add(ref['shortrid'])
                 refs_ids.add(ref['fullrid'])
-        if not os.path.isfile(self.seen_refs_path):
-            self.data = set()
-        else:
-            try:
-                self.data = pickle.load(open(self.seen_refs_path, 'rb'))
-            except Exception:
-                # Protect against corrupted file
-                self.data = set()
-        refs_to_clean = self.data - refs_ids
+        seen_refs = self.state.get_seen_refs()
+        if indexed:
+            seen_refs.update(self.c.iter_refs())
+        refs_to_clean = seen_refs - refs_ids
         if len(refs_to_clean):
             logger.info("Found %s refs to clean." % len(refs_to_clean))
         return refs_to_clean
@@ -367,59 +781,139 @@ class RefsCleaner():
             self.t.del_tags(ids)
 
     def clean_ref_cmts(self, ref):
+        if not self.catalog:
+            # Let the database find and update the ref's commits
+            res = self.c.remove_ref_by_query(ref)
+            logger.info("Ref %s no longer referenced. Deleted %s cmts "
+                        "and updated %s cmts." % (
+                            ref, res['deleted'], res['updated']))
+            return
         # Find ref's Commits
-        ids = [c['_id'] for c in
-               self.c.get_commits(repos=[ref], scan=True)]
+        ids = shaset.ShaSet.from_iterable(self.catalog.iter_ref_shas(ref))
         if not ids:
-            self.remove_from_seen_refs(ref)
             return
         logger.info("Ref %s no longer referenced. Cleaning %s cmts." %
                     (ref, len(ids)))
         # Do it by bulk of 10000 to not hurt memory
-        bulk = 10000
-        i = 0
-        while True:
-            _ids = ids[i:i+bulk]
-            if not _ids:
-                break
-            else:
-                delete_commits(self.c, ref, _ids, ref)
-                i += bulk
+        for _ids in shaset.chunks(ids, 10000):
+            delete_commits(self.c, ref, _ids, ref, self.catalog)
 
     def clean(self, refs):
         base_ids = set()
         for ref in refs:
-            self.clean_ref_cmts(ref)
-            self.remove_from_seen_refs(ref)
+            start = time.time()
+            try:
+                self.clean_ref_cmts(ref)
+            except Exception:
+                # The ref is kept in the state to be cleaned by the
+                # next run
+                logger.exception("Unable to clean ref %s" % ref)
+                continue
+            self.remove_from_checkpoints(ref)
+            self.remove_from_state(ref)
+            metrics.observe('clean_seconds', time.time() - start)
+            metrics.incr('refs_cleaned')
             base_id = ref.replace(":%s" % ref.split(':')[-1], "")
             if base_id not in self.current_base_ids:
                 base_ids.add(base_id)
         for base_id in base_ids:
             self.clean_tags(base_id)
 
-    def remove_from_seen_refs(self, ref_id):
-        # Remove from the struct to be dumped
-        self.data.remove(ref_id)
-        pickle.dump(self.data, open(self.seen_refs_path, 'wb'))
+    def remove_from_state(self, ref_id):
+        # A ref added back later must be indexed from scratch and from
+        # its index-since date as the commits older than the horizon
+        # are removed with the ref's commits
+        self.state.remove_ref(ref_id)
+
+    def remove_from_checkpoints(self, ref_id):
+        checkpoints.get_checkpoints().finish(ref_id)
+
+
+def is_blobless_fetch():
+    return getattr(conf, 'indexer_blobless_fetch', False)
+
+
+def is_two_phase(amount):
+    """ Return True if amount commits to create must be indexed
+    without their line statistics first (see RepoIndexer.backfill_stats).
+    """
+    min_commits = getattr(conf, 'indexer_two_phase_min_commits', 0)
+    return 0 < min_commits <= amount
+
+
+def get_horizon_backfill_days():
+    return getattr(conf, 'indexer_horizon_backfill_days', 0)
+
+
+def get_import_retries():
+    return getattr(conf, 'indexer_import_retries', 3)
+
+
+def get_moved_refs(indexers):
+    """ Return the ids of the refs of the indexers (RepoIndexer with
+    their branch set on a snapshot of the upstream refs) that need to
+    be indexed. Their upstream tips are compared at once with their
+    indexed tips, the tips of their last complete imports. A ref
+    without an indexed tip is always indexed: its tip being in the
+    index does not tell whether newer commits of a rewritten history
+    are still indexed for the ref, the import compares the history
+    with the index then records the tip.
+
+    The indexed tips of the refs found up to date are checked with a
+    single request to the index. The indexed tip of a ref missing from
+    the index for the ref (wiped or restored from an older snapshot) is
+    dropped and the ref is indexed again.
+    """
+    if not indexers:
+        return set()
+    tips = indexers[0].state.get_indexed_tips(
+        [r.ref_id for r in indexers])
+    moved = set()
+    up_to_date = []
+    for r in indexers:
+        if r.checkpoints.get(r.ref_id):
+            # The import of the ref did not complete
+            moved.add(r.ref_id)
+        elif tips.get(r.ref_id) != r.get_branch_tip():
+            moved.add(r.ref_id)
+        elif tips[r.ref_id] not in get_shallow_commits(r.local):
+            # A boundary commit of a shallow history is not indexed
+            up_to_date.append(r)
+    if up_to_date:
+        repos = indexers[0].c.get_commits_repos(
+            set(tips[r.ref_id] for r in up_to_date))
+        for r in up_to_date:
+            if r.ref_id not in repos.get(tips[r.ref_id], []):
+                logger.info("%s: indexed tip %s not found in the index" % (
+                    r.ref_id, tips[r.ref_id]))
+                r.state.set_indexed_tip(r.ref_id, None)
+                moved.add(r.ref_id)
+    return moved
 
 
 class RepoIndexer():
     def __init__(self, name, uri, parsers=None,
-                 con=None, meta_ref=None):
+                 con=None, meta_ref=None, index_since=None, pool=None):
         if not con:
             self.con = index.Connector()
         else:
             self.con = con
         self.c = Commits(self.con)
+        self.c.auto_refresh = not ingest.is_enabled()
         self.t = Tags(index.Connector(
             index=self.con.index, index_suffix='tags'))
+        self.catalog = catalog.get_catalog()
+        self.checkpoints = checkpoints.get_checkpoints()
+        self.state = state_store.get_store()
         if not os.path.isdir(conf.git_store):
             os.makedirs(conf.git_store)
         self.name = name
         self.uri = uri
         self.base_id = '%s:%s' % (self.uri, self.name)
-        self.seen_refs_path = os.path.join(
-            conf.db_cache_path, SEEN_REFS_CACHED)
+        # Epoch of the oldest commits to index (index-since)
+        self.index_since = index_since
+        # Objects pool shared with the forks of the repository
+        self.pool = pool
         if meta_ref:
             self.meta_ref = 'meta_ref: %s' % meta_ref
         else:
@@ -430,9 +924,7 @@ class RepoIndexer():
         else:
             self.parsers = parsers
         self.parsers_compiled = False
-        self.local = os.path.join(conf.git_store,
-                                  self.name,
-                                  self.uri.replace('/', '_'))
+        self.local = get_repo_path(self.name, self.uri)
         if not os.path.isdir(self.local):
             os.makedirs(self.local)
 
@@ -465,21 +957,51 @@ class RepoIndexer():
         # Keep a cache a each ref that have been indexed
         # This is use later to discover seen refs no longer in projects.yaml
         # In that case a removal from the backend will be performed
-        logger.debug("Save ref %s into seen_refs file" % self.ref_id)
-        if not os.path.isfile(self.seen_refs_path):
-            data = set()
-        else:
-            try:
-                data = pickle.load(open(self.seen_refs_path, 'rb'))
-            except Exception:
-                # Protect against corrupted file
-                data = set()
-        data.add(self.ref_id)
-        pickle.dump(data, open(self.seen_refs_path, 'wb'))
+        logger.debug("Save ref %s into seen refs" % self.ref_id)
+        self.state.add_seen_ref(self.ref_id)
+
+    def get_indexed_tip(self):
+        return self.state.get_indexed_tip(self.ref_id)
+
+    def save_indexed_tip(self):
+        # Keep the tip of the last indexed history of the ref. The
+        # next run only needs to consider the commits added on top of it.
+        logger.debug("Save indexed tip %s of ref %s" % (
+            self.tip, self.ref_id))
+        self.state.set_indexed_tip(self.ref_id, self.tip)
+
+    def is_stats_pending(self):
+        return self.state.is_stats_pending(self.ref_id)
+
+    def set_stats_pending(self, pending):
+        # Keep the refs having commits indexed without line statistics
+        # so the next runs compute them even if the ref did not move.
+        self.state.set_stats_pending(self.ref_id, pending)
+
+    def get_horizon(self):
+        """ Return the epoch of the oldest commits of the ref to index,
+        None to index the full history. The horizon starts at the
+        index-since date and is moved backwards by extend_horizon. 0
+        means the horizon reached the first commit.
+        """
+        if not self.index_since:
+            return None
+        horizon = self.state.get_horizon(self.ref_id)
+        if horizon is not None and horizon < self.index_since:
+            return horizon
+        return self.index_since
+
+    def save_horizon(self, horizon):
+        logger.debug("Save horizon %s of ref %s" % (horizon, self.ref_id))
+        self.state.set_horizon(self.ref_id, horizon)
 
     def set_branch(self, branch):
         self.branch = branch
         self.ref_id = '%s:%s:%s' % (self.uri, self.name, self.branch)
+        self.tip = None
+        self.incremental = False
+        self.horizon = self.get_horizon()
+        self.shallow = set()
         self.save_seen_ref_in_cache()
 
     def git_init(self):
@@ -490,14 +1012,61 @@ class RepoIndexer():
         remote_names = [line.split()[0] for line in remotes.splitlines()]
         if "origin" not in remote_names:
             run(["git", "remote", "add", "origin", self.uri], self.local)
+        if self.pool:
+            # Before the first fetch so only the objects missing from
+            # the pool are fetched
+            pools.join_pool(self.local, self.pool)
+        if is_blobless_fetch() and self.credentials_helper_path:
+            # The missing file contents are fetched by the git commands
+            # computing the line statistics
+            run(["git", "config", "credential.helper",
+                 self.credentials_helper_path], self.local)
 
     def git_fetch_branch(self):
-        logger.debug("Fetch %s %s:%s" % (self.name, self.uri,
-                                         self.branch))
-        run(["git", "-c",
-             "credential.helper=%s" % self.credentials_helper_path,
-             "fetch", "-nk", "origin", "+%s:%s" % (self.branch, self.branch)],
-            self.local)
+        self.git_fetch_branches([self.branch])
+
+    def git_fetch_branches(self, branches, tags=False, since=None):
+        """ Fetch the branches, and the tags if requested, with a
+        single fetch command. If since is set only the commits
+        committed since that epoch are fetched (shallow fetch).
+        """
+        logger.debug("Fetch %s %s:%s%s" % (
+            self.name, self.uri, ",".join(branches),
+            " and tags" if tags else ""))
+        refspecs = []
+        for branch in branches:
+            refspec = "+%s:%s" % (branch, get_branch_ref(branch))
+            if refspec not in refspecs:
+                refspecs.append(refspec)
+        if tags:
+            refspecs.append("+refs/tags/*:refs/tags/*")
+        options = []
+        if is_blobless_fetch():
+            # Ignored by the servers not supporting partial clones
+            options.append("--filter=blob:none")
+        shallow = bool(get_shallow_commits(self.local))
+        shallow_options = []
+        if since and (shallow or not has_refs(self.local)):
+            # A complete local history is not truncated, a shallow one
+            # is deepened (or shortened) up to since
+            shallow_options.append("--shallow-since=%d" % since)
+        elif not since and shallow:
+            shallow_options.append("--unshallow")
+        cmd = ["git", "-c",
+               "credential.helper=%s" % self.credentials_helper_path,
+               "fetch", "-nk"] + options
+        try:
+            run(cmd + shallow_options + ["origin"] + refspecs, self.local)
+        except Exception:
+            if not (since and shallow_options):
+                raise
+            # The fetch is refused when no commit has been committed
+            # since the horizon, the commits of the branches tips are
+            # still needed to know they are up to date.
+            logger.debug("%s: no commits since %s, fetch the tips" % (
+                self.base_id, since))
+            shallow_options = [] if shallow else ["--depth=1"]
+            run(cmd + shallow_options + ["origin"] + refspecs, self.local)
 
     def get_refs(self):
         refs = run([
@@ -513,66 +1082,304 @@ class RepoIndexer():
     def get_tags(self):
         self.tags = [x for x in self.refs if x[1].startswith('refs/tags/')]
 
+    def is_indexed_tip_valid(self, indexed_tip):
+        # The tip must still be in the index for this ref (the index
+        # could have been wiped) and must be an ancestor of the new tip
+        # (the history could have been rewritten).
+        if self.catalog:
+            refs = self.catalog.get_refs([indexed_tip]).get(indexed_tip, [])
+        else:
+            cmt = self.c.get_commit(indexed_tip, silent=True)
+            refs = cmt['repos'] if cmt else []
+        if self.ref_id not in refs:
+            logger.info("%s: indexed tip %s not found in the index" % (
+                self.ref_id, indexed_tip))
+            return False
+        if not is_ancestor(self.local, indexed_tip, self.tip):
+            logger.info("%s: indexed tip %s is not an ancestor of %s" % (
+                self.ref_id, indexed_tip, self.tip))
+            return False
+        return True
+
     def git_get_commit_obj(self):
-        self.commits = get_all_shas(self.local)
-
-    def run_workers(self, shas, workers):
-        BULK_CHUNK = 1000
-        to_process = []
-        if workers == 0:
-            # Default value (auto)
-            workers = mp.cpu_count() - 1 or 1
-        while True:
-            try:
-                shas[BULK_CHUNK]
-                to_process.append(shas[:BULK_CHUNK])
-                del shas[:BULK_CHUNK]
-            except IndexError:
-                # Add the rest
-                to_process.append(shas)
-                break
+        ref = get_branch_ref(self.branch)
+        self.tip = get_tip(self.local, ref)
+        indexed_tip = self.get_indexed_tip()
+        self.incremental = bool(
+            indexed_tip and self.is_indexed_tip_valid(indexed_tip))
+        since = self.horizon or None
+        if self.incremental:
+            logger.info("%s: compute commits from %s to %s" % (
+                self.ref_id, indexed_tip, self.tip))
+            self.commits = get_shas_set(
+                self.local, ref, exclude=indexed_tip, since=since)
+        else:
+            self.commits = get_shas_set(self.local, ref, since=since)
+        self.exclude_shallow_commits()
+
+    def exclude_shallow_commits(self):
+        # The line statistics of the boundary commits of a shallow
+        # history cannot be computed, they are indexed once the
+        # horizon is extended past them.
+        self.shallow = get_shallow_commits(self.local)
+        if self.shallow:
+            self.commits = self.commits.difference(self.shallow)
+
+    def get_ref_ids(self):
         ref_ids = [self.ref_id]
         if self.meta_ref:
             ref_ids.append(self.meta_ref)
+        return ref_ids
+
+    def run_workers(self, shas, workers, stats=True):
+        """ Create the commits of shas. The import is checkpointed by
+        chunks so an interrupted import is resumed (see resume_import).
+        """
+        self.checkpoints.start(self.ref_id, self.tip or '', stats,
+                               shaset.chunks(shas, IMPORT_CHUNK))
+        self.run_import(workers, stats)
+
+    def run_import(self, workers, stats=True, resume=False):
+        """ Index the remaining chunks of the import of the ref. The
+        failed chunks are retried up to indexer_import_retries times
+        with an exponential backoff, then the import is left to the
+        next run and an exception is raised.
+        """
+        attempt = 0
+        while True:
+            pending = False
+            failed = []
+            # The chunks are loaded by windows to bound the memory used
+            # by the import of large refs
+            for chunks in self.checkpoints.iter_chunks(
+                    self.ref_id, IMPORT_WINDOW):
+                pending = True
+                if resume or attempt:
+                    # Commits may have been indexed before the failure
+                    chunks = self.skip_indexed(chunks)
+                window_failed = self.run_chunks(chunks, workers, stats)
+                self.checkpoints.set_failed(self.ref_id, window_failed)
+                failed.extend(window_failed)
+            if not pending:
+                break
+            if not failed:
+                continue
+            attempt += 1
+            if attempt > get_import_retries():
+                raise Exception(
+                    "%s: %s chunks of commits failed to be indexed, the "
+                    "import is resumed by the next run" % (
+                        self.ref_id, len(failed)))
+            delay = getattr(conf, 'indexer_import_retry_delay', 5) * (
+                2 ** (attempt - 1))
+            logger.warning("%s: %s chunks of commits failed to be indexed, "
+                           "retry %s/%s in %ss" % (
+                               self.ref_id, len(failed), attempt,
+                               get_import_retries(), delay))
+            time.sleep(delay)
+        self.checkpoints.finish(self.ref_id)
+
+    def skip_indexed(self, chunks):
+        """ Add the ref to the commits of chunks already indexed and
+        remove them from the chunks.
+        """
+        ref_ids = self.get_ref_ids()
+        shas = [sha for chunk in chunks.values() for sha in chunk]
+        existing = set()
+        for i in range(0, len(shas), IMPORT_CHUNK):
+            existing.update(self.c.get_existing_ids(shas[i:i + IMPORT_CHUNK]))
+        if existing:
+            self.c.add_refs(list(existing), ref_ids)
+            if self.catalog:
+                self.catalog.add_refs(existing, ref_ids)
+        return dict(
+            (chunk, [sha for sha in shas if sha not in existing])
+            for chunk, shas in chunks.items())
+
+    def run_chunks(self, chunks, workers, stats=True):
+        """ Extract and index the chunks of commits (a dict chunk id
+        -> shas) with the workers pool. The chunks are checkpointed as
+        soon as all their commits are indexed. Return the failed chunks.
+        """
+        ref_ids = self.get_ref_ids()
+        tracker = checkpoints.ChunksTracker(
+            self.checkpoints, self.ref_id, chunks)
+
+        def indexed(shas):
+            tracker.indexed(shas)
+            metrics.incr('commits_indexed', len(shas))
         options = [
-            (self.local, ref_ids, stp) for stp in to_process]
-        worker_pool = mp.Pool(workers)
-        worker_pool.map(process_commits, options)
-        worker_pool.terminate()
-        worker_pool.join()
+            (self.local, ref_ids, shas, self.parsers, stats)
+            for _, shas in sorted(chunks.items()) if shas]
+        pool = start_workers_pool(workers)
+        if pipeline.is_enabled():
+            # Workers only extract commits, the main process writes them
+            writer = pipeline.BulkWriter(self.c, on_created=indexed)
+            try:
+                created = pipeline.run(
+                    pool, extract_chunk, options, writer,
+                    max_inflight=2 * get_workers_amount(workers))
+            except Exception:
+                logger.exception("%s: unable to index commits" % (
+                    self.ref_id))
+                created = writer.created
+            if self.catalog:
+                self.catalog.add_refs(created, ref_ids)
+        else:
+            for shas, bulks in pool.imap_unordered(process_chunk, options):
+                # The workers metrics are recorded by the main process
+                metrics.record_bulks(bulks)
+                indexed(shas)
+                if self.catalog:
+                    self.catalog.add_refs(shas, ref_ids)
+        failed = tracker.get_failed()
+        metrics.incr('chunks_failed', len(failed))
+        return failed
 
-    def is_branch_fully_indexed(self):
-        branch = [head for head in self.heads if
-                  head[1].endswith(self.branch)][0]
-        branch_tip_sha = branch[0]
-        _, _, cmts_list = self.c.get_commits(repos=[self.ref_id], limit=1)
-        if not cmts_list:
+    def resume_import(self, workers):
+        """ Complete the interrupted import of the ref. Its tip is then
+        the indexed tip so the commits added since are indexed
+        incrementally. Return True if an import has been resumed.
+        """
+        state = self.checkpoints.get(self.ref_id)
+        if not state:
             return False
-        cmt = cmts_list[0]
-        if branch_tip_sha != cmt['sha']:
+        tip = get_tip(self.local, get_branch_ref(self.branch))
+        if not (state['tip'] and is_ancestor(self.local, state['tip'], tip)):
+            logger.info("%s: history rewritten since the interrupted "
+                        "import, import it again" % self.ref_id)
+            self.checkpoints.finish(self.ref_id)
             return False
+        logger.info("%s: resume the import up to %s, %s chunks left" % (
+            self.ref_id, state['tip'],
+            self.checkpoints.count_chunks(self.ref_id)))
+        self.compile_parsers()
+        self.run_import(workers, state['stats'], resume=True)
+        self.tip = state['tip']
+        self.save_indexed_tip()
         return True
 
+    def backfill_stats(self, workers, budget=None):
+        """ Compute the line statistics of at most budget commits of
+        the ref indexed without them, newest commits first. Return the
+        amount of updated commits.
+        """
+        if budget is None:
+            budget = getattr(conf, 'indexer_stats_backfill_budget', 20000)
+        pool = start_workers_pool(workers)
+        done = 0
+        while done < budget:
+            shas = self.c.get_stats_pending(
+                self.ref_id, min(BACKFILL_CHUNK, budget - done))
+            if not shas:
+                logger.info("%s: line statistics are complete" % (
+                    self.ref_id))
+                self.set_stats_pending(False)
+                break
+            known = get_known_commits(self.local, shas)
+            chunks = [known[i:i + 1000] for i in range(0, len(known), 1000)]
+            docs = []
+            for ret in pool.map(
+                    extract_stats, [(self.local, chunk) for chunk in chunks]):
+                docs.extend(ret)
+            found = set(doc['sha'] for doc in docs)
+            for sha in shas:
+                if sha not in found:
+                    # Not in the repository anymore, do not retry it
+                    logger.warning("%s: unable to compute the line "
+                                   "statistics of %s" % (self.ref_id, sha))
+                    docs.append({'sha': sha})
+            self.c.set_stats(docs)
+            # The next query must not return the updated commits
+            self.c.refresh(force=True)
+            done += len(shas)
+            logger.info("%s: computed the line statistics of %s commits" % (
+                self.ref_id, done))
+        return done
+
+    def is_horizon_extensible(self):
+        return bool(self.horizon and get_horizon_backfill_days() > 0)
+
+    def get_extended_horizon(self):
+        return self.horizon - get_horizon_backfill_days() * 86400
+
+    def extend_horizon(self, workers, since):
+        """ Move the horizon of the ref indexer_horizon_backfill_days
+        days backwards then fetch and index the commits up to the new
+        horizon. since is passed to the fetch, it is the oldest horizon
+        of the refs of the repository (None when one of them needs the
+        full history) so their history is not shortened. Return the
+        amount of indexed commits.
+        """
+        horizon = self.get_extended_horizon()
+        self.git_fetch_branches([self.branch], since=since)
+        ref = get_branch_ref(self.branch)
+        self.tip = get_tip(self.local, ref)
+        self.incremental = False
+        self.shallow = get_shallow_commits(self.local)
+        if not get_shas_set(self.local, ref).intersection(self.shallow):
+            # The full history of the ref is fetched
+            horizon = 0
+        self.horizon = horizon
+        self.commits = get_shas_set(self.local, ref, since=horizon or None)
+        self.exclude_shallow_commits()
+        self.get_current_commits_indexed()
+        self.compute_to_index_to_delete()
+        amount = len(self.to_index)
+        self.index(workers)
+        self.save_horizon(horizon)
+        logger.info("%s: horizon extended to %s, %s commits indexed" % (
+            self.ref_id, horizon or "the first commit", amount))
+        return amount
+
+    def get_branch_tip(self):
+        """ Return the upstream tip of the branch in the refs snapshot
+        """
+        return [head for head in self.heads if
+                head[1].endswith(self.branch)][0][0]
+
+    def is_branch_fully_indexed(self):
+        return self.ref_id not in get_moved_refs([self])
+
     def get_current_commits_indexed(self):
         """ Fetch from the index commits mentionned for this repo
         and branch.
         """
-        self.already_indexed = [c['_id'] for c in
-                                self.c.get_commits(repos=[self.ref_id],
-                                                   scan=True)]
+        if self.incremental:
+            # Commits to index are only those added on top of the
+            # indexed tip so there is no need to diff the full history.
+            self.already_indexed = shaset.ShaSet()
+            return
+        if self.horizon:
+            # The commits older than the horizon are not fetched, they
+            # are intentionally absent from the upstream history.
+            indexed = (
+                c['_id'] for c in
+                self.c.get_commits(repos=[self.ref_id],
+                                   fromdate=self.horizon, scan=True))
+        elif self.catalog:
+            indexed = self.catalog.iter_ref_shas(self.ref_id)
+        else:
+            indexed = (
+                c['_id'] for c in
+                self.c.get_commits(repos=[self.ref_id], scan=True))
+        self.already_indexed = shaset.ShaSet.from_iterable(indexed)
         logger.debug(
             "%s: In the DB - repo history is composed of %s commits." % (
                 self.name, len(self.already_indexed)))
 
     def compute_to_index_to_delete(self):
-        """ Compute the list of commits (sha) to index and the
-        list to delete from the index.
+        """ Compute the set of commits (sha) to index and the
+        set to delete from the index. The sets are diffed in order on
+        their compact form (see shaset.ShaSet).
         """
         logger.debug(
             "%s: Upstream - repo history is composed of %s commits." % (
                 self.name, len(self.commits)))
-        self.to_delete = set(self.already_indexed) - set(self.commits)
-        self.to_index = set(self.commits) - set(self.already_indexed)
+        commits = shaset.ShaSet.from_iterable(self.commits)
+        already_indexed = shaset.ShaSet.from_iterable(self.already_indexed)
+        self.to_delete = already_indexed.difference(commits, self.shallow)
+        self.to_index = commits.difference(already_indexed)
         logger.debug(
             "%s: Indexer will reference %s commits." % (
                 self.name,
@@ -583,14 +1390,22 @@ class RepoIndexer():
                 len(self.to_delete)))
 
     def compute_to_create_to_update(self):
-        if self.to_index:
-            res = self.c.get_commits_by_id(list(self.to_index))
-            to_update = [c['_source'] for
-                         c in res['docs'] if c['found'] is True]
-            to_create = [c['_id'] for
-                         c in res['docs'] if c['found'] is False]
-            return to_create, to_update
-        return [], []
+        """ Split the commits to index into the commits to create and
+        the already indexed commits to which ref_id must be added.
+        The indexed commits are looked up by chunks.
+        """
+        if self.to_index and self.catalog:
+            get_existing = self.catalog.get_refs
+        elif self.to_index:
+            get_existing = self.c.get_existing_ids
+        else:
+            return shaset.ShaSet(), shaset.ShaSet()
+        to_update = shaset.ShaSet.from_iterable(
+            sha for chunk in shaset.chunks(self.to_index, IMPORT_CHUNK)
+            for sha in get_existing(chunk))
+        to_create = shaset.ShaSet.from_iterable(
+            self.to_index).difference(to_update)
+        return to_create, to_update
 
     def index_tags(self):
         def c_tid(t):
@@ -638,8 +1453,7 @@ class RepoIndexer():
                         self.name, len(to_delete)))
             self.t.del_tags(to_delete)
 
-    def index(self, extract_workers=1):
-        # Compile the parsers
+    def compile_parsers(self):
         if self.parsers:
             if not self.parsers_compiled:
                 raw_parsers = copy.deepcopy(self.parsers)
@@ -651,25 +1465,57 @@ class RepoIndexer():
                         self.name, len(self.parsers)))
                 self.parsers_compiled = True
 
+    def index(self, extract_workers=1):
+        self.compile_parsers()
+
         # check whether a commit should be completly deleted or
         # updated by removing the repo from the repos field
         if self.to_delete:
-            delete_commits(self.c, self.name, self.to_delete, self.ref_id)
+            delete_commits(self.c, self.name, self.to_delete, self.ref_id,
+                           self.catalog)
 
         # check whether a commit should be created or
         # updated by adding the repo into the repos field
         if self.to_index:
             to_create, to_update = self.compute_to_create_to_update()
 
-            if to_create:
-                logger.info("%s: %s commits will be created ..." % (
-                    self.name, len(to_create)))
-                self.run_workers(to_create, extract_workers)
-
+            # The ref is added to the indexed commits first: the import
+            # checkpoints only record the commits to create, an
+            # interrupted import is resumed from them only
             if to_update:
                 logger.info(
                     "%s: %s commits already indexed and need to be updated" % (
                         self.name, len(to_update)))
-                for c in to_update:
-                    c['repos'].append(self.ref_id)
-                self.c.update_commits(to_update)
+                res = self.c.add_refs(to_update, [self.ref_id])
+                missing = [sha for sha, r in res.items() if r == 'not_found']
+                if self.catalog:
+                    self.catalog.add_refs(to_update, [self.ref_id])
+                    self.catalog.remove_shas(missing)
+                if missing:
+                    logger.warning("%s: %s commits to update are missing "
+                                   "from the index, they are created" % (
+                                       self.ref_id, len(missing)))
+                    to_create = shaset.ShaSet.from_iterable(
+                        sha for shas in (to_create, missing) for sha in shas)
+                if getattr(conf, 'indexer_two_phase_min_commits', 0):
+                    # Some of the commits may wait for their line
+                    # statistics, their first ref could be removed first
+                    self.set_stats_pending(True)
+
+            if to_create:
+                logger.info("%s: %s commits will be created ..." % (
+                    self.name, len(to_create)))
+                stats = not is_two_phase(len(to_create))
+                if not stats:
+                    logger.info("%s: line statistics will be computed "
+                                "by the next runs" % self.ref_id)
+                    self.set_stats_pending(True)
+                self.run_workers(to_create, extract_workers, stats)
+
+        if ingest.is_enabled() and ingest.refresh_per_ref():
+            self.c.refresh(force=True)
+
+        if self.tip and not self.checkpoints.get(self.ref_id):
+            # Only once all the commits are confirmed written, the next
+            # run only considers the commits added on top of the tip
+            self.save_indexed_tip()
@@ -0,0 +1,132 @@
+# Copyright 2016, Fabien Boucher
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+import os
+import time
+import pickle
+import logging
+
+from contextlib import nullcontext
+
+from pecan import conf
+
+logger = logging.getLogger(__name__)
+
+INGEST_SETTINGS_CACHED = 'ingest-settings.cached'
+
+
+def is_enabled():
+    return getattr(conf, 'indexer_ingest_mode', False)
+
+
+def refresh_per_ref():
+    """ Return True if the commits index must be refreshed after each
+    indexed ref. Otherwise it is only refreshed at the end of the run.
+    """
+    return getattr(conf, 'indexer_ingest_refresh', 'ref') == 'ref'
+
+
+class IngestMode(object):
+    """ Tune the commits index for a large import. The refresh
+    interval is disabled (and the replicas optionally dropped) until
+    stop is called, then the original settings are restored and the
+    index is force merged if at least min_commits commits were added.
+
+    The original settings are saved in db_cache_path so they can be
+    restored after an indexer crash.
+    """
+    def __init__(self, connector, replicas=None, max_num_segments=None,
+                 min_commits=None):
+        self.es = connector.es
+        self.ic = connector.ic
+        self.index = connector.index
+        self.replicas = replicas
+        if self.replicas is None:
+            self.replicas = getattr(conf, 'indexer_ingest_replicas', None)
+        self.max_num_segments = max_num_segments or getattr(
+            conf, 'indexer_ingest_max_segments', 1)
+        self.min_commits = min_commits
+        if self.min_commits is None:
+            self.min_commits = getattr(
+                conf, 'indexer_ingest_min_commits', 10000)
+        self.settings_path = os.path.join(
+            conf.db_cache_path, INGEST_SETTINGS_CACHED)
+        self.original = None
+        self.start_time = None
+        self.start_count = None
+
+    def get_settings(self):
+        settings = self.ic.get_settings(index=self.index)
+        # Keyed by the concrete index when the index is an alias (see
+        # rebuild.py)
+        settings = list(settings.values())[0]['settings']['index']
+        return {
+            'refresh_interval': settings.get('refresh_interval'),
+            'number_of_replicas': settings.get('number_of_replicas'),
+        }
+
+    def load_original_settings(self):
+        if os.path.isfile(self.settings_path):
+            try:
+                return pickle.load(open(self.settings_path, 'rb'))
+            except Exception:
+                logger.warning("Unable to read %s" % self.settings_path)
+
+    def start(self):
+        # Settings saved by a run that did not end are the original ones
+        self.original = self.load_original_settings()
+        if self.original:
+            logger.info("Restore index settings of an interrupted "
+                        "ingest run: %s" % self.original)
+        else:
+            self.original = self.get_settings()
+            pickle.dump(self.original, open(self.settings_path, 'wb'))
+        self.start_count = self.es.count(index=self.index)['count']
+        self.start_time = time.time()
+        settings = {'refresh_interval': '-1'}
+        if self.replicas is not None:
+            settings['number_of_replicas'] = self.replicas
+        logger.info("Start ingest mode on index %s: %s" % (
+            self.index, settings))
+        self.ic.put_settings(index=self.index, body={'index': settings})
+
+    def stop(self, report=None):
+        """ Restore the index settings, force merge the index if the
+        import was large enough and log the ingest throughput. Return
+        the amount of new commits.
+        """
+        self.ic.put_settings(index=self.index,
+                             body={'index': self.original})
+        os.unlink(self.settings_path)
+        self.ic.refresh(index=self.index)
+        elapsed = time.time() - self.start_time
+        amount = self.es.count(index=self.index)['count'] - self.start_count
+        logger.info("Ingest mode done on index %s: %s new commits in "
+                    "%.1fs (%.0f commits/s)" % (
+                        self.index, amount, elapsed,
+                        amount / elapsed if elapsed else 0))
+        if amount >= self.min_commits:
+            self.forcemerge(report)
+        if report:
+            report.incr('ingested_commits', amount)
+        return amount
+
+    def forcemerge(self, report=None):
+        start = time.time()
+        with report.stage('forcemerge') if report else nullcontext():
+            self.ic.forcemerge(index=self.index,
+                               max_num_segments=self.max_num_segments,
+                               request_timeout=3600)
+        logger.info("Index %s force merged to %s segments in %.1fs" % (
+            self.index, self.max_num_segments, time.time() - start))
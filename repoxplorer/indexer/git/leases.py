@@ -0,0 +1,297 @@
+# Copyright 2016, Fabien Boucher
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+""" Fleet of indexers coordinated through leases.
+
+Several indexers, on one or several hosts, share the repositories of
+the projects definition. The leases are documents of the
+<elasticsearch_index>-leases index written with optimistic concurrency
+control (if_seq_no/if_primary_term) and expiring after
+indexer_lease_ttl seconds:
+
+- node: one per live indexer, renewed by its heartbeat.
+- repo: the ownership of a repository by an indexer. Each indexer
+  claims at most its share of the repositories (repositories / live
+  indexers) and releases the surplus when indexers join, so the
+  repositories of a crashed indexer are taken over by the others once
+  its leases expire.
+- leader: the indexer cleaning the refs no longer in the projects
+  definition.
+
+The leases held by an indexer are renewed by a heartbeat thread every
+third of the ttl so a long cycle does not lose them.
+"""
+
+import os
+import math
+import time
+import socket
+import hashlib
+import logging
+import threading
+
+from pecan import conf
+
+from elasticsearch.exceptions import ConflictError
+from elasticsearch.exceptions import NotFoundError
+from elasticsearch.helpers import scan as scanner
+
+from repoxplorer import index
+from repoxplorer.index import add_params
+from repoxplorer.indexer.git import polling
+from repoxplorer.indexer.git import state_store
+
+logger = logging.getLogger(__name__)
+
+PROPERTIES = {
+    "kind": {"type": "keyword"},
+    "key": {"type": "keyword"},
+    "owner": {"type": "keyword"},
+    "expires": {"type": "double"},
+}
+
+LEADER = 'leader'
+
+
+def is_enabled():
+    return getattr(conf, 'indexer_leases', False)
+
+
+def get_node_id():
+    return (getattr(conf, 'indexer_node_id', None) or
+            '%s-%s' % (socket.gethostname(), os.getpid()))
+
+
+def get_lease_id(kind, key):
+    return '%s-%s' % (kind, hashlib.sha1(key.encode()).hexdigest())
+
+
+class LeaseManager(object):
+    """ Claim, renew and release the leases of an indexer
+    """
+    def __init__(self, connector=None, node=None, ttl=None):
+        if not connector:
+            connector = index.Connector(index_suffix='leases')
+        self.es = connector.es
+        self.ic = connector.ic
+        self.index = connector.index
+        self.dbname = 'leases'
+        self.node = node or get_node_id()
+        self.ttl = ttl or getattr(conf, 'indexer_lease_ttl', 300)
+        self.lock = threading.RLock()
+        self.stopped = threading.Event()
+        # lease id -> (seq_no, primary_term) of the leases held
+        self.held = {}
+        # (kind, key) of the repo and leader leases held
+        self.leased = set()
+        # Repositories taken over from another indexer
+        self.transferred = set()
+        mapping = {self.dbname: {"properties": PROPERTIES}}
+        if not self.ic.exists_type(index=self.index, doc_type=self.dbname):
+            self.ic.put_mapping(index=self.index, doc_type=self.dbname,
+                                body=mapping, **add_params(self.es))
+
+    def write(self, lease_id, kind, key, version=None, refresh=False):
+        """ Write the lease of the node. version is the (seq_no,
+        primary_term) of the lease read, None to create it. Return
+        False if another indexer wrote it first.
+        """
+        body = {'kind': kind, 'key': key, 'owner': self.node,
+                'expires': time.time() + self.ttl}
+        kwargs = {'op_type': 'create'}
+        if version:
+            kwargs = {'if_seq_no': version[0],
+                      'if_primary_term': version[1]}
+        try:
+            ret = self.es.index(
+                index=self.index, doc_type=self.dbname, id=lease_id,
+                body=body, refresh=refresh, **kwargs)
+        except ConflictError:
+            self.held.pop(lease_id, None)
+            return False
+        self.held[lease_id] = (ret['_seq_no'], ret['_primary_term'])
+        return True
+
+    def acquire(self, kind, key, lease=None):
+        """ Acquire or renew the lease of key. lease is the lease
+        document if already read. Return True if the lease is held.
+        """
+        lease_id = get_lease_id(kind, key)
+        with self.lock:
+            if lease is None:
+                try:
+                    lease = self.es.get(
+                        index=self.index, doc_type=self.dbname, id=lease_id)
+                except NotFoundError:
+                    pass
+            if lease is None:
+                return self.write(lease_id, kind, key)
+            source = lease['_source']
+            if source['owner'] != self.node and (
+                    source['expires'] > time.time()):
+                return False
+            if not self.write(lease_id, kind, key, (
+                    lease['_seq_no'], lease['_primary_term'])):
+                return False
+            if source['owner'] != self.node:
+                logger.info("Lease of %s %s taken over from %s" % (
+                    kind, key, source['owner']))
+                if kind == 'repo':
+                    self.transferred.add(key)
+            return True
+
+    def renew(self, kind, key):
+        lease_id = get_lease_id(kind, key)
+        with self.lock:
+            version = self.held.get(lease_id)
+            if version is None or not self.write(
+                    lease_id, kind, key, version, refresh=(kind == 'node')):
+                logger.warning("Lease of %s %s lost" % (kind, key))
+                self.leased.discard((kind, key))
+                return False
+            return True
+
+    def release(self, kind, key):
+        lease_id = get_lease_id(kind, key)
+        with self.lock:
+            self.leased.discard((kind, key))
+            version = self.held.pop(lease_id, None)
+            if version is None:
+                return
+            try:
+                self.es.delete(
+                    index=self.index, doc_type=self.dbname, id=lease_id,
+                    if_seq_no=version[0], if_primary_term=version[1])
+            except (ConflictError, NotFoundError):
+                pass
+
+    def get_leases(self, kind):
+        """ Return the lease documents of kind by key
+        """
+        query = {
+            'query': {'term': {'kind': kind}},
+            'seq_no_primary_term': True,
+        }
+        return dict((hit['_source']['key'], hit) for hit in scanner(
+            self.es, query=query, index=self.index))
+
+    def get_nodes(self):
+        """ Return the ids of the live indexers
+        """
+        now = time.time()
+        return sorted(
+            lease['_source']['owner'] for lease in
+            self.get_leases('node').values()
+            if lease['_source']['expires'] > now)
+
+    def heartbeat(self):
+        """ Renew the leases held by the node
+        """
+        with self.lock:
+            node_id = get_lease_id('node', self.node)
+            if node_id not in self.held or not self.renew(
+                    'node', self.node):
+                self.write(node_id, 'node', self.node, refresh=True)
+            for kind, key in list(self.leased):
+                self.renew(kind, key)
+
+    def is_leader(self):
+        with self.lock:
+            if self.acquire(LEADER, LEADER):
+                self.leased.add((LEADER, LEADER))
+                return True
+            self.leased.discard((LEADER, LEADER))
+            return False
+
+    def select(self, jobs):
+        """ Return the repository jobs (scheduler.RepoJob) owned by the
+        node for the cycle: the ones already leased, up to its share,
+        then the free or expired ones.
+        """
+        with self.lock:
+            self.heartbeat()
+            nodes = self.get_nodes()
+            if self.node not in nodes:
+                nodes.append(self.node)
+            quota = int(math.ceil(len(jobs) / float(len(nodes))))
+            leases = self.get_leases('repo')
+            by_key = dict((job.base_id, job) for job in jobs)
+            leased = set(key for kind, key in self.leased
+                         if kind == 'repo')
+            # Repositories no longer in the projects definition
+            for key in leased - set(by_key):
+                self.release('repo', key)
+            mine = [key for key in by_key if key in leased]
+            # Leave the surplus to the indexers that joined
+            for key in mine[quota:]:
+                self.release('repo', key)
+            mine = mine[:quota]
+            # Each node walks the free repositories in its own order to
+            # limit the conflicts
+            candidates = sorted(
+                (key for key in by_key if key not in mine),
+                key=lambda k: hashlib.sha1(
+                    ('%s%s' % (self.node, k)).encode()).hexdigest())
+            now = time.time()
+            for key in candidates:
+                if len(mine) >= quota:
+                    break
+                lease = leases.get(key)
+                if lease and lease['_source']['owner'] != self.node and (
+                        lease['_source']['expires'] > now):
+                    continue
+                if self.acquire('repo', key, lease):
+                    self.leased.add(('repo', key))
+                    mine.append(key)
+            self.forget_transferred(by_key)
+            logger.info("%s repositories leased by %s out of %s (%s "
+                        "indexers)" % (len(mine), self.node, len(jobs),
+                                       len(nodes)))
+            mine = set(mine)
+            return [job for job in jobs if job.base_id in mine]
+
+    def forget_transferred(self, by_key):
+        """ Forget the indexed tips of the refs of the repositories
+        taken over from another indexer: the commits index may have
+        changed since this node indexed them.
+        """
+        state = state_store.get_store()
+        for key in self.transferred:
+            job = by_key.get(key)
+            if job is None:
+                continue
+            for ref, _ in job.refs:
+                state.set_indexed_tip(polling.get_ref_id(ref), None)
+        self.transferred = set()
+
+    def work(self):
+        while not self.stopped.wait(self.ttl / 3.0):
+            try:
+                self.heartbeat()
+            except Exception:
+                logger.exception("Unable to renew the leases of %s" %
+                                 self.node)
+
+    def start(self):
+        self.heartbeat()
+        threading.Thread(target=self.work, daemon=True).start()
+
+    def stop(self):
+        """ Release the leases of the node
+        """
+        self.stopped.set()
+        with self.lock:
+            for kind, key in list(self.leased):
+                self.release(kind, key)
+            self.release('node', self.node)
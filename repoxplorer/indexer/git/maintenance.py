@@ -0,0 +1,274 @@
+# Copyright 2016, Fabien Boucher
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+""" Maintenance of the bare repositories of git_store.
+
+The fetches of the indexer only add packs to the repositories. The
+maintenance tasks keep the history walks of the indexer (rev-list, log,
+diff-tree) fast:
+
+- pool: fetch the refs of the repository into its objects pool (see
+  pools.py) and repack it without the objects found in the pool.
+- commit-graph: write or incrementally update (split) the commit-graph,
+  with the changed paths Bloom filters when git supports them.
+- pack: geometric repack of the packs and multi-pack-index.
+- prune: delete the local branches no longer indexed then drop the
+  unreachable objects.
+
+Each task runs at most once per interval and per repository. The last
+run and duration of the tasks are kept in the indexer state store.
+The maintenance is disabled by default (indexer_maintenance).
+"""
+
+import os
+import re
+import time
+import logging
+import subprocess
+
+from pecan import conf
+
+from repoxplorer.indexer.git import pools
+from repoxplorer.indexer.git import state_store
+from repoxplorer.indexer.git.indexer import run
+from repoxplorer.indexer.git.indexer import has_refs
+from repoxplorer.indexer.git.indexer import get_repo_path
+from repoxplorer.indexer.git.indexer import get_branch_ref
+
+logger = logging.getLogger(__name__)
+
+TASKS = ('pool', 'commit-graph', 'pack', 'prune')
+
+# Default interval in seconds between two runs of a task
+INTERVALS = {
+    'pool': 3600,
+    'commit-graph': 3600,
+    'pack': 24 * 3600,
+    'prune': 7 * 24 * 3600,
+}
+
+_git_version = None
+
+
+def is_enabled():
+    return getattr(conf, 'indexer_maintenance', False)
+
+
+def get_interval(task):
+    """ Return the interval of task, 0 if the task is disabled.
+    """
+    return getattr(
+        conf, 'indexer_maintenance_%s_interval' % task.replace('-', '_'),
+        INTERVALS[task])
+
+
+def get_git_version():
+    global _git_version
+    if _git_version is None:
+        out = subprocess.check_output(['git', '--version']).decode()
+        m = re.search(r'(\d+)\.(\d+)', out)
+        _git_version = tuple(int(v) for v in m.groups()) if m else (0, 0)
+    return _git_version
+
+
+def write_commit_graph(path, replace=False):
+    """ Add the new commits to the commit-graph of the repository in a
+    new layer. Layers are merged by git. With replace the commit-graph
+    is written again in a single layer.
+    """
+    cmd = ['git', 'commit-graph', 'write', '--reachable']
+    if replace:
+        cmd.append('--split=replace')
+    else:
+        cmd.append('--split')
+    if get_git_version() >= (2, 27):
+        cmd.append('--changed-paths')
+    run(cmd, path)
+
+
+def repack(path):
+    """ Repack the packs so that each pack is at least twice as large
+    as the next smaller one and write the multi-pack-index.
+    """
+    if get_git_version() >= (2, 34):
+        run(['git', 'repack', '-d', '-l', '--geometric=2',
+             '--write-midx'], path)
+    else:
+        run(['git', 'repack', '-d', '-l'], path)
+        run(['git', 'multi-pack-index', 'write'], path)
+
+
+def full_repack(path):
+    """ Repack all the objects of the repository not found in its
+    alternates into a single pack.
+    """
+    cmd = ['git', 'repack', '-a', '-d', '-l']
+    if get_git_version() >= (2, 34):
+        cmd.append('--write-midx')
+    run(cmd, path)
+
+
+def pool_objects(path):
+    """ Move the objects of the repository to its objects pool.
+    Return the path of the pool or None.
+    """
+    pool = pools.sync_member(path)
+    if pool:
+        full_repack(path)
+        repack(pool)
+        write_commit_graph(pool)
+    return pool
+
+
+def prune(path, keep):
+    """ Delete the local branches not in keep, and their remote
+    tracking branches updated by the fetches, then drop the objects only
+    reachable from them. Return the deleted refs.
+    """
+    keep = set(keep)
+    keep.update(
+        ref.replace('refs/heads/', 'refs/remotes/origin/', 1)
+        for ref in list(keep))
+    refs = run(['git', 'for-each-ref', '--format=%(refname)',
+                'refs/heads/', 'refs/remotes/'], path).split()
+    stale = [ref for ref in refs if ref not in keep]
+    if stale:
+        subprocess.run(
+            ['git', 'update-ref', '--stdin'],
+            input=''.join('delete %s\n' % ref for ref in stale).encode(),
+            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+            cwd=path, check=True)
+    full_repack(path)
+    run(['git', 'prune', '--expire=%s' % getattr(
+        conf, 'indexer_maintenance_prune_expire', '2.weeks.ago')], path)
+    # The commit-graph must not reference the dropped commits
+    write_commit_graph(path, replace=True)
+    return stale
+
+
+def get_repos_size():
+    """ Return the size in bytes of each repository of git_store.
+    """
+    sizes = {}
+    if not os.path.isdir(conf.git_store):
+        return sizes
+    for root, dirs, files in os.walk(conf.git_store):
+        rel = os.path.relpath(root, conf.git_store).split(os.sep)
+        if len(rel) < 2:
+            continue
+        repo = os.path.join(conf.git_store, rel[0], rel[1])
+        for name in files:
+            try:
+                size = os.lstat(os.path.join(root, name)).st_size
+            except OSError:
+                continue
+            sizes[repo] = sizes.get(repo, 0) + size
+    return sizes
+
+
+class GitMaintainer(object):
+    """ Run the maintenance tasks of the repositories of the indexer
+    jobs (scheduler.RepoJob), the most overdue first.
+    """
+    def __init__(self, state=None):
+        self.state = state or state_store.get_store()
+
+    def get_state(self):
+        return self.state.get_maintenance()
+
+    def save_task(self, path, task, last, duration):
+        self.state.set_maintenance(path, task, last, duration)
+
+    def get_due_tasks(self, jobs, now=None):
+        """ Return the (job, task) couples to run, most overdue first.
+        """
+        now = now or time.time()
+        state = self.get_state()
+        due = []
+        for job in jobs:
+            path = get_repo_path(job.name, job.uri)
+            if not os.path.isdir(path) or not has_refs(path):
+                # Not fetched yet
+                continue
+            for task in TASKS:
+                interval = get_interval(task)
+                if not interval:
+                    continue
+                last = state.get(path, {}).get(task, {}).get('last', 0)
+                if now - last >= interval:
+                    due.append((now - last - interval, job, task))
+        due.sort(key=lambda d: d[0], reverse=True)
+        return [(job, task) for _, job, task in due]
+
+    def run_task(self, job, task):
+        path = get_repo_path(job.name, job.uri)
+        if task == 'pool':
+            pool_objects(path)
+        elif task == 'commit-graph':
+            write_commit_graph(path)
+        elif task == 'pack':
+            repack(path)
+        elif task == 'prune':
+            keep = set(get_branch_ref(ref['branch']) for ref, _ in job.refs)
+            stale = prune(path, keep)
+            if stale:
+                logger.info("%s: deleted the local branches %s" % (
+                    job, ", ".join(stale)))
+
+    def run(self, jobs, report, deadline=None, locks=None):
+        """ Run the due tasks until deadline (an epoch). A started task
+        is not interrupted. Return the amount of tasks run. With locks
+        (scheduler.RepoLocks) a task holds the lock of its repository.
+        """
+        done = 0
+        due = self.get_due_tasks(jobs)
+        for job, task in due:
+            if deadline and time.time() >= deadline:
+                logger.info("Maintenance window is over, %s tasks "
+                            "postponed" % (len(due) - done))
+                break
+            start = time.time()
+            lock = locks.get(job.base_id) if locks else None
+            if lock:
+                lock.acquire()
+            try:
+                with report.stage('maintenance'):
+                    self.run_task(job, task)
+            except Exception as e:
+                logger.warning("Unable to run the %s maintenance of "
+                               "%s: %s" % (task, job, e))
+                report.incr('errors')
+            finally:
+                if lock:
+                    lock.release()
+            duration = time.time() - start
+            # A failing task is retried after its interval
+            self.save_task(
+                get_repo_path(job.name, job.uri), task, start, duration)
+            logger.info("%s: %s maintenance done in %.1fs" % (
+                job, task, duration))
+            report.incr('maintenance_tasks')
+            done += 1
+        report.gauge('git_store_bytes', sum(get_repos_size().values()))
+        return done
+
+    def summary(self):
+        """ Return the size and the last maintenance tasks of each
+        repository of git_store.
+        """
+        state = self.get_state()
+        summary = {}
+        for path, size in get_repos_size().items():
+            summary[path] = {'size': size, 'tasks': state.get(path, {})}
+        return summary
@@ -15,25 +15,42 @@
 
 import re
 
-METADATA_REs = {
-    'signed-of-by': re.compile('^[Ss]igned-[Oo]f(?:-[Bb]y)?:([^//].+)$'),
-    'reviewed-by': re.compile('^[Rr]evied(?:-[Bb]y)?:([^//].+)$'),
-    'tested-by': re.compile('^[Tt]ested(?:-[Bb]y)?:([^//].+)$'),
-    'rebased-by': re.compile('^[Rr]ebased(?:-[Bb]y)?:([^//].+)$'),
-    'reported-by': re.compile('^[Rr]eported(?:-[Bb]y)?:([^//].+)$'),
-    'co-authored-by': re.compile('^[Cc]o-[Aa]uthored(?:-[Bb]y)?:([^//].+)$'),
-    'helped-by': re.compile('^[Hh]elped(?:-[Bb]y)?:([^//].+)$'),
-    'acked-by': re.compile('^[Aa]cked(?:-[Bb]y)?:([^//].+)$'),
-    'suggested-by': re.compile('^[Ss]uggested(?:-[Bb]y)?:([^//].+)$'),
-    'noticed-by': re.compile('^[Nn]oticed(?:-[Bb]y)?:([^//].+)$'),
-    'mentored-by': re.compile('^[Mm]entored(?:-[Bb]y)?:([^//].+)$'),
-    'closes-bug': re.compile('^[Cc]loses?(?:-[Bb]ug)?:([^//].+)$'),
-    'fixes-bug': re.compile('^[Ff]ixe?s?(?:-[Bb]ug)?:([^//].+)$'),
-    'related-bug': re.compile('^[Rr]elated(?:-[Bb]ug)?:([^//].+)$'),
-    'depends-on': re.compile('^[Dd]epends(?:-[Oo]n)?:([^//].+)$'),
-    'resolves': re.compile('^[Rr]esolv(?:es)?:([^//].+)$'),
-    'issue': re.compile('^[Ii]ssue:([^//].+)$'),
-    'story': re.compile('^[Ss]tory:([^//].+)$'),
-    'task': re.compile('^[Tt]ask:([^//].+)$'),
-    'bug': re.compile('^[Bu]ug:([^//].+)$'),
-}
+from collections import OrderedDict
+
+# Key of the metadata and pattern of the trailer key
+METADATA_KEYS = OrderedDict((
+    ('signed-of-by', '[Ss]igned-[Oo]f(?:-[Bb]y)?'),
+    ('reviewed-by', '[Rr]evied(?:-[Bb]y)?'),
+    ('tested-by', '[Tt]ested(?:-[Bb]y)?'),
+    ('rebased-by', '[Rr]ebased(?:-[Bb]y)?'),
+    ('reported-by', '[Rr]eported(?:-[Bb]y)?'),
+    ('co-authored-by', '[Cc]o-[Aa]uthored(?:-[Bb]y)?'),
+    ('helped-by', '[Hh]elped(?:-[Bb]y)?'),
+    ('acked-by', '[Aa]cked(?:-[Bb]y)?'),
+    ('suggested-by', '[Ss]uggested(?:-[Bb]y)?'),
+    ('noticed-by', '[Nn]oticed(?:-[Bb]y)?'),
+    ('mentored-by', '[Mm]entored(?:-[Bb]y)?'),
+    ('closes-bug', '[Cc]loses?(?:-[Bb]ug)?'),
+    ('fixes-bug', '[Ff]ixe?s?(?:-[Bb]ug)?'),
+    ('related-bug', '[Rr]elated(?:-[Bb]ug)?'),
+    ('depends-on', '[Dd]epends(?:-[Oo]n)?'),
+    ('resolves', '[Rr]esolv(?:es)?'),
+    ('issue', '[Ii]ssue'),
+    ('story', '[Ss]tory'),
+    ('task', '[Tt]ask'),
+    ('bug', '[Bu]ug'),
+))
+
+METADATA_REs = dict(
+    (key, re.compile('^%s:([^//].+)$' % pattern))
+    for key, pattern in METADATA_KEYS.items())
+
+# Group name in METADATA_RE of each metadata key
+METADATA_GROUPS = dict(
+    ('m%s' % i, key) for i, key in enumerate(METADATA_KEYS))
+
+# Match the trailer keys of all the metadata at once. The matched group
+# name gives the metadata key and the value follows the match.
+METADATA_RE = re.compile('(?:%s):' % '|'.join(
+    '(?P<m%s>%s)' % (i, pattern)
+    for i, pattern in enumerate(METADATA_KEYS.values())))
@@ -0,0 +1,223 @@
+# Copyright 2016, Fabien Boucher
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+""" Metrics of the indexer process.
+
+Counters, gauges and histograms are kept for the process lifetime and
+exposed in the Prometheus text format on
+indexer_metrics_port/metrics and/or written to indexer_metrics_textfile
+(node_exporter textfile collector) at the end of each cycle, with the
+JSON summary of the cycle in indexer_metrics_summary. The stages, the
+counters and the gauges of the cycle reports (scheduler.CycleReport)
+are recorded as stage_seconds, <counter>_total and <gauge> metrics.
+
+The extraction workers run in their own processes, their work is
+measured by the stages and the counters of the main process. The bulk
+requests they send are returned with their results and recorded by the
+main process as the bulk_seconds, bulk_docs and bulk_rejected metrics.
+"""
+
+import os
+import json
+import time
+import logging
+import threading
+
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+
+from pecan import conf
+
+logger = logging.getLogger(__name__)
+
+PREFIX = 'repoxplorer_indexer_'
+# Upper bounds in seconds of the buckets of the histograms
+BUCKETS = (0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300, 900, 3600)
+
+
+def get_labels(labels):
+    return tuple(sorted(labels.items()))
+
+
+def format_labels(labels, extra=()):
+    labels = tuple(labels) + tuple(extra)
+    if not labels:
+        return ''
+    return '{%s}' % ','.join(
+        '%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+        for k, v in labels)
+
+
+class Registry(object):
+    """ Thread safe metrics of the process
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.gauges = {}
+        # (name, labels) -> [bucket counts, sum, count]
+        self.histograms = {}
+
+    def incr(self, name, value=1, **labels):
+        key = (name, get_labels(labels))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def gauge(self, name, value, **labels):
+        with self.lock:
+            self.gauges[(name, get_labels(labels))] = value
+
+    def observe(self, name, value, **labels):
+        key = (name, get_labels(labels))
+        with self.lock:
+            histogram = self.histograms.setdefault(
+                key, [[0] * len(BUCKETS), 0.0, 0])
+            index = bisect_left(BUCKETS, value)
+            if index < len(BUCKETS):
+                histogram[0][index] += 1
+            histogram[1] += value
+            histogram[2] += 1
+
+    def render(self):
+        """ Return the metrics in the Prometheus text format
+        """
+        lines = []
+        with self.lock:
+            counters = sorted(self.counters.items())
+            gauges = sorted(self.gauges.items())
+            histograms = sorted(
+                (key, (list(h[0]), h[1], h[2]))
+                for key, h in self.histograms.items())
+        typed = set()
+
+        def add_type(name, kind):
+            if name not in typed:
+                typed.add(name)
+                lines.append('# TYPE %s %s' % (name, kind))
+        for (name, labels), value in counters:
+            name = '%s%s_total' % (PREFIX, name)
+            add_type(name, 'counter')
+            lines.append('%s%s %s' % (name, format_labels(labels), value))
+        for (name, labels), value in gauges:
+            name = '%s%s' % (PREFIX, name)
+            add_type(name, 'gauge')
+            lines.append('%s%s %s' % (name, format_labels(labels), value))
+        for (name, labels), (buckets, total, count) in histograms:
+            name = '%s%s' % (PREFIX, name)
+            add_type(name, 'histogram')
+            cumulated = 0
+            for bound, amount in zip(BUCKETS, buckets):
+                cumulated += amount
+                lines.append('%s_bucket%s %s' % (
+                    name, format_labels(labels, (('le', bound),)),
+                    cumulated))
+            lines.append('%s_bucket%s %s' % (
+                name, format_labels(labels, (('le', '+Inf'),)), count))
+            lines.append('%s_sum%s %s' % (name, format_labels(labels), total))
+            lines.append('%s_count%s %s' % (
+                name, format_labels(labels), count))
+        return '\n'.join(lines) + '\n'
+
+
+_registry = Registry()
+_server = None
+
+
+def get_registry():
+    return _registry
+
+
+def incr(name, value=1, **labels):
+    _registry.incr(name, value, **labels)
+
+
+def gauge(name, value, **labels):
+    _registry.gauge(name, value, **labels)
+
+
+def observe(name, value, **labels):
+    _registry.observe(name, value, **labels)
+
+
+def record_bulks(bulks):
+    """ Record the (latency, docs, rejected) of bulk requests
+    """
+    for latency, docs, rejected in bulks:
+        observe('bulk_seconds', latency)
+        incr('bulk_docs', docs)
+        incr('bulk_rejected', rejected)
+
+
+def write_file(path, data):
+    tmp = '%s.tmp' % path
+    with open(tmp, 'w') as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+
+def export(report):
+    """ Record the end of the cycle of report (scheduler.CycleReport)
+    and write the metrics and the summary files if configured.
+    """
+    observe('cycle_seconds', report.wall_time)
+    gauge('last_cycle_timestamp', report.end or time.time())
+    textfile = getattr(conf, 'indexer_metrics_textfile', None)
+    if textfile:
+        write_file(textfile, _registry.render())
+    summary = getattr(conf, 'indexer_metrics_summary', None)
+    if summary:
+        write_file(summary, json.dumps(
+            report.summary(), indent=2, sort_keys=True))
+
+
+def start_server(host=None, port=None):
+    """ Serve the metrics at /metrics of host:port if the port is set.
+    Return the port.
+    """
+    global _server
+    host = host or getattr(conf, 'indexer_metrics_host', '127.0.0.1')
+    port = port if port is not None else getattr(
+        conf, 'indexer_metrics_port', 0)
+    if not port or _server:
+        return _server.server_address[1] if _server else None
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] != '/metrics':
+                self.send_error(404)
+                return
+            data = _registry.render().encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, format, *args):
+            logger.debug(format % args)
+
+    _server = ThreadingHTTPServer((host, port), Handler)
+    threading.Thread(target=_server.serve_forever, daemon=True).start()
+    logger.info("Metrics served on http://%s:%s/metrics" % (
+        host, _server.server_address[1]))
+    return _server.server_address[1]
+
+
+def stop_server():
+    global _server
+    if _server:
+        _server.shutdown()
+        _server.server_close()
+        _server = None
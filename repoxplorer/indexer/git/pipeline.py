@@ -0,0 +1,250 @@
+# Copyright 2016, Fabien Boucher
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+import time
+import queue
+import logging
+import threading
+
+from collections import Counter
+
+from elasticsearch import TransportError
+from elasticsearch.helpers import BulkIndexError
+from pecan import conf
+
+from repoxplorer.indexer.git import metrics
+
+logger = logging.getLogger(__name__)
+
+_controller = None
+_controller_lock = threading.Lock()
+
+
+def is_enabled():
+    return getattr(conf, 'indexer_bulk_writers', 0) > 0
+
+
+def get_controller():
+    """ Return the bulk controller of the process. It is shared by
+    the writers of all the refs indexed concurrently.
+    """
+    global _controller
+    with _controller_lock:
+        if _controller is None:
+            _controller = BulkController(
+                max_concurrency=getattr(conf, 'indexer_bulk_writers', 0),
+                min_batch=getattr(conf, 'indexer_bulk_min_batch', 100),
+                max_batch=getattr(conf, 'indexer_bulk_max_batch', 5000),
+                target_latency=getattr(
+                    conf, 'indexer_bulk_target_latency', 2.0))
+        return _controller
+
+
+class BulkController(object):
+    """ Adapt the amount of concurrent bulk requests and the size of
+    the bulk requests to the cluster. Both are increased additively
+    while the requests are fast and halved when a request is slower
+    than target_latency or when the cluster rejects documents (429).
+    """
+    def __init__(self, max_concurrency=4, min_batch=100, max_batch=5000,
+                 target_latency=2.0):
+        self.max_concurrency = max(max_concurrency, 1)
+        self.min_batch = min_batch
+        self.max_batch = max(max_batch, min_batch)
+        self.target_latency = target_latency
+        self.cond = threading.Condition()
+        self.concurrency = 1
+        self.batch_size = min_batch
+        self.active = 0
+        self.stats = Counter()
+
+    def acquire(self):
+        with self.cond:
+            while self.active >= self.concurrency:
+                self.cond.wait()
+            self.active += 1
+
+    def release(self, latency, docs, rejected):
+        with self.cond:
+            self.active -= 1
+            self.stats['bulks'] += 1
+            self.stats['docs'] += docs
+            self.stats['rejected'] += rejected
+            if rejected or latency > self.target_latency:
+                self.concurrency = max(1, self.concurrency // 2)
+                self.batch_size = max(self.min_batch, self.batch_size // 2)
+            else:
+                self.concurrency = min(
+                    self.max_concurrency, self.concurrency + 1)
+                if latency < self.target_latency / 2:
+                    self.batch_size = min(
+                        self.max_batch, self.batch_size + self.min_batch)
+            self.cond.notify_all()
+
+
+class BulkWriter(object):
+    """ Index commits documents from writer threads fed through a
+    bounded queue. put blocks when the writers are late so the
+    extraction stage is slowed down to the pace of the cluster.
+
+    Rejected documents are retried with an exponential backoff.
+    on_created is called by the writers threads with the created shas.
+    """
+    def __init__(self, commits, controller=None, max_retries=8,
+                 initial_backoff=1, max_backoff=60, on_created=None):
+        self.commits = commits
+        self.on_created = on_created
+        self.controller = controller or get_controller()
+        self.max_retries = max_retries
+        self.initial_backoff = initial_backoff
+        self.max_backoff = max_backoff
+        self.queue = queue.Queue(
+            maxsize=2 * self.controller.max_concurrency)
+        self.buffer = []
+        self.lock = threading.Lock()
+        self.created = []
+        self.errors = []
+        self.start = time.time()
+        self.threads = [
+            threading.Thread(target=self.work, daemon=True)
+            for _ in range(self.controller.max_concurrency)]
+        for thread in self.threads:
+            thread.start()
+
+    def put(self, cmts):
+        self.buffer.extend(cmts)
+        while len(self.buffer) >= self.controller.batch_size:
+            size = self.controller.batch_size
+            self.queue.put(self.buffer[:size])
+            del self.buffer[:size]
+
+    def close(self):
+        """ Wait for all the documents to be written. Return the
+        created shas.
+        """
+        if self.buffer:
+            self.queue.put(self.buffer)
+            self.buffer = []
+        for _ in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        self.commits.refresh()
+        elapsed = time.time() - self.start
+        logger.info("Bulk writers created %s commits in %.1fs "
+                    "(%.0f commits/s, concurrency %s, batch size %s)" % (
+                        len(self.created), elapsed,
+                        len(self.created) / elapsed if elapsed else 0,
+                        self.controller.concurrency,
+                        self.controller.batch_size))
+        if self.errors:
+            raise BulkIndexError(
+                "%i document(s) failed to index." % len(self.errors),
+                self.errors)
+        return self.created
+
+    def abort(self):
+        """ Stop the writers without writing the pending documents
+        """
+        self.buffer = []
+        while True:
+            try:
+                self.queue.get_nowait()
+            except queue.Empty:
+                break
+        for _ in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+
+    def work(self):
+        while True:
+            batch = self.queue.get()
+            if batch is None:
+                return
+            try:
+                self.write(batch)
+            except Exception as e:
+                logger.exception("Unable to write commits")
+                with self.lock:
+                    self.errors.extend(
+                        {'_id': c['sha'], 'error': str(e)} for c in batch)
+
+    def write(self, batch):
+        attempt = 0
+        while batch:
+            self.controller.acquire()
+            start = time.time()
+            created, rejected, errors = [], [], []
+            try:
+                created, rejected, errors = self.commits.bulk_create(batch)
+            except TransportError as e:
+                if e.status_code != 429:
+                    raise
+                rejected = batch
+            finally:
+                latency = time.time() - start
+                self.controller.release(latency, len(created), len(rejected))
+                metrics.record_bulks(
+                    [(latency, len(created), len(rejected))])
+            with self.lock:
+                self.created.extend(created)
+                self.errors.extend(errors)
+            if self.on_created and created:
+                self.on_created(created)
+            if not rejected:
+                return
+            attempt += 1
+            if attempt > self.max_retries:
+                with self.lock:
+                    self.errors.extend(
+                        {'_id': c['sha'],
+                         'error': 'rejected after %s retries' % (
+                             self.max_retries)} for c in rejected)
+                return
+            backoff = min(self.max_backoff,
+                          self.initial_backoff * 2 ** (attempt - 1))
+            logger.info("%s commits rejected by the cluster, retry in "
+                        "%ss" % (len(rejected), backoff))
+            time.sleep(backoff)
+            batch = rejected
+
+
+def run(pool, func, options, writer, max_inflight):
+    """ Extract the commits of each item of options with func in the
+    workers pool and index them with the writer. At most max_inflight
+    items are extracted and not yet handed to the writer. Return the
+    created shas.
+    """
+    stopped = threading.Event()
+    inflight = threading.Semaphore(max_inflight)
+
+    def feed():
+        # Run by the task handler thread of the pool
+        for option in options:
+            inflight.acquire()
+            if stopped.is_set():
+                return
+            yield option
+    try:
+        for cmts in pool.imap_unordered(func, feed()):
+            writer.put(cmts)
+            inflight.release()
+    except Exception:
+        # Unblock the task handler of the pool as it is shared
+        stopped.set()
+        inflight.release()
+        writer.abort()
+        raise
+    return writer.close()
@@ -0,0 +1,150 @@
+# Copyright 2016, Fabien Boucher
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+""" Adaptive polling of the repositories.
+
+Each poll of a ref (the ls-remote of its repository) is recorded in the
+indexer state store with whether the ref had to be indexed. A ref that
+had to be indexed is polled again after indexer_poll_min_interval, the
+polling interval of a ref that did not move is multiplied by
+indexer_poll_backoff up to indexer_poll_max_interval. A repository is
+due as soon as one of its refs is due. The refs never polled (never
+indexed or just added to the projects definition) are due immediately
+and their repositories are processed first. A repository that could not
+be fetched stays due.
+"""
+
+import time
+import logging
+
+from pecan import conf
+
+from repoxplorer.indexer.git import state_store
+
+logger = logging.getLogger(__name__)
+
+# Defaults of indexer_poll_min_interval and indexer_poll_max_interval
+MIN_INTERVAL = 300
+MAX_INTERVAL = 24 * 3600
+# Default of indexer_poll_backoff
+BACKOFF = 2
+
+
+def is_enabled():
+    return getattr(conf, 'indexer_adaptive_polling', False)
+
+
+def get_ref_id(ref):
+    """ Return the ref id (see RepoIndexer.set_branch) of a ref of the
+    projects definition.
+    """
+    return '%s:%s:%s' % (ref['uri'], ref['name'], ref['branch'])
+
+
+class PollingSchedule(object):
+    """ Select the repository jobs (scheduler.RepoJob) due for a poll
+    and record the outcome of their polls.
+    """
+    def __init__(self, state=None):
+        self.state = state or state_store.get_store()
+        self.min_interval = getattr(
+            conf, 'indexer_poll_min_interval', MIN_INTERVAL)
+        self.max_interval = max(getattr(
+            conf, 'indexer_poll_max_interval', MAX_INTERVAL),
+            self.min_interval)
+        self.backoff = max(getattr(conf, 'indexer_poll_backoff', BACKOFF), 1)
+
+    def get_next_due(self, job, schedule):
+        """ Return the time the earliest ref of job is due, 0 if one of
+        its refs was never polled.
+        """
+        dues = []
+        for ref, _ in job.refs:
+            entry = schedule.get(get_ref_id(ref))
+            if entry is None:
+                return 0
+            dues.append(entry['next_due'])
+        return min(dues) if dues else 0
+
+    def select(self, jobs, now=None):
+        """ Return the jobs due at now, the never polled jobs first then
+        the most overdue ones.
+        """
+        now = now or time.time()
+        schedule = self.state.get_schedule()
+        due = []
+        for job in jobs:
+            next_due = self.get_next_due(job, schedule)
+            if next_due <= now:
+                due.append((next_due, job))
+        due.sort(key=lambda d: d[0])
+        logger.info("%s repositories due for a poll out of %s" % (
+            len(due), len(jobs)))
+        return [job for _, job in due]
+
+    def get_interval(self, entry, changed):
+        if changed or entry is None:
+            return self.min_interval
+        return max(min(entry['interval'] * self.backoff, self.max_interval),
+                   self.min_interval)
+
+    def record(self, jobs, now=None):
+        """ Record the polls of the refs of the jobs. The refs to index
+        found by the fetch of a job are in its changed attribute. The
+        schedule of a job whose fetch failed is left unchanged so it is
+        polled again by the next cycle.
+        """
+        now = now or time.time()
+        schedule = self.state.get_schedule()
+        updates = {}
+        for job in jobs:
+            if job.failed:
+                continue
+            for ref, _ in job.refs:
+                ref_id = get_ref_id(ref)
+                entry = schedule.get(ref_id)
+                changed = ref_id in job.changed
+                interval = self.get_interval(entry, changed)
+                updates[ref_id] = {
+                    'interval': interval,
+                    'next_due': now + interval,
+                    'polls': (entry['polls'] if entry else 0) + 1,
+                    'changes': (entry['changes'] if entry else 0) + changed,
+                    'last_poll': now,
+                    'last_change': now if changed else (
+                        entry['last_change'] if entry else None),
+                }
+        self.state.set_schedule(updates)
+
+    def summary(self, jobs, now=None):
+        """ Return the schedule of the refs of the jobs with the time
+        before they are due (negative when overdue, None when never
+        polled) and the durations of their last runs.
+        """
+        now = now or time.time()
+        schedule = self.state.get_schedule()
+        runs = self.state.get_runs()
+        summary = {}
+        for job in jobs:
+            for ref, _ in job.refs:
+                ref_id = get_ref_id(ref)
+                entry = dict(schedule.get(ref_id) or {})
+                entry['due_in'] = (
+                    entry['next_due'] - now if entry else None)
+                run = runs.get(ref_id, {})
+                for key in ('runs', 'errors', 'last_duration',
+                            'total_duration'):
+                    entry[key] = run.get(key)
+                summary[ref_id] = entry
+        return summary
@@ -0,0 +1,158 @@
+# Copyright 2016, Fabien Boucher
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+""" Objects pools shared by the repositories of git_store.
+
+Forks and mirrors of a repository declare the same object-pool in the
+projects definition (or are grouped by root commit when
+indexer_object_pools_auto is set). Their bare repositories borrow the
+objects of a pool repository through git alternates:
+
+- the fetches of a member only download the objects missing from the
+  pool as the refs of the pool are advertised as known,
+- the pool maintenance task (see maintenance.py) fetches the refs of a
+  member into the pool, under refs/members/<member id>/, then repacks
+  the member without the objects now found in the pool.
+
+Pools are never pruned, an object of a pool may be used by any member.
+"""
+
+import os
+import re
+import hashlib
+import logging
+import subprocess
+
+from pecan import conf
+
+logger = logging.getLogger(__name__)
+
+POOLS_DIR = '.pools'
+
+
+def git(path, *args):
+    process = subprocess.run(
+        ('git',) + args, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+        cwd=path)
+    if process.returncode != 0:
+        logger.debug(process.stderr)
+        raise Exception('%s exited with code %s' % (
+            ['git'] + list(args), process.returncode))
+    return process.stdout.decode(errors='replace')
+
+
+def is_auto():
+    return getattr(conf, 'indexer_object_pools_auto', False)
+
+
+def get_pool_path(pool_id):
+    return os.path.join(
+        conf.git_store, POOLS_DIR,
+        re.sub(r'[^A-Za-z0-9_.\-]', '_', pool_id) + '.git')
+
+
+def get_member_id(path):
+    return hashlib.sha1(
+        os.path.relpath(path, conf.git_store).encode()).hexdigest()
+
+
+def get_alternates_path(path):
+    return os.path.join(path, 'objects', 'info', 'alternates')
+
+
+def get_pool(path):
+    """ Return the path of the pool of the repository or None.
+    """
+    alternates = get_alternates_path(path)
+    if not os.path.isfile(alternates):
+        return None
+    with open(alternates) as fd:
+        for line in fd.read().splitlines():
+            if line.startswith(os.path.join(conf.git_store, POOLS_DIR)):
+                return os.path.dirname(line.rstrip('/'))
+    return None
+
+
+def init_pool(pool_id):
+    pool = get_pool_path(pool_id)
+    if not os.path.isdir(os.path.join(pool, 'objects')):
+        os.makedirs(pool, exist_ok=True)
+        git(pool, 'init', '-q', '--bare', '.')
+        # Never garbage collected, objects may be used by any member
+        git(pool, 'config', 'gc.auto', '0')
+        git(pool, 'config', 'gc.pruneExpire', 'never')
+    return pool
+
+
+def join_pool(path, pool_id):
+    """ Make the repository borrow the objects of the pool. A repository
+    never changes of pool as it may have dropped objects found in the
+    pool. Return the path of the pool of the repository.
+    """
+    pool = get_pool(path)
+    if pool:
+        if pool != get_pool_path(pool_id):
+            logger.warning("%s already uses the objects pool %s" % (
+                path, pool))
+        return pool
+    pool = init_pool(pool_id)
+    os.makedirs(os.path.dirname(get_alternates_path(path)), exist_ok=True)
+    with open(get_alternates_path(path), 'a') as fd:
+        fd.write(os.path.join(pool, 'objects') + '\n')
+    logger.info("%s joined the objects pool %s" % (path, pool_id))
+    return pool
+
+
+def is_poolable(path):
+    """ The refs of shallow and partial clones cannot be fetched into
+    a pool.
+    """
+    if os.path.isfile(os.path.join(path, 'shallow')):
+        return False
+    try:
+        return not git(path, 'config', '--get',
+                       'remote.origin.promisor').strip() == 'true'
+    except Exception:
+        return True
+
+
+def get_root_pool_id(path):
+    """ Return a pool id shared by the repositories of the same
+    history, based on their root commits, or None.
+    """
+    roots = git(path, 'rev-list', '--max-parents=0', '--branches').split()
+    if not roots:
+        return None
+    return 'root-%s' % min(roots)
+
+
+def sync_member(path):
+    """ Fetch the branches and tags of a member into its pool, joining
+    the pool of its root commit when indexer_object_pools_auto is set.
+    The member must then be repacked with -l to drop the objects found
+    in the pool. Return the path of the pool or None if the repository
+    is not in a pool.
+    """
+    pool = get_pool(path)
+    if not pool and is_auto() and is_poolable(path):
+        pool_id = get_root_pool_id(path)
+        if pool_id:
+            pool = join_pool(path, pool_id)
+    if not pool or not is_poolable(path):
+        return None
+    member = get_member_id(path)
+    git(pool, 'fetch', '-q', '--prune', '--no-tags', path,
+        '+refs/heads/*:refs/members/%s/heads/*' % member,
+        '+refs/tags/*:refs/members/%s/tags/*' % member)
+    return pool
@@ -0,0 +1,274 @@
+# Copyright 2016, Fabien Boucher
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+""" Offline rebuild of the commits and tags indexes.
+
+The refs already fetched in git_store are indexed, without any remote
+operation (no ls-remote nor fetch), into new indexes named
+<elasticsearch_index>-rebuild-<date> and <...>-tags. The new indexes
+are then published by pointing the elasticsearch_index and
+<elasticsearch_index>-tags aliases to them, so the API and the indexer
+keep using the same names. Indexes created before the first rebuild
+are replaced by the aliases.
+
+The indexed tips, the refs waiting for their line statistics and the
+history horizons are kept aside in a state store during the rebuild
+and replace the ones of the previous indexes when the aliases are
+swapped. The horizons start from the published ones so the history
+already backfilled past index-since is indexed again. The imports
+checkpoints are only kept in memory as a failed rebuild is not
+published.
+"""
+
+import os
+import time
+import logging
+
+from pecan import conf
+
+from repoxplorer import index
+from repoxplorer.index.tags import Tags
+from repoxplorer.index.commits import Commits
+from repoxplorer.indexer.git import catalog
+from repoxplorer.indexer.git import checkpoints
+from repoxplorer.indexer.git import indexer
+from repoxplorer.indexer.git import pipeline
+from repoxplorer.indexer.git import scheduler
+from repoxplorer.indexer.git import state_store
+
+logger = logging.getLogger(__name__)
+
+REBUILD_SUFFIX = 'rebuild'
+# State describing the indexes, replaced when the new indexes are published
+REBUILT_STATE = ('indexed_tips', 'stats_pending', 'horizons')
+# Amount of bulk writers when indexer_bulk_writers is not set
+REBUILD_BULK_WRITERS = 4
+
+
+def get_local_refs(path):
+    """ Return the branches and tags of the repository in the format of
+    RepoIndexer.get_refs (git ls-remote): a [sha, name] couple per ref
+    and the peeled commit of the annotated tags as [sha, name^{}].
+    """
+    out = indexer.run([
+        'git', 'for-each-ref',
+        '--format=%(objectname) %(refname) %(*objectname)',
+        'refs/heads/', 'refs/tags/'], path)
+    refs = []
+    for line in out.splitlines():
+        fields = line.split()
+        refs.append(fields[:2])
+        if len(fields) == 3:
+            refs.append([fields[2], '%s^{}' % fields[1]])
+    return refs
+
+
+def swap_alias(ic, alias, name):
+    """ Atomically point alias to the index name. The indexes previously
+    pointed by alias are deleted, as is an index named alias. Return the
+    deleted indexes.
+    """
+    actions = [{'add': {'index': name, 'alias': alias}}]
+    previous = []
+    if ic.exists_alias(name=alias):
+        previous = [i for i in ic.get_alias(name=alias) if i != name]
+        actions.extend(
+            {'remove': {'index': i, 'alias': alias}} for i in previous)
+    elif ic.exists(index=alias):
+        actions.append({'remove_index': {'index': alias}})
+        previous = [alias]
+    ic.update_aliases(body={'actions': actions})
+    for i in previous:
+        if i != alias:
+            ic.delete(index=i)
+    return previous
+
+
+class RebuildJob(scheduler.RepoJob):
+    """ Index the refs of a repository of git_store into the indexes
+    of con without any remote operation. The refs are always indexed
+    as the new indexes start empty.
+    """
+    def __init__(self, name, uri, extract_workers=0, con=None,
+                 state=None):
+        super(RebuildJob, self).__init__(name, uri, extract_workers)
+        self.con = con
+        self.state = state
+
+    def fetch(self, report):
+        self.to_index = []
+        self.to_backfill = []
+        self.to_extend = []
+        path = indexer.get_repo_path(self.name, self.uri)
+        if not os.path.isdir(path) or not indexer.has_refs(path):
+            logger.warning("Repository %s is not in the git store, "
+                           "skip it" % self.base_id)
+            report.incr('repos_missing')
+            return False
+        with report.stage('ls-local'):
+            refs = get_local_refs(path)
+        for ref, meta_ref in self.refs:
+            r = indexer.RepoIndexer(
+                ref['name'],
+                ref['uri'],
+                parsers=ref['parsers'],
+                con=self.con,
+                meta_ref=meta_ref,
+                index_since=ref.get('index-since'),
+                pool=ref.get('object-pool'))
+            # The commits catalog and the indexer state describe the
+            # published indexes
+            r.catalog = None
+            r.checkpoints = checkpoints.ImportCheckpoints(':memory:')
+            r.state = self.state
+            r.refs = refs
+            r.get_heads()
+            if ref.get('index-tags') is True:
+                r.get_tags()
+            if not [head for head in r.heads if
+                    head[1] == indexer.get_branch_ref(ref['branch'])]:
+                logger.warning(
+                    "Repository %s does not have the requested branch "
+                    "%s in the git store" % (r.base_id, ref['branch']))
+                report.incr('refs_missing')
+                continue
+            r.set_branch(ref['branch'])
+            self.to_index.append((ref, r))
+        return bool(self.to_index)
+
+
+class IndexRebuilder(object):
+    """ Rebuild the commits and tags indexes from git_store then
+    publish them with swap.
+    """
+    def __init__(self, name=None):
+        self.alias = (getattr(conf, 'elasticsearch_index', None) or
+                      'repoxplorer')
+        self.name = name or '%s-%s-%s' % (
+            self.alias, REBUILD_SUFFIX,
+            time.strftime('%Y%m%d%H%M%S', time.gmtime()))
+        self.state = state_store.StateStore(os.path.join(
+            conf.db_cache_path, '%s.%s' % (state_store.STATE_FILE,
+                                           self.name)))
+        self.state.replace(state_store.get_store().path, ('horizons',))
+        self.con = index.Connector(index=self.name)
+        self.tags_con = index.Connector(
+            index=self.name, index_suffix='tags')
+        # Create the mappings even if nothing is indexed
+        Commits(self.con)
+        Tags(self.tags_con)
+
+    def get_indexes(self):
+        """ Return the (alias, connector) couples of the new indexes
+        """
+        return [(self.alias, self.con),
+                ('%s-tags' % self.alias, self.tags_con)]
+
+    def get_replicas(self, ic, alias):
+        """ Return the amount of replicas of the published index or None
+        """
+        if not ic.exists(index=alias):
+            return None
+        settings = list(ic.get_settings(index=alias).values())[0]
+        return settings['settings']['index'].get('number_of_replicas')
+
+    def tune(self):
+        """ Configure the indexer for the rebuild throughput: the new
+        indexes are only refreshed at the end and the line statistics
+        are computed in a single pass. The extraction workers write to
+        the published index so the commits are written by the bulk
+        writers of the main process.
+        """
+        conf['indexer_ingest_mode'] = True
+        conf['indexer_ingest_refresh'] = 'run'
+        conf['indexer_two_phase_min_commits'] = 0
+        if not pipeline.is_enabled():
+            conf['indexer_bulk_writers'] = REBUILD_BULK_WRITERS
+
+    def start(self):
+        for _, con in self.get_indexes():
+            con.ic.put_settings(index=con.index, body={'index': {
+                'refresh_interval': '-1', 'number_of_replicas': 0}})
+
+    def finish(self, report):
+        """ Restore the refresh and the replicas of the new indexes and
+        force merge them.
+        """
+        for alias, con in self.get_indexes():
+            con.ic.put_settings(index=con.index, body={'index': {
+                'refresh_interval': None,
+                'number_of_replicas': self.get_replicas(con.ic, alias)}})
+            con.ic.refresh(index=con.index)
+            with report.stage('forcemerge'):
+                con.ic.forcemerge(
+                    index=con.index,
+                    max_num_segments=getattr(
+                        conf, 'indexer_ingest_max_segments', 1),
+                    request_timeout=3600)
+
+    def run(self, jobs, workers=1, report=None):
+        """ Index the refs of the jobs (scheduler.RepoJob) into the new
+        indexes, workers repositories at a time. Return the report.
+        """
+        report = report or scheduler.CycleReport()
+        self.tune()
+        rebuild_jobs = []
+        for job in jobs:
+            rebuild_job = RebuildJob(
+                job.name, job.uri, job.extract_workers, self.con,
+                self.state)
+            rebuild_job.refs = list(job.refs)
+            rebuild_jobs.append(rebuild_job)
+        logger.info("Start rebuilding %s refs of %s repositories into "
+                    "index %s" % (sum(len(job.refs) for job in jobs),
+                                  len(jobs), self.name))
+        self.start()
+        # No remote operations, the amount of jobs per host is not limited
+        scheduler.RepoScheduler(
+            workers=workers, max_per_host=workers).run(rebuild_jobs, report)
+        self.finish(report)
+        report.stop()
+        amount = self.con.es.count(index=self.name)['count']
+        report.gauge('commits', amount)
+        report.gauge('commits_per_second', round(
+            amount / report.wall_time if report.wall_time else 0))
+        logger.info("Index %s rebuilt with %s commits in %.1fs (%.0f "
+                    "commits/s)" % (self.name, amount, report.wall_time,
+                                    report.gauges['commits_per_second']))
+        return report
+
+    def swap(self):
+        """ Publish the new indexes and their indexer state
+        """
+        for alias, con in self.get_indexes():
+            deleted = swap_alias(con.ic, alias, con.index)
+            logger.info("Alias %s swapped to %s, deleted indexes: %s" % (
+                alias, con.index, ", ".join(deleted) or "none"))
+        self.state.flush()
+        state_store.get_store().replace(self.state.path, REBUILT_STATE)
+        self.discard_state()
+        if getattr(conf, 'indexer_commits_catalog', False):
+            catalog.CommitsCatalog().rebuild(Commits(index.Connector()))
+
+    def discard_state(self):
+        self.state.close()
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.isfile(self.state.path + suffix):
+                os.unlink(self.state.path + suffix)
+
+    def discard(self):
+        """ Remove the indexer state of an unpublished rebuild. The new
+        indexes are kept for inspection.
+        """
+        self.discard_state()
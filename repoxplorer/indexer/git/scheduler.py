@@ -0,0 +1,433 @@
+# Copyright 2016, Fabien Boucher
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+import time
+import logging
+import threading
+
+from collections import deque
+from collections import Counter
+from contextlib import contextmanager
+from urllib.parse import urlparse
+from concurrent.futures import ThreadPoolExecutor
+
+from repoxplorer.indexer.git import indexer
+from repoxplorer.indexer.git import metrics
+from repoxplorer.indexer.git import state_store
+
+logger = logging.getLogger(__name__)
+
+
+def get_host(uri):
+    """ Return the remote host of a Git uri. The scp like syntax
+    (user@host:path) is supported. Local repositories share the
+    'localhost' host.
+    """
+    host = urlparse(uri).hostname
+    if host:
+        return host
+    if '://' not in uri and ':' in uri.split('/')[0]:
+        return uri.split(':')[0].split('@')[-1]
+    return 'localhost'
+
+
+def get_since(horizons):
+    """ Return the oldest of the horizons of the refs of a repository
+    or None if one of the refs needs the full history.
+    """
+    horizons = list(horizons)
+    if horizons and all(horizons):
+        return min(horizons)
+    return None
+
+
+class CycleReport(object):
+    """ Collect the wall time of an indexer cycle, the busy time spent
+    and the failures in each stage. Stages can overlap as repositories
+    are processed concurrently so the sum of busy times can exceed the
+    wall time. The stages, counters and gauges are also recorded in the
+    metrics of the process.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.start = time.time()
+        self.end = None
+        self.stages = {}
+        self.failures = Counter()
+        self.counters = Counter()
+        self.gauges = {}
+
+    @contextmanager
+    def stage(self, name):
+        start = time.time()
+        failed = False
+        try:
+            yield
+        except Exception:
+            failed = True
+            raise
+        finally:
+            elapsed = time.time() - start
+            with self.lock:
+                busy, count = self.stages.get(name, (0.0, 0))
+                self.stages[name] = (busy + elapsed, count + 1)
+                if failed:
+                    self.failures[name] += 1
+            metrics.observe('stage_seconds', elapsed, stage=name)
+            if failed:
+                metrics.incr('failures', stage=name)
+
+    def incr(self, name, value=1):
+        with self.lock:
+            self.counters[name] += value
+        metrics.incr(name, value)
+
+    def gauge(self, name, value):
+        with self.lock:
+            self.gauges[name] = value
+        metrics.gauge(name, value)
+
+    def stop(self):
+        self.end = time.time()
+
+    @property
+    def wall_time(self):
+        return (self.end or time.time()) - self.start
+
+    def summary(self):
+        return {
+            'wall_time': self.wall_time,
+            'stages': dict(
+                (name, {'busy_time': busy, 'count': count,
+                        'failures': self.failures[name]})
+                for name, (busy, count) in self.stages.items()),
+            'counters': dict(self.counters),
+            'gauges': dict(self.gauges),
+        }
+
+    def log(self):
+        logger.info("Indexer cycle done in %.1fs" % self.wall_time)
+        for name, (busy, count) in sorted(self.stages.items()):
+            logger.info("Stage %-10s busy %8.1fs over %s runs" % (
+                name, busy, count))
+        for name, value in sorted(self.counters.items()):
+            logger.info("Counter %-20s %s" % (name, value))
+        for name, value in sorted(self.gauges.items()):
+            logger.info("Gauge   %-20s %s" % (name, value))
+
+
+class RepoJob(object):
+    """ Index the refs of a Git repository. The job is run in two
+    stages, fetch then index, so the scheduler can overlap the network
+    bound stage of a repository with the indexing of another one.
+    """
+    def __init__(self, name, uri, extract_workers=0):
+        self.name = name
+        self.uri = uri
+        self.base_id = '%s:%s' % (uri, name)
+        self.host = get_host(uri)
+        self.extract_workers = extract_workers
+        self.refs = []
+        self.to_index = []
+        self.to_backfill = []
+        self.to_extend = []
+        self.horizons = {}
+        # Refs found to index by the last fetch
+        self.changed = set()
+        # The last fetch could not reach the repository
+        self.failed = False
+
+    def __str__(self):
+        return self.base_id
+
+    def add_ref(self, ref, meta_ref=None):
+        self.refs.append((ref, meta_ref))
+
+    def copy(self):
+        """ Return a new job of the same refs, with its own fetch state
+        """
+        job = RepoJob(self.name, self.uri, self.extract_workers)
+        for ref, meta_ref in self.refs:
+            job.add_ref(ref, meta_ref)
+        return job
+
+    def fetch(self, report):
+        """ Take a single snapshot of the remote refs and fetch, with
+        a single command, the branches that need to be indexed. Return
+        True if there is something to index.
+        """
+        self.to_index = []
+        self.to_backfill = []
+        self.to_extend = []
+        self.changed = set()
+        self.failed = False
+        indexers = []
+        for ref, meta_ref in self.refs:
+            indexers.append(indexer.RepoIndexer(
+                ref['name'],
+                ref['uri'],
+                parsers=ref['parsers'],
+                meta_ref=meta_ref,
+                index_since=ref.get('index-since'),
+                pool=ref.get('object-pool')))
+        first = indexers[0]
+        self.horizons = {}
+        try:
+            with report.stage('init'):
+                first.git_init()
+        except Exception as e:
+            logger.warning("Unable to init the repository %s: %s" % (
+                           self.base_id, e))
+            report.incr('errors')
+            self.failed = True
+            return False
+        try:
+            with report.stage('ls-remote'):
+                first.get_refs()
+        except Exception as e:
+            logger.warning("Unable to access the repository %s: %s" % (
+                           self.base_id, e))
+            report.incr('errors')
+            self.failed = True
+            return False
+        candidates = []
+        for (ref, meta_ref), r in zip(self.refs, indexers):
+            r.refs = first.refs
+            r.get_heads()
+            if ref.get('index-tags') is True:
+                r.get_tags()
+            if not [head for head in r.heads if
+                    head[1].endswith(ref['branch'])]:
+                logger.warning(
+                    "Repository %s does not have the "
+                    "requested branch %s" % (r.base_id, ref['branch']))
+                continue
+            r.set_branch(ref['branch'])
+            self.horizons[r.ref_id] = r.horizon
+            candidates.append((ref, r))
+        # The upstream tips of the snapshot are compared with the
+        # indexed tips of all the refs at once
+        with report.stage('precheck'):
+            moved = indexer.get_moved_refs([r for _, r in candidates])
+        for ref, r in candidates:
+            if r.ref_id not in moved:
+                logger.info("Repository branch fully indexed %s" % (
+                    r.ref_id))
+                report.incr('refs_up_to_date')
+                if r.is_stats_pending():
+                    self.to_backfill.append(r)
+                if r.is_horizon_extensible():
+                    self.to_extend.append(r)
+                continue
+            logger.info("Start indexing repository branch %s" % r.ref_id)
+            self.to_index.append((ref, r))
+            self.changed.add(r.ref_id)
+        if not self.to_index:
+            return bool(self.to_backfill or self.to_extend)
+        branches = [r.branch for _, r in self.to_index]
+        tags = any(ref.get('index-tags') is True for ref, _ in self.to_index)
+        try:
+            size = indexer.get_packs_size(first.local)
+            with report.stage('fetch'):
+                first.git_fetch_branches(
+                    branches, tags=tags,
+                    since=get_since(self.horizons.values()))
+            report.incr('bytes_fetched', max(
+                indexer.get_packs_size(first.local) - size, 0))
+        except Exception as e:
+            logger.warning("Unable to fetch repository "
+                           "branches %s of %s: %s" % (
+                               ",".join(branches), self.base_id, e))
+            report.incr('errors')
+            self.failed = True
+            self.to_index = []
+            return bool(self.to_backfill or self.to_extend)
+        return True
+
+    def index(self, report):
+        for ref, r in self.to_index:
+            start = time.time()
+            try:
+                with report.stage('index'):
+                    if r.resume_import(self.extract_workers):
+                        report.incr('imports_resumed')
+                with report.stage('list-shas'):
+                    r.git_get_commit_obj()
+                with report.stage('diff'):
+                    r.get_current_commits_indexed()
+                    r.compute_to_index_to_delete()
+                with report.stage('index'):
+                    r.index(self.extract_workers)
+                report.incr('refs_indexed')
+                r.state.record_run(r.ref_id, time.time() - start)
+            except Exception as e:
+                logger.warning("Unable to index repository "
+                               "branch %s: %s" % (r.ref_id, e))
+                logger.exception("Exception is:")
+                report.incr('errors')
+                r.state.record_run(r.ref_id, time.time() - start, str(e))
+                continue
+            try:
+                with report.stage('tags'):
+                    self.index_tags(ref, r)
+            except Exception as e:
+                logger.warning("Unable to index repository tags "
+                               "%s: %s" % (r.base_id, e))
+                report.incr('errors')
+                continue
+            if r.is_stats_pending():
+                self.to_backfill.append(r)
+        for r in self.to_backfill:
+            try:
+                with report.stage('backfill'):
+                    report.incr('stats_backfilled',
+                                r.backfill_stats(self.extract_workers))
+            except Exception as e:
+                logger.warning("Unable to compute the line statistics "
+                               "of %s: %s" % (r.ref_id, e))
+                report.incr('errors')
+        # Low priority, only the refs already up to date extend their
+        # horizon, by one slice per run
+        for r in self.to_extend:
+            try:
+                self.horizons[r.ref_id] = r.get_extended_horizon()
+                with report.stage('horizon'):
+                    report.incr('horizon_backfilled', r.extend_horizon(
+                        self.extract_workers,
+                        get_since(self.horizons.values())))
+                self.horizons[r.ref_id] = r.horizon
+            except Exception as e:
+                logger.warning("Unable to extend the horizon "
+                               "of %s: %s" % (r.ref_id, e))
+                report.incr('errors')
+        self.to_index = []
+        self.to_backfill = []
+        self.to_extend = []
+
+    def index_tags(self, ref, r):
+        if ref.get('index-tags') is True:
+            r.index_tags()
+        else:
+            # Make sure to wipe tags for this repo if index-tags flag
+            # is False.
+            tags = r.t.get_tags([r.base_id])
+            ids = [t['_id'] for t in tags]
+            if ids:
+                logger.info(
+                    "Found %s tags for %s but index-tags is False. "
+                    "Wipe tags ..." % (len(ids), r.base_id))
+                r.t.del_tags(ids)
+
+
+class RepoLocks(object):
+    """ Locks of the repositories by base_id. The schedulers sharing
+    the locks never process a repository concurrently.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.locks = {}
+
+    def get(self, base_id):
+        with self.lock:
+            return self.locks.setdefault(base_id, threading.Lock())
+
+
+class RepoScheduler(object):
+    """ Run repository jobs concurrently. At most workers jobs
+    are fetched and workers jobs are indexed at the same time, and at
+    most max_per_host jobs are fetched from the same remote host.
+    A job is fetched ahead while others are being indexed but no more
+    than 2 * workers jobs are in flight. With locks (RepoLocks) a job
+    holds the lock of its repository from its fetch to the end of its
+    indexing.
+    """
+    def __init__(self, workers=1, max_per_host=2, locks=None):
+        self.workers = max(workers, 1)
+        self.max_per_host = max(max_per_host, 1)
+        self.locks = locks
+        self.cond = threading.Condition()
+        self.hosts = Counter()
+        self.inflight = 0
+
+    def next_job(self, pending):
+        for job in pending:
+            if self.hosts[job.host] < self.max_per_host:
+                return job
+
+    def done(self, job=None):
+        with self.cond:
+            if job:
+                self.hosts[job.host] -= 1
+            else:
+                self.inflight -= 1
+            self.cond.notify_all()
+
+    def run(self, jobs, report=None):
+        report = report or CycleReport()
+        pending = deque(jobs)
+        fetchers = ThreadPoolExecutor(self.workers)
+        indexers = ThreadPoolExecutor(self.workers)
+
+        def release(job):
+            if self.locks:
+                self.locks.get(job.base_id).release()
+            self.done()
+
+        def index(job):
+            try:
+                job.index(report)
+            except Exception:
+                logger.exception("Unexpected error when indexing %s" % job)
+            finally:
+                release(job)
+
+        def fetch(job):
+            to_index = False
+            if self.locks:
+                self.locks.get(job.base_id).acquire()
+            try:
+                to_index = job.fetch(report)
+            except Exception:
+                logger.exception("Unexpected error when fetching %s" % job)
+                job.failed = True
+            finally:
+                self.done(job)
+            if to_index:
+                indexers.submit(index, job)
+            else:
+                release(job)
+
+        try:
+            while True:
+                with self.cond:
+                    if not pending and not self.inflight:
+                        break
+                    job = None
+                    if pending and self.inflight < 2 * self.workers:
+                        job = self.next_job(pending)
+                    if job is None:
+                        self.cond.wait()
+                        continue
+                    pending.remove(job)
+                    self.hosts[job.host] += 1
+                    self.inflight += 1
+                report.incr('repos')
+                fetchers.submit(fetch, job)
+        finally:
+            fetchers.shutdown()
+            indexers.shutdown()
+            # The seen refs and the runs of the cycle are written at once
+            state_store.flush()
+            report.stop()
+        return report
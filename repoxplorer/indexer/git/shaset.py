@@ -0,0 +1,219 @@
+# Copyright 2016, Fabien Boucher
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+""" Compact sets of commits shas.
+
+The history of a ref is held as the sorted concatenation of the binary
+shas of its commits (20 bytes per commit instead of about 100 bytes for
+a str in a Python set) and the sets are diffed by merging them. The
+shas are sorted by runs bounded by indexer_memory_cap_bytes, the runs
+above are spilled to temporary files and merged.
+"""
+
+import heapq
+import logging
+import tempfile
+import itertools
+
+from pecan import conf
+
+logger = logging.getLogger(__name__)
+
+SHA_SIZE = 20
+# Approximate memory used by a sha being sorted (bytes object and its
+# reference in the run)
+SORT_COST = 64
+MIN_RUN = 1000
+
+
+def get_memory_cap():
+    return getattr(conf, 'indexer_memory_cap_bytes', 512 * 1024 ** 2)
+
+
+def get_run_size():
+    """ Return the amount of shas sorted in memory at once. A run uses
+    at most a quarter of the memory cap.
+    """
+    return max(MIN_RUN, get_memory_cap() // 4 // SORT_COST)
+
+
+def chunks(items, size):
+    """ Yield lists of at most size shas of items
+    """
+    if isinstance(items, ShaSet):
+        for chunk in items.chunks(size):
+            yield chunk
+        return
+    items = iter(items)
+    while True:
+        chunk = list(itertools.islice(items, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def spill(run):
+    run_file = tempfile.TemporaryFile()
+    run_file.write(b''.join(run))
+    run_file.seek(0)
+    return run_file
+
+
+def read_run(run_file, width):
+    while True:
+        binary = run_file.read(width)
+        if not binary:
+            return
+        yield binary
+
+
+class ShaSet(object):
+    """ Immutable set of shas stored as the sorted concatenation of
+    their binary form. It implements the part of the set API used by
+    the indexer; the shas are iterated in hexadecimal, in sha order.
+    """
+    def __init__(self, data=b'', width=SHA_SIZE):
+        self.data = data
+        self.width = width
+
+    @classmethod
+    def from_sorted(cls, binaries, width=SHA_SIZE):
+        """ Return the ShaSet of the sorted binary shas, duplicates
+        are skipped.
+        """
+        data = bytearray()
+        last = None
+        for binary in binaries:
+            if binary != last:
+                data += binary
+                last = binary
+        return cls(bytes(data), width)
+
+    @classmethod
+    def from_iterable(cls, items, run_size=None):
+        """ Return the ShaSet of the hexadecimal shas of items. Items
+        that are not shas (ids of synthetic commits) are returned as a
+        set.
+        """
+        if isinstance(items, ShaSet):
+            return items
+        run_size = run_size or get_run_size()
+        items = iter(items)
+        width = None
+        run = []
+        runs = []
+        try:
+            for sha in items:
+                try:
+                    binary = bytes.fromhex(sha)
+                    if not binary or len(binary) != (width or len(binary)):
+                        raise ValueError(sha)
+                except (TypeError, ValueError):
+                    run.sort()
+                    known = heapq.merge(
+                        run, *[read_run(f, width) for f in runs])
+                    return set(itertools.chain(
+                        (binary.hex() for binary in known), [sha], items))
+                width = len(binary)
+                run.append(binary)
+                if len(run) >= run_size:
+                    run.sort()
+                    runs.append(spill(run))
+                    run = []
+            run.sort()
+            if runs:
+                logger.debug("Merge %s sorted runs of shas" % (
+                    len(runs) + 1))
+                run = heapq.merge(run, *[read_run(f, width) for f in runs])
+            return cls.from_sorted(run, width or SHA_SIZE)
+        finally:
+            for run_file in runs:
+                run_file.close()
+
+    def __len__(self):
+        return len(self.data) // self.width
+
+    def __bool__(self):
+        return bool(self.data)
+
+    def __iter__(self):
+        for binary in self.iter_binary():
+            yield binary.hex()
+
+    def __repr__(self):
+        return '<ShaSet of %s shas>' % len(self)
+
+    def __contains__(self, sha):
+        try:
+            binary = bytes.fromhex(sha)
+        except (TypeError, ValueError):
+            return False
+        if len(binary) != self.width:
+            return False
+        lo, hi = 0, len(self)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.get(mid) < binary:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo < len(self) and self.get(lo) == binary
+
+    def get(self, i):
+        return self.data[i * self.width:(i + 1) * self.width]
+
+    def iter_binary(self):
+        data, width = self.data, self.width
+        for i in range(0, len(data), width):
+            yield data[i:i + width]
+
+    def chunks(self, size):
+        step = size * self.width
+        for i in range(0, len(self.data), step):
+            yield [binary.hex() for binary in
+                   ShaSet(self.data[i:i + step], self.width).iter_binary()]
+
+    def merge(self, other, common):
+        """ Return the shas of self that are (common) or are not in
+        other by walking both sets in order.
+        """
+        if not isinstance(other, ShaSet):
+            other = ShaSet.from_iterable(other)
+        if not isinstance(other, ShaSet):
+            return ShaSet.from_sorted(
+                (binary for binary in self.iter_binary() if
+                 (binary.hex() in other) == common), self.width)
+        if other.width != self.width:
+            return ShaSet(width=self.width) if common else self
+        others = other.iter_binary()
+        current = next(others, None)
+        data = bytearray()
+        for binary in self.iter_binary():
+            while current is not None and current < binary:
+                current = next(others, None)
+            if (current == binary) == common:
+                data += binary
+        return ShaSet(bytes(data), self.width)
+
+    def difference(self, *others):
+        ret = self
+        for other in others:
+            ret = ret.merge(other, False)
+        return ret
+
+    def intersection(self, *others):
+        ret = self
+        for other in others:
+            ret = ret.merge(other, True)
+        return ret
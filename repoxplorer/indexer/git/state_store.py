@@ -0,0 +1,340 @@
+# Copyright 2016, Fabien Boucher
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+import os
+import time
+import pickle
+import sqlite3
+import logging
+import threading
+
+from pecan import conf
+
+from repoxplorer.indexer.git.catalog import chunks
+
+logger = logging.getLogger(__name__)
+
+STATE_FILE = 'indexer-state.sqlite'
+# Seen refs file of the previous versions migrated to the store at
+# first start
+SEEN_REFS_CACHED = 'seen-refs.cached'
+# Tables holding a row per ref
+REF_TABLES = ('seen_refs', 'indexed_tips', 'stats_pending', 'horizons',
+              'ref_runs', 'poll_schedule')
+# Columns of the polling schedule of a ref (see polling.py)
+SCHEDULE_KEYS = ('interval', 'next_due', 'polls', 'changes', 'last_poll',
+                 'last_change')
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_store():
+    """ Return the indexer state store of the process. The seen refs
+    file of the previous versions is migrated at first use.
+    """
+    global _store
+    path = os.path.join(conf.db_cache_path, STATE_FILE)
+    with _store_lock:
+        if _store is None or _store.path != path:
+            _store = StateStore(path)
+            _store.migrate(conf.db_cache_path)
+    return _store
+
+
+def flush():
+    """ Flush the state store of the process if it is opened
+    """
+    with _store_lock:
+        store = _store
+    if store is not None:
+        store.flush()
+
+
+class StateStore(object):
+    """ Transactional state of the indexer per ref: the seen refs (to
+    find the refs to clean), the last indexed tips, the refs waiting for
+    their line statistics, the history horizons and the timings and
+    errors of the runs. The last git store maintenance tasks are kept
+    per repository. The seen refs and the runs are written by batch
+    with flush, once per cycle. The store can be shared by the threads
+    and the processes of concurrent indexers.
+    """
+    def __init__(self, path=None):
+        self.path = path or os.path.join(conf.db_cache_path, STATE_FILE)
+        self.lock = threading.Lock()
+        self.seen_refs = set()
+        self.runs = []
+        self.db = sqlite3.connect(
+            self.path, timeout=60, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        with self.db:
+            self.db.execute(
+                'CREATE TABLE IF NOT EXISTS seen_refs ('
+                'ref TEXT PRIMARY KEY) WITHOUT ROWID')
+            self.db.execute(
+                'CREATE TABLE IF NOT EXISTS indexed_tips ('
+                'ref TEXT PRIMARY KEY, tip TEXT NOT NULL) WITHOUT ROWID')
+            self.db.execute(
+                'CREATE TABLE IF NOT EXISTS stats_pending ('
+                'ref TEXT PRIMARY KEY) WITHOUT ROWID')
+            self.db.execute(
+                'CREATE TABLE IF NOT EXISTS horizons ('
+                'ref TEXT PRIMARY KEY, horizon INTEGER NOT NULL) '
+                'WITHOUT ROWID')
+            self.db.execute(
+                'CREATE TABLE IF NOT EXISTS ref_runs ('
+                'ref TEXT PRIMARY KEY, runs INTEGER NOT NULL, '
+                'errors INTEGER NOT NULL, '
+                'consecutive_errors INTEGER NOT NULL, '
+                'last_run REAL NOT NULL, last_duration REAL NOT NULL, '
+                'total_duration REAL NOT NULL, last_error TEXT) '
+                'WITHOUT ROWID')
+            self.db.execute(
+                'CREATE TABLE IF NOT EXISTS poll_schedule ('
+                'ref TEXT PRIMARY KEY, interval REAL NOT NULL, '
+                'next_due REAL NOT NULL, polls INTEGER NOT NULL, '
+                'changes INTEGER NOT NULL, last_poll REAL NOT NULL, '
+                'last_change REAL) WITHOUT ROWID')
+            self.db.execute(
+                'CREATE TABLE IF NOT EXISTS maintenance ('
+                'repo TEXT NOT NULL, task TEXT NOT NULL, '
+                'last REAL NOT NULL, duration REAL NOT NULL, '
+                'PRIMARY KEY (repo, task)) WITHOUT ROWID')
+            self.db.execute(
+                'CREATE TABLE IF NOT EXISTS meta ('
+                'key TEXT PRIMARY KEY, value TEXT)')
+
+    def close(self):
+        self.db.close()
+
+    def migrate(self, path):
+        """ Import once the pickle seen refs file found in path. The
+        migrated file is renamed with a .migrated suffix, an unreadable
+        file is left in place.
+        """
+        legacy = os.path.join(path, SEEN_REFS_CACHED)
+        migrated = False
+        with self.lock, self.db:
+            # Concurrent indexers wait for the first one to migrate
+            self.db.execute('BEGIN IMMEDIATE')
+            if self.db.execute(
+                    "SELECT value FROM meta WHERE key = 'migrated'"
+                    ).fetchone():
+                return
+            if os.path.isfile(legacy):
+                try:
+                    with open(legacy, 'rb') as f:
+                        data = pickle.load(f)
+                    self.db.executemany(
+                        'INSERT OR REPLACE INTO seen_refs VALUES (?)',
+                        ((ref,) for ref in data))
+                    logger.info("Migrated %s refs from %s" % (
+                        len(data), legacy))
+                    migrated = True
+                except Exception as e:
+                    logger.error("Unable to migrate the indexer state "
+                                 "file %s: %s" % (legacy, e))
+            self.db.execute(
+                "INSERT OR REPLACE INTO meta (key, value) "
+                "VALUES ('migrated', ?)", (time.time(),))
+        if migrated:
+            os.replace(legacy, '%s.migrated' % legacy)
+
+    def add_seen_ref(self, ref):
+        with self.lock:
+            self.seen_refs.add(ref)
+
+    def get_seen_refs(self):
+        self.flush()
+        with self.lock:
+            return set(row[0] for row in self.db.execute(
+                'SELECT ref FROM seen_refs'))
+
+    def record_run(self, ref, duration, error=None):
+        """ Record the duration of the indexing of ref and its error if
+        it failed.
+        """
+        with self.lock:
+            self.runs.append((ref, time.time(), duration, error))
+
+    def get_runs(self):
+        """ Return a dict ref -> runs statistics
+        """
+        self.flush()
+        keys = ('runs', 'errors', 'consecutive_errors', 'last_run',
+                'last_duration', 'total_duration', 'last_error')
+        with self.lock:
+            return dict(
+                (row[0], dict(zip(keys, row[1:]))) for row in
+                self.db.execute('SELECT ref, %s FROM ref_runs' % (
+                    ', '.join(keys))))
+
+    def flush(self):
+        """ Write the seen refs and the runs recorded since the last
+        flush in a single transaction.
+        """
+        with self.lock:
+            if not self.seen_refs and not self.runs:
+                return
+            with self.db:
+                # The runs counters are read then updated
+                self.db.execute('BEGIN IMMEDIATE')
+                self.db.executemany(
+                    'INSERT OR IGNORE INTO seen_refs (ref) VALUES (?)',
+                    ((ref,) for ref in self.seen_refs))
+                for ref, last_run, duration, error in self.runs:
+                    self.add_run(ref, last_run, duration, error)
+            self.seen_refs = set()
+            self.runs = []
+
+    def add_run(self, ref, last_run, duration, error):
+        row = self.db.execute(
+            'SELECT runs, errors, consecutive_errors, total_duration '
+            'FROM ref_runs WHERE ref = ?', (ref,)).fetchone()
+        runs, errors, consecutive_errors, total_duration = (
+            row or (0, 0, 0, 0.0))
+        if error is not None:
+            errors += 1
+            consecutive_errors += 1
+        else:
+            consecutive_errors = 0
+        self.db.execute(
+            'INSERT OR REPLACE INTO ref_runs (ref, runs, errors, '
+            'consecutive_errors, last_run, last_duration, total_duration, '
+            'last_error) VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+            (ref, runs + 1, errors, consecutive_errors, last_run,
+             duration, total_duration + duration, error))
+
+    def get_indexed_tip(self, ref):
+        with self.lock:
+            row = self.db.execute(
+                'SELECT tip FROM indexed_tips WHERE ref = ?',
+                (ref,)).fetchone()
+        return row[0] if row else None
+
+    def get_indexed_tips(self, refs):
+        """ Return a dict ref -> indexed tip of the refs having one
+        """
+        ret = {}
+        with self.lock:
+            for chunk in chunks(refs):
+                ret.update(self.db.execute(
+                    'SELECT ref, tip FROM indexed_tips WHERE ref IN (%s)' % (
+                        ','.join('?' * len(chunk))), chunk))
+        return ret
+
+    def set_indexed_tip(self, ref, tip):
+        with self.lock, self.db:
+            if tip is None:
+                self.db.execute(
+                    'DELETE FROM indexed_tips WHERE ref = ?', (ref,))
+            else:
+                self.db.execute(
+                    'INSERT OR REPLACE INTO indexed_tips (ref, tip) '
+                    'VALUES (?, ?)', (ref, tip))
+
+    def is_stats_pending(self, ref):
+        with self.lock:
+            return bool(self.db.execute(
+                'SELECT 1 FROM stats_pending WHERE ref = ?',
+                (ref,)).fetchone())
+
+    def set_stats_pending(self, ref, pending):
+        with self.lock, self.db:
+            if pending:
+                self.db.execute(
+                    'INSERT OR IGNORE INTO stats_pending (ref) VALUES (?)',
+                    (ref,))
+            else:
+                self.db.execute(
+                    'DELETE FROM stats_pending WHERE ref = ?', (ref,))
+
+    def get_horizon(self, ref):
+        with self.lock:
+            row = self.db.execute(
+                'SELECT horizon FROM horizons WHERE ref = ?',
+                (ref,)).fetchone()
+        return row[0] if row else None
+
+    def set_horizon(self, ref, horizon):
+        with self.lock, self.db:
+            self.db.execute(
+                'INSERT OR REPLACE INTO horizons (ref, horizon) '
+                'VALUES (?, ?)', (ref, horizon))
+
+    def get_schedule(self):
+        """ Return a dict ref -> polling schedule
+        """
+        with self.lock:
+            return dict(
+                (row[0], dict(zip(SCHEDULE_KEYS, row[1:]))) for row in
+                self.db.execute('SELECT ref, %s FROM poll_schedule' % (
+                    ', '.join(SCHEDULE_KEYS))))
+
+    def set_schedule(self, schedule):
+        """ Write the polling schedules of the dict ref -> schedule in a
+        single transaction.
+        """
+        with self.lock, self.db:
+            self.db.executemany(
+                'INSERT OR REPLACE INTO poll_schedule (ref, %s) '
+                'VALUES (?, %s)' % (', '.join(SCHEDULE_KEYS),
+                                    ', '.join('?' * len(SCHEDULE_KEYS))),
+                ((ref,) + tuple(entry[key] for key in SCHEDULE_KEYS)
+                 for ref, entry in schedule.items()))
+
+    def get_maintenance(self):
+        """ Return a dict repository path -> task -> last run and
+        duration of the git store maintenance tasks (see maintenance.py)
+        """
+        ret = {}
+        with self.lock:
+            for repo, task, last, duration in self.db.execute(
+                    'SELECT repo, task, last, duration FROM maintenance'):
+                ret.setdefault(repo, {})[task] = {
+                    'last': last, 'duration': duration}
+        return ret
+
+    def set_maintenance(self, repo, task, last, duration):
+        with self.lock, self.db:
+            self.db.execute(
+                'INSERT OR REPLACE INTO maintenance (repo, task, last, '
+                'duration) VALUES (?, ?, ?, ?)', (repo, task, last, duration))
+
+    def remove_ref(self, ref):
+        """ Remove all the state of ref
+        """
+        with self.lock, self.db:
+            self.seen_refs.discard(ref)
+            for table in REF_TABLES:
+                self.db.execute(
+                    'DELETE FROM %s WHERE ref = ?' % table, (ref,))
+
+    def replace(self, path, tables):
+        """ Replace the content of tables by the one of the store at
+        path in a single transaction.
+        """
+        with self.lock:
+            self.db.execute('ATTACH DATABASE ? AS other', (path,))
+            try:
+                with self.db:
+                    for table in tables:
+                        self.db.execute('DELETE FROM %s' % table)
+                        self.db.execute(
+                            'INSERT INTO %s SELECT * FROM other.%s' % (
+                                table, table))
+            finally:
+                self.db.execute('DETACH DATABASE other')
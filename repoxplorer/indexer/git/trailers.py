@@ -0,0 +1,161 @@
+# Copyright 2016, Fabien Boucher
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+""" Extraction of the metadata (trailers) of the commit messages.
+
+The builtin metadata are matched with a single compiled pattern
+(metadata_re.METADATA_RE) that is only tried on lines containing a
+colon. The project parsers are only tried on lines containing the
+longest literal the parser requires, when one can be found.
+"""
+
+import re
+import threading
+
+try:
+    from re import _parser as sre_parse
+except ImportError:
+    import sre_parse
+
+from repoxplorer.index.tags import PROPERTIES as T_PROPERTIES
+from repoxplorer.index.commits import PROPERTIES as C_PROPERTIES
+from repoxplorer.indexer.git import metadata_re
+
+EL_RESERVED_FIELDS = [
+    '_index',
+    '_uid',
+    '_type',
+    '_id',
+    '_source',
+    '_size',
+    '_all',
+    '_field_names',
+    '_timestamp',
+    '_ttl',
+    '_parent',
+    '_routing',
+    '_meta',
+]
+
+# Keys that cannot be set by the project parsers
+RESERVED_METADATA_KEYS = (
+    list(C_PROPERTIES.keys()) +
+    list(T_PROPERTIES.keys()) +
+    EL_RESERVED_FIELDS
+)
+
+# Maximum amount of extractors kept by a process
+MAX_EXTRACTORS = 128
+
+_extractors = {}
+_extractors_lock = threading.Lock()
+
+
+def required_literal(pattern):
+    """ Return the longest literal string a line must contain to be
+    matched by pattern or None. Only the literals that are not
+    optional are considered.
+    """
+    if pattern.flags & re.IGNORECASE:
+        return None
+    try:
+        parsed = sre_parse.parse(pattern.pattern, pattern.flags)
+    except Exception:
+        return None
+    candidates = []
+
+    def walk(items):
+        current = []
+        for op, av in items:
+            if op is sre_parse.LITERAL:
+                current.append(chr(av))
+                continue
+            candidates.append(''.join(current))
+            current = []
+            if op is sre_parse.SUBPATTERN:
+                # (group, add_flags, del_flags, pattern)
+                if av[1] or av[2]:
+                    continue
+                walk(av[-1])
+            elif op is sre_parse.MAX_REPEAT or op is sre_parse.MIN_REPEAT:
+                # The repeated pattern is required at least once
+                if av[0] >= 1:
+                    walk(av[2])
+        candidates.append(''.join(current))
+
+    walk(parsed)
+    literal = max(candidates, key=len)
+    return literal or None
+
+
+class TrailersExtractor(object):
+    """ Extract the subject and the metadata of commit messages.
+    extra_parsers are compiled regexes with two groups, the metadata
+    key and its value.
+    """
+    def __init__(self, extra_parsers=None):
+        self.extra_parsers = [
+            (parser, required_literal(parser))
+            for parser in extra_parsers or []]
+        self.reserved_keys = frozenset(RESERVED_METADATA_KEYS)
+
+    def extract(self, msg):
+        lines = msg.split('\n')
+        metadatas = []
+        builtin = metadata_re.METADATA_RE.match
+        for line in lines[1:]:
+            if ':' in line:
+                m = builtin(line)
+                if m:
+                    value = line[m.end():]
+                    # Same as the ([^//].+)$ of metadata_re.METADATA_REs
+                    if len(value) > 1 and value[0] != '/':
+                        metadatas.append((
+                            metadata_re.METADATA_GROUPS[m.lastgroup],
+                            value.strip().replace('#', '')))
+            for parser, literal in self.extra_parsers:
+                if literal and literal not in line:
+                    continue
+                m = parser.match(line)
+                if m:
+                    key = m.groups()[0]
+                    if key not in self.reserved_keys:
+                        # Remove space before and after the string and
+                        # remove the \# that will cause trouble when
+                        # metadata are queried via the URL arguments
+                        metadatas.append((
+                            key.strip(),
+                            m.groups()[1].strip().replace('#', '')))
+        return lines[0], metadatas
+
+
+def get_extractor(extra_parsers=None):
+    """ Return the extractor of the parsers. Extractors are shared by
+    the calls with the same parsers of a process.
+    """
+    key = []
+    for parser in extra_parsers or []:
+        if not hasattr(parser, 'pattern'):
+            parser = re.compile(parser)
+        key.append((parser.pattern, parser.flags))
+    key = tuple(key)
+    extractor = _extractors.get(key)
+    if extractor is None:
+        with _extractors_lock:
+            if len(_extractors) >= MAX_EXTRACTORS:
+                _extractors.clear()
+            extractor = TrailersExtractor(
+                [re.compile(pattern, flags) for pattern, flags in key])
+            _extractors[key] = extractor
+    return extractor
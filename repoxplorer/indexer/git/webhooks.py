@@ -0,0 +1,309 @@
+# Copyright 2016, Fabien Boucher
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+""" Push triggered indexing.
+
+The indexer daemon listens for push notifications on
+indexer_webhook_host:indexer_webhook_port. The payloads of the GitHub
+and GitLab push events, of the Gerrit ref-updated and change-merged
+events and the generic {"uri": ..., "branch": ...} form are supported.
+A notification is mapped to the repositories of the projects definition
+having the pushed branch (or indexing the tags for a pushed tag) and
+their jobs are put in a deduplicating priority queue. The queue is
+consumed by a thread indexing the pushed repositories while the polling
+cycles run, a repository being never processed by both at once.
+"""
+
+import hmac
+import json
+import heapq
+import hashlib
+import logging
+import itertools
+import threading
+
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+from urllib.parse import urlparse
+
+from pecan import conf
+
+logger = logging.getLogger(__name__)
+
+# Priorities of the queued jobs, the lowest first
+BRANCH_PRIORITY = 0
+TAG_PRIORITY = 1
+# Maximum size of a notification payload
+MAX_PAYLOAD = 25 * 1024 ** 2
+
+
+def is_enabled():
+    return bool(getattr(conf, 'indexer_webhook_port', 0))
+
+
+def normalize_uri(uri):
+    """ Return host/path of a Git uri to compare the uris of the http,
+    ssh and scp like forms of a repository.
+    """
+    if '://' in uri:
+        parsed = urlparse(uri)
+        host, path = parsed.hostname or 'localhost', parsed.path
+    elif ':' in uri.split('/')[0]:
+        host, path = uri.split(':', 1)
+        host = host.split('@')[-1]
+    else:
+        host, path = 'localhost', uri
+    path = path.strip('/')
+    if path.endswith('.git'):
+        path = path[:-len('.git')]
+    return ('%s/%s' % (host, path)).lower()
+
+
+def parse_payload(payload):
+    """ Return the (uris, project, ref) pushed according to a
+    notification payload. project is the Gerrit project name, ref is a
+    full ref name or None for all the branches of the repository.
+    """
+    if not isinstance(payload, dict):
+        raise ValueError('Payload is not a JSON object')
+    if 'refUpdate' in payload:
+        # Gerrit ref-updated
+        update = payload['refUpdate']
+        ref = update['refName']
+        if not ref.startswith('refs/'):
+            ref = 'refs/heads/%s' % ref
+        return [], update['project'], ref
+    if 'change' in payload and 'project' in payload['change']:
+        # Gerrit change-merged
+        change = payload['change']
+        return [], change['project'], 'refs/heads/%s' % change['branch']
+    if 'uri' in payload:
+        branch = payload.get('branch')
+        return [payload['uri']], None, (
+            'refs/heads/%s' % branch if branch else None)
+    # GitLab pushes describe the repository in project, GitHub ones in
+    # repository
+    repository = payload.get('project') or payload.get('repository')
+    if not isinstance(repository, dict) or 'ref' not in payload:
+        raise ValueError('Unsupported payload')
+    uris = [repository[key] for key in (
+        'clone_url', 'ssh_url', 'git_url', 'html_url', 'git_http_url',
+        'git_ssh_url', 'web_url', 'url') if repository.get(key)]
+    return uris, None, payload['ref']
+
+
+class PushQueue(object):
+    """ Deduplicating priority queue of repository jobs
+    (scheduler.RepoJob). A job pushed again while queued is only queued
+    once, with the lowest of its priorities.
+    """
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.heap = []
+        # base_id -> (priority, seq, job)
+        self.queued = {}
+        self.seq = itertools.count()
+
+    def __len__(self):
+        with self.cond:
+            return len(self.queued)
+
+    def put(self, job, priority=BRANCH_PRIORITY):
+        """ Queue job. Return False if it was already queued with the
+        same or a lower priority.
+        """
+        with self.cond:
+            entry = self.queued.get(job.base_id)
+            if entry and entry[0] <= priority:
+                return False
+            seq = next(self.seq)
+            self.queued[job.base_id] = (priority, seq, job)
+            heapq.heappush(self.heap, (priority, seq, job.base_id))
+            self.cond.notify_all()
+            return True
+
+    def get_batch(self, timeout=None):
+        """ Wait up to timeout seconds for a queued job then return all
+        the queued jobs by priority.
+        """
+        with self.cond:
+            if not self.queued:
+                self.cond.wait(timeout)
+            jobs = []
+            while self.heap:
+                _, seq, base_id = heapq.heappop(self.heap)
+                entry = self.queued.get(base_id)
+                # Skip the entries replaced by a higher priority
+                if entry and entry[1] == seq:
+                    jobs.append(entry[2])
+                    del self.queued[base_id]
+            return jobs
+
+
+class WebhookReceiver(object):
+    """ HTTP receiver of the push notifications queueing the jobs of
+    the pushed repositories.
+    """
+    def __init__(self, queue, host=None, port=None, secret=None):
+        self.queue = queue
+        self.host = host or getattr(
+            conf, 'indexer_webhook_host', '127.0.0.1')
+        self.port = port if port is not None else getattr(
+            conf, 'indexer_webhook_port', 0)
+        self.secret = secret or getattr(conf, 'indexer_webhook_secret', None)
+        self.lock = threading.Lock()
+        self.by_uri = {}
+        self.jobs = []
+        self.server = None
+
+    def set_jobs(self, jobs):
+        """ Set the repository jobs of the projects definition
+        """
+        by_uri = {}
+        for job in jobs:
+            by_uri.setdefault(normalize_uri(job.uri), []).append(job)
+        with self.lock:
+            self.by_uri = by_uri
+            self.jobs = list(jobs)
+
+    def is_authorized(self, headers, body):
+        if not self.secret:
+            return True
+        signature = headers.get('X-Hub-Signature-256')
+        if signature:
+            expected = 'sha256=%s' % hmac.new(
+                self.secret.encode(), body, hashlib.sha256).hexdigest()
+            return hmac.compare_digest(signature, expected)
+        token = (headers.get('X-Gitlab-Token') or
+                 headers.get('X-Repoxplorer-Token'))
+        return bool(token) and hmac.compare_digest(token, self.secret)
+
+    def match(self, uris, project, ref):
+        """ Return the (job, priority) couples of the repositories
+        indexing ref.
+        """
+        with self.lock:
+            if project:
+                suffix = '/%s' % project.strip('/').lower()
+                jobs = [job for job in self.jobs if
+                        normalize_uri(job.uri).endswith(suffix)]
+            else:
+                jobs = []
+                for uri in set(normalize_uri(uri) for uri in uris):
+                    jobs.extend(self.by_uri.get(uri, []))
+        matched = []
+        for job in jobs:
+            refs = [r for r, _ in job.refs]
+            if ref is None:
+                matched.append((job, BRANCH_PRIORITY))
+            elif ref.startswith('refs/tags/'):
+                if any(r.get('index-tags') is True for r in refs):
+                    matched.append((job, TAG_PRIORITY))
+            elif [r for r in refs if
+                  'refs/heads/%s' % r['branch'] == ref]:
+                matched.append((job, BRANCH_PRIORITY))
+        return matched
+
+    def handle(self, headers, body):
+        """ Queue the jobs of a notification. Return the HTTP status
+        code and the response.
+        """
+        if not self.is_authorized(headers, body):
+            return 403, {'error': 'Invalid secret'}
+        try:
+            uris, project, ref = parse_payload(json.loads(body))
+        except (ValueError, KeyError, TypeError) as e:
+            return 400, {'error': 'Invalid payload: %s' % e}
+        queued = []
+        for job, priority in self.match(uris, project, ref):
+            # The polling cycles run the jobs of the projects definition
+            # meanwhile, queue a copy so their fetch states stay apart
+            if self.queue.put(job.copy(), priority):
+                queued.append(job.base_id)
+        logger.info("Push notification for %s %s: %s repositories "
+                    "queued" % (project or ', '.join(uris), ref,
+                                len(queued)))
+        return 202, {'queued': queued}
+
+    def start(self):
+        receiver = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                length = int(self.headers.get('Content-Length', 0))
+                if length > MAX_PAYLOAD:
+                    code, ret = 413, {'error': 'Payload too large'}
+                else:
+                    code, ret = receiver.handle(
+                        self.headers, self.rfile.read(length))
+                data = json.dumps(ret).encode()
+                self.send_response(code)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, format, *args):
+                logger.debug(format % args)
+
+        self.server = ThreadingHTTPServer((self.host, self.port), Handler)
+        self.port = self.server.server_address[1]
+        threading.Thread(
+            target=self.server.serve_forever, daemon=True).start()
+        logger.info("Listening for push notifications on %s:%s" % (
+            self.host, self.port))
+
+    def stop(self):
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+
+class PushConsumer(object):
+    """ Process the jobs of the queue with process (a function taking a
+    list of jobs). process runs the jobs with the repository locks
+    (scheduler.RepoLocks) of the polling cycles of the daemon so a
+    repository is never indexed concurrently.
+    """
+    def __init__(self, queue, process):
+        self.queue = queue
+        self.process = process
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def consume(self, timeout=None):
+        jobs = self.queue.get_batch(timeout)
+        if not jobs:
+            return 0
+        logger.info("Index %s pushed repositories" % len(jobs))
+        try:
+            self.process(jobs)
+        except Exception:
+            logger.exception("Unexpected error when indexing the "
+                             "pushed repositories")
+        return len(jobs)
+
+    def work(self):
+        while not self.stopped.is_set():
+            self.consume(timeout=1)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.work, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread:
+            self.thread.join()
@@ -1,9 +1,41 @@
 import os
+import shutil
+import tempfile
+import subprocess
 from unittest import TestCase
+from pecan import conf
 from pecan import set_config
 from pecan.testing import load_test_app
 
-__all__ = ['FunctionalTest']
+__all__ = ['FunctionalTest', 'IndexerTest', 'git', 'write', 'commit']
+
+GIT_ENV = {
+    'GIT_AUTHOR_NAME': 'Author A',
+    'GIT_AUTHOR_EMAIL': 'author.a@test',
+    'GIT_AUTHOR_DATE': '1493424649 -0400',
+    'GIT_COMMITTER_NAME': 'Author B',
+    'GIT_COMMITTER_EMAIL': 'author.b@test',
+    'GIT_COMMITTER_DATE': '1493425136 +0000',
+}
+
+
+def git(path, *args):
+    env = dict(os.environ)
+    env.update(GIT_ENV)
+    return subprocess.check_output(
+        ('git',) + args, cwd=path, env=env).decode()
+
+
+def write(path, name, content):
+    with open(os.path.join(path, name), 'w') as fd:
+        fd.write(content)
+
+
+def commit(path, name, content, msg):
+    write(path, name, content)
+    git(path, 'add', name)
+    git(path, 'commit', '-q', '-m', msg)
+    return git(path, 'rev-parse', 'HEAD').strip()
 
 
 class FunctionalTest(TestCase):
@@ -16,3 +48,33 @@ class FunctionalTest(TestCase):
 
     def tearDown(self):
         set_config({}, overwrite=True)
+
+
+class IndexerTest(TestCase):
+    """ Base of the indexer tests. The settings are restored after each
+    test as the pecan conf is shared by the tests. Each test gets its
+    own db_cache_path.
+    """
+
+    def setUp(self):
+        self.addCleanup(setattr, conf, '__values__', dict(conf.__values__))
+        self.db_cache_path = self.mkdtemp()
+        conf['db_cache_path'] = self.db_cache_path
+
+    def mkdtemp(self):
+        """ Return a temporary directory removed after the test
+        """
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path, True)
+        return path
+
+    def init_git_store(self):
+        self.git_store = self.mkdtemp()
+        conf['git_store'] = self.git_store
+
+    def init_repo(self):
+        """ Return the path of a new repository with a master branch
+        """
+        path = self.mkdtemp()
+        git(path, 'init', '-q', '-b', 'master', '.')
+        return path
@@ -1,4 +1,7 @@
+import mock
+
 from unittest import TestCase
+from mock import patch
 
 from repoxplorer import index
 from repoxplorer.index.commits import Commits
@@ -504,3 +507,119 @@ class TestCommits(TestCase):
         self.assertIn('19', ret)
         self.assertIn('20', ret)
         self.assertTrue(len(ret), 2)
+
+
+class TestCommitsRefs(TestCase):
+
+    def setUp(self):
+        self.con = index.Connector(index='repoxplorertestrefs')
+        self.c = Commits(self.con)
+        self.c.add_commits([
+            {'sha': 'sha%s' % i, 'author_date': 1410456005,
+             'committer_date': 1410456005, 'repos': repos}
+            for i, repos in enumerate((
+                ['r1'],
+                ['r1', 'meta_ref: m'],
+                ['r1', 'r2'],
+                ['r2'],
+            ))])
+
+    def tearDown(self):
+        self.con.ic.delete(index=self.con.index)
+
+    def get_repos(self, shas):
+        return dict((c['_id'], c['_source']['repos'] if c['found'] else None)
+                    for c in self.c.get_commits_by_id(shas)['docs'])
+
+    def test_add_refs(self):
+        ret = self.c.add_refs(['sha0', 'sha3', 'sha4'], ['r2'])
+        self.assertDictEqual(
+            ret, {'sha0': 'updated', 'sha3': 'noop', 'sha4': 'not_found'})
+        self.assertDictEqual(
+            self.get_repos(['sha0', 'sha3']),
+            {'sha0': ['r1', 'r2'], 'sha3': ['r2']})
+
+    def test_remove_ref(self):
+        shas = ['sha0', 'sha1', 'sha2', 'sha3']
+        ret = self.c.remove_ref(shas, 'r1')
+        self.assertDictEqual(
+            ret, {'sha0': 'deleted', 'sha1': 'deleted',
+                  'sha2': 'updated', 'sha3': 'noop'})
+        self.assertDictEqual(
+            self.get_repos(shas),
+            {'sha0': None, 'sha1': None, 'sha2': ['r2'], 'sha3': ['r2']})
+
+    def test_remove_ref_by_query(self):
+        shas = ['sha0', 'sha1', 'sha2', 'sha3']
+        ret = self.c.remove_ref_by_query('r1')
+        self.assertDictEqual(ret, {'updated': 1, 'deleted': 2})
+        self.assertDictEqual(
+            self.get_repos(shas),
+            {'sha0': None, 'sha1': None, 'sha2': ['r2'], 'sha3': ['r2']})
+        self.assertSetEqual(
+            self.c.get_existing_ids(shas), set(['sha2', 'sha3']))
+
+    def test_iter_refs(self):
+        # Paginated and without the meta refs
+        self.assertListEqual(list(self.c.iter_refs(size=1)), ['r1', 'r2'])
+
+    def test_bulk_create(self):
+        created, rejected, errors = self.c.bulk_create([
+            {'sha': sha, 'author_date': 1410456005,
+             'committer_date': 1410456005, 'repos': ['r3']}
+            for sha in ('sha0', 'sha9')])
+        # sha0 is already indexed, by another ref
+        self.assertListEqual(sorted(created), ['sha0', 'sha9'])
+        self.assertListEqual(rejected, [])
+        self.assertListEqual(errors, [])
+        self.c.refresh()
+        self.assertDictEqual(
+            self.get_repos(['sha0', 'sha9']),
+            {'sha0': ['r1', 'r3'], 'sha9': ['r3']})
+
+    def test_stats_pending(self):
+        self.c.add_commits([
+            {'sha': 'sha%s' % i, 'author_date': 1410456005 + i,
+             'committer_date': 1410456005 + i, 'repos': ['r4'],
+             'stats_pending': True}
+            for i in (5, 6, 7)])
+        # Newest commits first
+        self.assertListEqual(
+            self.c.get_stats_pending('r4', 2), ['sha7', 'sha6'])
+        self.assertDictEqual(
+            self.c.get_repos(repos=['r1', 'r4'], stats_pending=True)[1],
+            {'r4': 3})
+        self.c.set_stats([
+            {'sha': 'sha7', 'line_modifieds': 10, 'files_list': ['f']},
+            {'sha': 'sha6'}])
+        self.assertListEqual(self.c.get_stats_pending('r4', 2), ['sha5'])
+        self.assertEqual(
+            self.c.get_commits_amount(repos=['r4'], stats_pending=True), 1)
+        cmt = self.c.get_commit('sha7')
+        self.assertEqual(cmt['line_modifieds'], 10)
+        self.assertFalse(cmt['stats_pending'])
+
+
+class TestRemoveRefByQuery(TestCase):
+
+    def setUp(self):
+        self.c = Commits(mock.MagicMock())
+
+    def get_response(self, conflicts):
+        return {'updated': 1, 'deleted': 1, 'version_conflicts': conflicts}
+
+    def test_retries(self):
+        self.c.es.update_by_query.side_effect = [
+            self.get_response(2), self.get_response(0)]
+        with patch('repoxplorer.index.commits.time.sleep') as sleep:
+            self.assertDictEqual(
+                self.c.remove_ref_by_query('r1'),
+                {'updated': 2, 'deleted': 2})
+        sleep.assert_called_once_with(1)
+
+    def test_attempts_exhausted(self):
+        self.c.es.update_by_query.return_value = self.get_response(1)
+        with patch('repoxplorer.index.commits.time.sleep') as sleep:
+            self.assertRaises(Exception, self.c.remove_ref_by_query, 'r1')
+        self.assertListEqual(
+            [c[0][0] for c in sleep.call_args_list], [1, 2, 4, 8, 16])
@@ -633,6 +633,7 @@ class TestInfosController(FunctionalTest):
             'commits_amount': 3,
             'authors_amount': 2,
             'line_modifieds_amount': 29,
+            'line_stats_complete': True,
             'duration': 16595352,
             'ttl_average': 0,
             'projects_amount': 1,
@@ -676,6 +677,7 @@ class TestInfosController(FunctionalTest):
             'commits_amount': 2,
             'authors_amount': 2,
             'line_modifieds_amount': 18,
+            'line_stats_complete': True,
             'duration': 16595352,
             'ttl_average': 0,
             'projects_amount': 1,
@@ -690,6 +692,7 @@ class TestInfosController(FunctionalTest):
             'projects_amount': 1,
             'first': 1410456005,
             'line_modifieds_amount': 10,
+            'line_stats_complete': True,
             'duration': 0,
             'commits_amount': 1,
             'ttl_average': 0,
@@ -810,6 +813,13 @@ class TestProjectsController(FunctionalTest):
         assert response.status_int == 200
         self.assertEqual(len(response.json), 1)
         self.assertEqual(response.json[0]['name'], 'monkey')
+        self.assertTrue(response.json[0]['line_stats_complete'])
+        # The refs of the projects cache are left untouched
+        project = Projects().get('test')
+        with patch.object(Projects, 'get', return_value=project):
+            response = self.app.get('/api/v1/projects/repos?pid=test')
+        self.assertTrue(response.json[0]['line_stats_complete'])
+        self.assertNotIn('line_stats_pending', project['refs'][0])
         response = self.app.get('/api/v1/projects/repos?tid=python')
         assert response.status_int == 200
         self.assertEqual(len(response.json), 1)
@@ -0,0 +1,92 @@
+import os
+import mock
+
+from repoxplorer.indexer.git import catalog
+from repoxplorer.indexer.git import indexer
+from repoxplorer.tests import IndexerTest
+
+
+class FakeCommits(object):
+    index = 'repoxplorertest'
+
+    def __init__(self, docs):
+        self.docs = docs
+
+    def get_all_commits_repos(self):
+        return [{'_id': sha, '_source': {'repos': repos}}
+                for sha, repos in self.docs.items()]
+
+
+class TestCommitsCatalog(IndexerTest):
+
+    def setUp(self):
+        super(TestCommitsCatalog, self).setUp()
+        self.catalog = catalog.CommitsCatalog(
+            path=os.path.join(self.db_cache_path, catalog.CATALOG_FILE),
+            index_name='repoxplorertest')
+
+    def tearDown(self):
+        self.catalog.close()
+
+    def test_catalog(self):
+        self.catalog.add_refs(['sha1', 'sha2'], ['r1', 'meta_ref: m'])
+        self.catalog.add_refs(['sha2', 'sha3'], ['r2'])
+        self.assertListEqual(
+            sorted(self.catalog.get_ref_shas('r1')), ['sha1', 'sha2'])
+        self.assertDictEqual(
+            self.catalog.get_refs(['sha1', 'sha2', 'sha4']),
+            {'sha1': set(['r1', 'meta_ref: m']),
+             'sha2': set(['r1', 'r2', 'meta_ref: m'])})
+        self.catalog.remove_ref(['sha2'], 'r1')
+        self.assertDictEqual(
+            self.catalog.get_refs(['sha2']),
+            {'sha2': set(['r2', 'meta_ref: m'])})
+        self.catalog.remove_shas(['sha2', 'sha3'])
+        self.assertListEqual(self.catalog.get_ref_shas('r2'), [])
+        # Chunked queries
+        shas = ['%040d' % i for i in range(catalog.QUERY_CHUNK * 2 + 1)]
+        self.catalog.add_refs(shas, ['r3'])
+        self.assertEqual(len(self.catalog.get_refs(shas)), len(shas))
+
+    def test_rebuild_and_check(self):
+        self.assertFalse(self.catalog.is_built())
+        commits = FakeCommits({
+            'sha1': ['r1'],
+            'sha2': ['r1', 'r2'],
+        })
+        self.catalog.add_refs(['sha4'], ['r4'])
+        self.assertEqual(self.catalog.rebuild(commits), 2)
+        self.assertTrue(self.catalog.is_built())
+        self.assertDictEqual(
+            self.catalog.get_refs(['sha1', 'sha2', 'sha4']),
+            {'sha1': set(['r1']), 'sha2': set(['r1', 'r2'])})
+        ret = self.catalog.check(commits)
+        self.assertEqual(ret['missing'], 0)
+        self.assertEqual(ret['extra'], 0)
+        self.catalog.remove_ref(['sha2'], 'r2')
+        self.catalog.add_refs(['sha3'], ['r3'])
+        ret = self.catalog.check(commits)
+        self.assertEqual(ret['missing'], 1)
+        self.assertListEqual(ret['missing_samples'], [('sha2', 'r2')])
+        self.assertEqual(ret['extra'], 1)
+        self.assertListEqual(ret['extra_samples'], [('sha3', 'r3')])
+
+    def test_get_catalog_disabled(self):
+        indexer.conf['indexer_commits_catalog'] = False
+        self.assertIsNone(catalog.get_catalog())
+
+    def test_delete_commits(self):
+        self.catalog.add_refs(['sha1', 'sha2', 'sha3'], ['r1'])
+        self.catalog.add_refs(['sha2'], ['meta_ref: m'])
+        self.catalog.add_refs(['sha3'], ['r2'])
+        commits = mock.MagicMock()
+        commits.remove_ref.return_value = {
+            'sha1': 'deleted', 'sha2': 'deleted', 'sha3': 'updated'}
+        indexer.delete_commits(
+            commits, 'p1', ['sha1', 'sha2', 'sha3'], 'r1', self.catalog)
+        self.assertFalse(commits.get_commits_by_id.called)
+        commits.remove_ref.assert_called_once_with(
+            ['sha1', 'sha2', 'sha3'], 'r1')
+        self.assertDictEqual(
+            self.catalog.get_refs(['sha1', 'sha2', 'sha3']),
+            {'sha3': set(['r2'])})
@@ -0,0 +1,229 @@
+import mock
+
+from unittest import TestCase
+from mock import patch
+
+from repoxplorer.indexer.git import indexer
+from repoxplorer.indexer.git import checkpoints
+from repoxplorer.indexer.git import metrics
+from repoxplorer.tests import IndexerTest
+from repoxplorer.tests import commit
+
+
+class FakePool(object):
+    def imap_unordered(self, func, options):
+        return map(func, options)
+
+
+class TestImportCheckpoints(IndexerTest):
+
+    def setUp(self):
+        super(TestImportCheckpoints, self).setUp()
+        self.checkpoints = checkpoints.ImportCheckpoints()
+
+    def tearDown(self):
+        self.checkpoints.close()
+
+    def test_checkpoints(self):
+        self.assertIsNone(self.checkpoints.get('ref'))
+        self.checkpoints.start('ref', 'tip', False, [['a', 'b'], ['c']])
+        state = self.checkpoints.get('ref')
+        self.assertEqual(state['tip'], 'tip')
+        self.assertFalse(state['stats'])
+        self.checkpoints.set_done('ref', 0)
+        self.checkpoints.set_failed('ref', [1])
+        self.assertDictEqual(
+            self.checkpoints.get_chunks('ref'), {1: (['c'], 1)})
+        # Durable
+        self.assertDictEqual(
+            checkpoints.ImportCheckpoints().get_chunks('ref'),
+            {1: (['c'], 1)})
+        # A new import replaces the previous one
+        self.checkpoints.start('ref', 'tip2', True, [['d']])
+        self.assertDictEqual(
+            self.checkpoints.get_chunks('ref'), {0: (['d'], 0)})
+        self.checkpoints.finish('ref')
+        self.assertIsNone(self.checkpoints.get('ref'))
+        self.assertDictEqual(self.checkpoints.get_chunks('ref'), {})
+
+    def test_iter_chunks(self):
+        self.checkpoints.start(
+            'ref', 'tip', True, iter([['a'], ['b'], ['c']]))
+        self.checkpoints.set_done('ref', 1)
+        self.assertListEqual(
+            list(self.checkpoints.iter_chunks('ref', 1)),
+            [{0: ['a']}, {2: ['c']}])
+        self.assertEqual(self.checkpoints.count_chunks('ref'), 2)
+
+    def test_tracker(self):
+        self.checkpoints.start('ref', 'tip', True, [['a', 'b'], ['c'], []])
+        chunks = dict((chunk, shas) for chunk, (shas, _) in
+                      self.checkpoints.get_chunks('ref').items())
+        tracker = checkpoints.ChunksTracker(self.checkpoints, 'ref', chunks)
+        tracker.indexed(['a', 'c', 'unknown'])
+        self.assertListEqual(tracker.done, [2, 1])
+        self.assertListEqual(tracker.get_failed(), [0])
+        self.assertListEqual(list(self.checkpoints.get_chunks('ref')), [0])
+
+
+class TestCheckpointedImport(IndexerTest):
+
+    def setUp(self):
+        super(TestCheckpointedImport, self).setUp()
+        self.init_git_store()
+        self.upstream = self.init_repo()
+        indexer.conf['indexer_extract_mode'] = 'stream'
+        indexer.conf['indexer_import_retries'] = 1
+        indexer.conf['indexer_import_retry_delay'] = 0
+        self.shas = [
+            commit(self.upstream, 'f', '%s\n' % i, 'Commit %s' % i)
+            for i in range(3)]
+        with patch.object(indexer.index, 'Connector'):
+            self.pi = indexer.RepoIndexer(
+                'p1', 'file://%s' % self.upstream)
+        self.pi.git_init()
+        self.pi.set_branch('master')
+        self.pi.git_fetch_branch()
+        self.pi.tip = self.shas[-1]
+        self.pi.c = mock.MagicMock()
+        self.pi.c.get_existing_ids.return_value = set()
+        self.pi.catalog = None
+        self.failing = set()
+        self.processed = []
+        self.patchers = [
+            patch.object(indexer, 'IMPORT_CHUNK', 1),
+            patch.object(indexer, 'start_workers_pool',
+                         return_value=FakePool()),
+            patch.object(indexer, 'process_commits',
+                         side_effect=self.process_commits)]
+        for patcher in self.patchers:
+            patcher.start()
+
+    def tearDown(self):
+        for patcher in self.patchers:
+            patcher.stop()
+
+    def process_commits(self, options, bulks=None):
+        shas = options[2]
+        self.processed.append(shas)
+        if self.failing.intersection(shas):
+            raise Exception('Elasticsearch timeout')
+        bulks.append((0.2, len(shas), 0))
+        return shas
+
+    def test_retries(self):
+        self.failing.add(self.shas[1])
+        self.processed = []
+        with patch.object(indexer.time, 'sleep'):
+            self.assertRaises(
+                Exception, self.pi.run_workers, list(self.shas), 0)
+        # The failed chunk is retried once
+        self.assertListEqual(
+            self.processed, [[sha] for sha in self.shas] + [[self.shas[1]]])
+        self.assertDictEqual(
+            self.pi.checkpoints.get_chunks(self.pi.ref_id),
+            {1: ([self.shas[1]], 2)})
+        self.assertFalse(self.pi.is_branch_fully_indexed())
+        self.assertIsNone(self.pi.get_indexed_tip())
+
+        # The next run only indexes the remaining chunk
+        self.failing.clear()
+        self.processed = []
+        self.assertTrue(self.pi.resume_import(0))
+        self.assertListEqual(self.processed, [[self.shas[1]]])
+        self.assertIsNone(self.pi.checkpoints.get(self.pi.ref_id))
+        self.assertEqual(self.pi.get_indexed_tip(), self.shas[-1])
+        self.assertFalse(self.pi.resume_import(0))
+
+    def test_bulk_metrics(self):
+        # The bulk requests of the workers are recorded by the main
+        # process
+        registry = metrics.Registry()
+        with patch.object(metrics, '_registry', registry):
+            self.pi.run_workers(list(self.shas), 0)
+        self.assertEqual(
+            registry.counters[('bulk_docs', ())], len(self.shas))
+        self.assertEqual(registry.counters[('bulk_rejected', ())], 0)
+        self.assertEqual(
+            registry.histograms[('bulk_seconds', ())][2], len(self.shas))
+
+    def test_resume_indexed_commits(self):
+        # The indexer died after the commits of the chunk were indexed
+        self.pi.checkpoints.start(
+            self.pi.ref_id, self.shas[1], True, [self.shas[:2]])
+        self.pi.c.get_existing_ids.return_value = set([self.shas[0]])
+        self.assertTrue(self.pi.resume_import(0))
+        self.assertListEqual(self.processed, [[self.shas[1]]])
+        self.pi.c.add_refs.assert_called_once_with(
+            [self.shas[0]], [self.pi.ref_id])
+        self.assertEqual(self.pi.get_indexed_tip(), self.shas[1])
+
+    def test_index_missing_update(self):
+        self.pi.to_delete = set()
+        self.pi.to_index = set(self.shas)
+        self.pi.c.get_existing_ids.side_effect = lambda shas: [
+            sha for sha in shas if sha == self.shas[0]]
+        # The commit was deleted from the index since the lookup
+        self.pi.c.add_refs.return_value = {self.shas[0]: 'not_found'}
+        self.pi.index(0)
+        # It is created with the others
+        self.assertListEqual(
+            sorted(self.processed), sorted([[sha] for sha in self.shas]))
+        self.assertEqual(self.pi.get_indexed_tip(), self.shas[-1])
+
+    def test_resume_shared_commits(self):
+        # shas[0] is already indexed for another ref
+        refs = {self.shas[0]: set(['other'])}
+
+        def add_refs(shas, ref_ids):
+            for sha in shas:
+                refs[sha].update(ref_ids)
+            return dict((sha, 'updated') for sha in shas)
+        self.pi.c.get_existing_ids.side_effect = lambda shas: [
+            sha for sha in shas if sha in refs]
+        self.pi.c.add_refs.side_effect = add_refs
+        self.pi.to_delete = set()
+        self.pi.to_index = set(self.shas)
+        self.failing.add(self.shas[2])
+        with patch.object(indexer.time, 'sleep'):
+            self.assertRaises(Exception, self.pi.index, 0)
+        self.assertIsNone(self.pi.get_indexed_tip())
+        # The indexer is restarted
+        self.failing.clear()
+        self.assertTrue(self.pi.resume_import(0))
+        self.assertEqual(self.pi.get_indexed_tip(), self.shas[-1])
+        self.assertSetEqual(
+            refs[self.shas[0]], set(['other', self.pi.ref_id]))
+
+    def test_resume_rewritten_history(self):
+        self.pi.checkpoints.start(
+            self.pi.ref_id, 'f' * 40, True, [self.shas])
+        self.assertFalse(self.pi.resume_import(0))
+        self.assertIsNone(self.pi.checkpoints.get(self.pi.ref_id))
+        self.assertListEqual(self.processed, [])
+
+
+class TestProcessCommits(TestCase):
+
+    def test_confirmed_writes(self):
+        cmts = [{'sha': 'sha%s' % i} for i in range(3)]
+        c = mock.MagicMock()
+        # The second commit is rejected by the overloaded cluster
+        c.bulk_create.side_effect = lambda docs: (
+            [d['sha'] for d in docs if d['sha'] != 'sha1'],
+            [d for d in docs if d['sha'] == 'sha1'], [])
+        bulks = []
+        with patch.object(indexer, 'get_worker_commits', return_value=c), \
+                patch.object(indexer, 'iter_commits',
+                             return_value=iter(cmts)), \
+                patch.object(indexer.index, 'get_bulk_params',
+                             return_value={'chunk_size': 2}):
+            self.assertListEqual(
+                indexer.process_commits(
+                    ('path', 'ref', ['sha0', 'sha1', 'sha2'], [], True),
+                    bulks),
+                ['sha0', 'sha2'])
+        self.assertEqual(c.bulk_create.call_count, 2)
+        # The (latency, docs, rejected) of each bulk request
+        self.assertListEqual(
+            [bulk[1:] for bulk in bulks], [(1, 1), (1, 0)])
@@ -0,0 +1,106 @@
+from mock import patch
+
+from repoxplorer.indexer.git import indexer
+from repoxplorer.indexer.git import commits_cache
+from repoxplorer.tests import IndexerTest
+from repoxplorer.tests import commit
+
+
+class TestParsedCommitsCache(IndexerTest):
+
+    def setUp(self):
+        super(TestParsedCommitsCache, self).setUp()
+        self.cache = commits_cache.ParsedCommitsCache()
+
+    def tearDown(self):
+        self.cache.close()
+
+    def test_get_put(self):
+        cmts = [{'sha': '%040d' % i, 'message': 'msg %s' % i}
+                for i in range(3)]
+        self.cache.put_many(cmts, 'v1')
+        self.assertDictEqual(
+            self.cache.get_many(['%040d' % i for i in range(5)], 'v1'),
+            dict((cmt['sha'], cmt) for cmt in cmts))
+        # Commits parsed by other parsers are not returned
+        self.assertDictEqual(self.cache.get_many(['%040d' % 0], 'v2'), {})
+        size = self.cache.get_size()
+        self.assertGreater(size, 0)
+        # Caching again a commit replaces it
+        self.cache.put_many(cmts[:1], 'v1')
+        self.assertEqual(self.cache.get_size(), size)
+
+    def test_get_version(self):
+        class Parser(object):
+            pattern = 'fix: (.*)'
+        self.assertEqual(
+            commits_cache.get_version(), commits_cache.get_version([]))
+        self.assertNotEqual(
+            commits_cache.get_version(), commits_cache.get_version([Parser]))
+
+    def test_evict(self):
+        cmts = [{'sha': '%040d' % i, 'message': 'msg %s' % i}
+                for i in range(20)]
+        with patch.object(commits_cache.time, 'time') as now:
+            now.return_value = 1000
+            self.cache.put_many(cmts[:10], 'v1')
+            now.return_value = 1001
+            self.cache.put_many(cmts[10:], 'v1')
+            now.return_value = 1002
+            # The first commit is the most recently used one
+            self.cache.get_many([cmts[0]['sha']], 'v1')
+        self.cache.max_bytes = self.cache.get_size() - 1
+        now.return_value = 1003
+        self.cache.put_many(cmts[:1], 'v1')
+        self.assertLess(self.cache.get_size(), self.cache.max_bytes)
+        cached = self.cache.get_many([cmt['sha'] for cmt in cmts], 'v1')
+        self.assertIn(cmts[0]['sha'], cached)
+        self.assertNotIn(cmts[1]['sha'], cached)
+        self.assertIn(cmts[-1]['sha'], cached)
+
+
+class TestIterCachedCommits(IndexerTest):
+
+    def setUp(self):
+        super(TestIterCachedCommits, self).setUp()
+        self.repo = self.init_repo()
+        indexer.conf['indexer_extract_mode'] = 'stream'
+        indexer.conf['indexer_parsed_cache'] = True
+        self.shas = [
+            commit(self.repo, 'f', '1\n', 'First commit'),
+            commit(self.repo, 'f', '1\n2\n', 'Second commit')]
+
+    def tearDown(self):
+        commits_cache.get_cache().close()
+
+    def test_iter_commits(self):
+        cmts = list(indexer.iter_commits(self.repo, ['r1'], self.shas))
+        self.assertEqual(len(cmts), 2)
+        # Served from the cache with the repos of the caller
+        with patch.object(indexer, 'read_commits') as read_commits:
+            cached = list(indexer.iter_commits(
+                self.repo, ['r2'], self.shas[::-1]))
+            read_commits.assert_not_called()
+        for cmt in cmts:
+            cmt['repos'] = ['r2']
+        self.assertListEqual(
+            sorted(cached, key=lambda cmt: cmt['sha']),
+            sorted(cmts, key=lambda cmt: cmt['sha']))
+        # Cached commits have their line statistics even without stats
+        cmts = list(indexer.iter_commits(
+            self.repo, ['r1'], self.shas, stats=False))
+        self.assertListEqual(
+            sorted(cmt['line_modifieds'] for cmt in cmts), [1, 1])
+
+    def test_iter_commits_without_stats(self):
+        # Commits without line statistics are not cached
+        list(indexer.iter_commits(self.repo, ['r1'], self.shas, stats=False))
+        self.assertEqual(commits_cache.get_cache().get_size(), 0)
+        sha = commit(self.repo, 'f', '1\n2\n3\n', 'Third commit')
+        list(indexer.iter_commits(self.repo, ['r1'], self.shas[:1]))
+        with patch.object(indexer, 'read_commits') as read_commits:
+            read_commits.return_value = []
+            list(indexer.iter_commits(
+                self.repo, ['r1'], [self.shas[0], sha]))
+            read_commits.assert_called_once_with(
+                self.repo, ['r1'], [sha], None, True)
@@ -1,17 +1,31 @@
+import io
 import os
 import re
 import mock
 import shutil
-import pickle
 import tempfile
 
+from importlib.util import find_spec
+from unittest import skipIf
 from unittest import TestCase
 from mock import patch
 
 from repoxplorer import index
 from repoxplorer.index import commits
 from repoxplorer.index import projects
+from repoxplorer.indexer.git import backends
 from repoxplorer.indexer.git import indexer
+from repoxplorer.indexer.git import state_store
+from repoxplorer.tests import GIT_ENV
+from repoxplorer.tests import IndexerTest
+from repoxplorer.tests import git
+from repoxplorer.tests import write
+from repoxplorer.tests import commit
+
+
+def worker_connection(_):
+    return (os.getpid(), id(indexer.get_worker_commits()),
+            indexer.Commits.call_count)
 
 
 class TestExtractCmtFunctions(TestCase):
@@ -244,6 +258,440 @@ http://metavalue
         self.assertListEqual(output, expected)
 
 
+class TestStreamExtraction(IndexerTest):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.path = tempfile.mkdtemp()
+        git(cls.path, 'init', '-q', '-b', 'master', '.')
+        os.makedirs(os.path.join(cls.path, 'doc'))
+        write(cls.path, 'doc/arch.rst', 'line1\nline2\n')
+        git(cls.path, 'add', '.')
+        git(cls.path, 'commit', '-q', '-m', 'First commit\n\n'
+            'Body of the commit\n\nCo-Authored-By: Author C')
+        git(cls.path, 'mv', 'doc/arch.rst', 'doc/components.rst')
+        write(cls.path, 'doc/components.rst', 'line1\nline2\nline3\n')
+        with open(os.path.join(cls.path, 'logo.bin'), 'wb') as fd:
+            fd.write(b'\x00\x01\x02')
+        git(cls.path, 'add', '-A')
+        git(cls.path, 'commit', '-q', '-m', 'Second commit')
+        git(cls.path, 'checkout', '-q', '-b', 'devel', 'HEAD~1')
+        write(cls.path, 'README', 'readme\n')
+        git(cls.path, 'add', '.')
+        git(cls.path, 'commit', '-q', '-m', 'Third commit')
+        git(cls.path, 'checkout', '-q', 'master')
+        git(cls.path, 'merge', '-q', '--no-ff', '-m', 'Merge devel', 'devel')
+        cls.shas = git(cls.path, 'log', '--format=%H', 'master').split()
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.path)
+
+    def test_iter_stream_records(self):
+        raw = (b'\0sha1\nmsg1\n\0\n\n1\t1\tf\n'
+               b'\0sha2\nmsg2\n\0\n'
+               b'\0sha3\nmsg3\n\0')
+        for read_size in (1, 3, 1024):
+            records = list(indexer.iter_stream_records(
+                io.BytesIO(raw), read_size=read_size))
+            self.assertListEqual(
+                records,
+                [(b'sha1\nmsg1\n', b'\n\n1\t1\tf\n'),
+                 (b'sha2\nmsg2\n', b'\n'),
+                 (b'sha3\nmsg3\n', b'')])
+
+    def test_process_commits_stream(self):
+        cmts = list(indexer.process_commits_stream(
+            indexer.get_commits_stream(self.path, self.shas),
+            ['file:///test:test:master']))
+        self.assertListEqual([c['sha'] for c in cmts], self.shas)
+        merge, second, third, first = cmts
+        self.assertTrue(merge['merge_commit'])
+        self.assertEqual(merge['commit_msg'], 'Merge devel')
+        self.assertEqual(merge['line_modifieds'], 0)
+        self.assertListEqual(merge['files_list'], [])
+        self.assertDictEqual(first, {
+            'sha': self.shas[-1],
+            'merge_commit': False,
+            'author_name': 'Author A',
+            'author_email': 'author.a@test',
+            'author_email_domain': 'test',
+            'author_date': 1493424649,
+            'committer_name': 'Author B',
+            'committer_email': 'author.b@test',
+            'committer_date': 1493425136,
+            'ttl': 487,
+            'line_modifieds': 2,
+            'files_list': ['doc', 'doc/arch.rst'],
+            'commit_msg': 'First commit',
+            'co-authored-by': ['Author C'],
+            'repos': ['file:///test:test:master'],
+        })
+        # Renamed file and binary file (not accounted)
+        self.assertEqual(second['line_modifieds'], 1)
+        self.assertListEqual(
+            second['files_list'], ['doc', 'doc/components.rst'])
+        self.assertListEqual(third['files_list'], ['README'])
+
+    def test_extract_commits_parsers(self):
+        options = (self.path, ['r'], self.shas,
+                   [re.compile('^(Co)-Authored-By: (.*)$')], True)
+        with patch.object(indexer, 'Commits'), \
+                patch.object(indexer.index, 'Connector'):
+            pool = indexer.start_workers_pool(1)
+            try:
+                # The project parsers reach the workers
+                cmts = pool.map(indexer.extract_commits, [options])[0]
+            finally:
+                indexer.stop_workers_pool()
+        self.assertListEqual(cmts[-1]['Co'], ['Author C'])
+        self.assertListEqual(cmts[-1]['co-authored-by'], ['Author C'])
+
+    def test_iter_commits_without_stats(self):
+        cmts = list(indexer.iter_commits(
+            self.path, ['r'], self.shas, stats=False))
+        self.assertListEqual([c['sha'] for c in cmts], self.shas)
+        merge, second, third, first = cmts
+        self.assertEqual(merge['line_modifieds'], 0)
+        self.assertNotIn('stats_pending', merge)
+        for cmt in (second, third, first):
+            self.assertTrue(cmt['stats_pending'])
+            self.assertNotIn('line_modifieds', cmt)
+            self.assertNotIn('files_list', cmt)
+        self.assertListEqual(first['co-authored-by'], ['Author C'])
+
+    def test_get_commits_stream_no_shas(self):
+        self.assertListEqual(
+            list(indexer.get_commits_stream(self.path, [])), [])
+
+    def check_reader(self, mode):
+        expected = list(indexer.process_commits_stream(
+            indexer.get_commits_stream(self.path, self.shas), ['r']))
+        reader = backends.get_reader(mode, self.path)
+        try:
+            self.assertSetEqual(
+                set(reader.get_all_shas('refs/heads/master')),
+                set(self.shas))
+            self.assertListEqual(
+                reader.get_all_shas('refs/heads/master', self.shas[1]),
+                [self.shas[0], self.shas[2]])
+            for _ in range(2):
+                # The reader is reused and unknown commits are skipped
+                cmts = list(indexer.process_commits_stream(
+                    reader.iter_records(self.shas + ['0' * 40]), ['r']))
+                self.assertListEqual(cmts, expected)
+            self.assertIs(backends.get_reader(mode, self.path), reader)
+        finally:
+            backends.close_readers()
+
+    def test_batch_reader(self):
+        self.check_reader('batch')
+
+    def test_batch_reader_lazy(self):
+        indexer.conf['indexer_extract_mode'] = 'batch'
+        try:
+            # Listing the commits neither opens a reader nor spawns the
+            # persistent processes
+            self.assertSetEqual(
+                set(indexer.get_all_shas(self.path, 'refs/heads/master')),
+                set(self.shas))
+            self.assertDictEqual(dict(backends._readers), {})
+            reader = backends.get_reader('batch', self.path)
+            self.assertIsNone(reader.cat)
+            list(reader.iter_records(self.shas[:1]))
+            self.assertTrue(reader.is_alive())
+        finally:
+            backends.close_readers()
+
+    @skipIf(find_spec('dulwich') is None, 'dulwich is not installed')
+    def test_dulwich_reader(self):
+        self.check_reader('dulwich')
+
+    def test_format_rename(self):
+        for a, b, expected in (
+                ('a', 'b', 'a => b'),
+                ('doc/arch.rst', 'doc/components.rst',
+                 'doc/{arch.rst => components.rst}'),
+                ('d1/x', 'd2/x', '{d1 => d2}/x'),
+                ('k/b/c', 'k/c', 'k/{b => }/c'),
+                ('p/q/r/s', 'p/z/r/s', 'p/{q => z}/r/s')):
+            self.assertEqual(backends.format_rename(a, b), expected)
+
+
+class TestIncrementalIndexing(IndexerTest):
+
+    def setUp(self):
+        super(TestIncrementalIndexing, self).setUp()
+        self.init_git_store()
+        self.upstream = self.init_repo()
+        self.shas = [
+            commit(self.upstream, 'f', '1\n', 'First commit'),
+            commit(self.upstream, 'f', '2\n', 'Second commit')]
+        with patch.object(indexer.index, 'Connector'):
+            self.pi = indexer.RepoIndexer(
+                'p1', 'file://%s' % self.upstream, con=mock.MagicMock())
+        self.pi.git_init()
+        self.pi.set_branch('master')
+        self.indexed = {}
+        self.pi.c = mock.MagicMock()
+        self.pi.c.get_commit.side_effect = (
+            lambda sha, silent: self.indexed.get(sha))
+
+    def fetch_and_get_commits(self):
+        self.pi.git_fetch_branch()
+        self.pi.git_get_commit_obj()
+        self.pi.get_current_commits_indexed()
+
+    def mark_indexed(self):
+        for sha in self.pi.commits:
+            self.indexed[sha] = {'sha': sha, 'repos': [self.pi.ref_id]}
+        self.pi.save_indexed_tip()
+
+    def test_incremental(self):
+        self.fetch_and_get_commits()
+        self.assertFalse(self.pi.incremental)
+        self.assertListEqual(list(self.pi.commits), sorted(self.shas))
+        self.mark_indexed()
+        self.assertEqual(self.pi.get_indexed_tip(), self.shas[-1])
+
+        # Only the new commits are considered
+        self.shas.append(commit(self.upstream, 'f', '3\n', 'Third'))
+        self.fetch_and_get_commits()
+        self.assertTrue(self.pi.incremental)
+        self.assertListEqual(list(self.pi.commits), [self.shas[-1]])
+        self.assertListEqual(list(self.pi.already_indexed), [])
+        self.pi.compute_to_index_to_delete()
+        self.assertSetEqual(self.pi.to_index, set([self.shas[-1]]))
+        self.assertSetEqual(self.pi.to_delete, set())
+        self.mark_indexed()
+        self.assertEqual(self.pi.get_indexed_tip(), self.shas[-1])
+
+    def test_history_rewritten(self):
+        self.fetch_and_get_commits()
+        self.mark_indexed()
+        git(self.upstream, 'reset', '-q', '--hard', 'HEAD~1')
+        new_sha = commit(self.upstream, 'f', '4\n', 'Rewritten')
+        self.pi.get_current_commits_indexed = mock.Mock()
+        self.fetch_and_get_commits()
+        self.assertFalse(self.pi.incremental)
+        self.assertListEqual(
+            list(self.pi.commits), sorted([new_sha, self.shas[0]]))
+        self.assertTrue(self.pi.get_current_commits_indexed.called)
+
+    def test_indexed_tip_not_in_index(self):
+        self.fetch_and_get_commits()
+        self.mark_indexed()
+        # The index has been wiped
+        self.indexed = {}
+        self.shas.append(commit(self.upstream, 'f', '3\n', 'Third'))
+        self.pi.get_current_commits_indexed = mock.Mock()
+        self.fetch_and_get_commits()
+        self.assertFalse(self.pi.incremental)
+        self.assertListEqual(list(self.pi.commits), sorted(self.shas))
+
+    def test_indexed_tip_removed_by_cleaner(self):
+        self.fetch_and_get_commits()
+        self.mark_indexed()
+        with patch.object(indexer.index, 'Connector'):
+            rc = indexer.RefsCleaner(mock.MagicMock(), con=mock.MagicMock())
+        rc.remove_from_state(self.pi.ref_id)
+        self.assertIsNone(self.pi.get_indexed_tip())
+
+
+class TestWorkersPool(TestCase):
+
+    def tearDown(self):
+        indexer.stop_workers_pool()
+
+    def test_workers_pool(self):
+        with patch.object(indexer, 'Commits') as c, \
+                patch.object(indexer.index, 'Connector'):
+            c.side_effect = lambda con: mock.Mock()
+            pool = indexer.start_workers_pool(2)
+            self.assertIs(indexer.start_workers_pool(2), pool)
+            ret = pool.map(worker_connection, range(20), chunksize=1)
+        # Each worker connected once to the index at startup and
+        # reused the connection for all its jobs
+        self.assertLessEqual(len(set(pid for pid, _, _ in ret)), 2)
+        self.assertEqual(len(set(ret)), len(set(pid for pid, _, _ in ret)))
+        self.assertSetEqual(set(count for _, _, count in ret), set([1]))
+        indexer.stop_workers_pool()
+        self.assertIsNot(indexer.start_workers_pool(1), pool)
+
+
+class TestTwoPhaseImport(IndexerTest):
+
+    def setUp(self):
+        super(TestTwoPhaseImport, self).setUp()
+        self.init_git_store()
+        self.upstream = self.init_repo()
+        indexer.conf['indexer_two_phase_min_commits'] = 2
+        self.shas = [
+            commit(self.upstream, 'f', '1\n', 'First commit'),
+            commit(self.upstream, 'f', '1\n2\n', 'Second commit')]
+        with patch.object(indexer.index, 'Connector'):
+            self.pi = indexer.RepoIndexer(
+                'p1', 'file://%s' % self.upstream, con=mock.MagicMock())
+        self.pi.git_init()
+        self.pi.set_branch('master')
+        self.pi.c = mock.MagicMock()
+        self.pi.c.get_existing_ids.return_value = set()
+        self.pi.git_fetch_branch()
+        self.pi.git_get_commit_obj()
+        self.pi.get_current_commits_indexed()
+        self.pi.compute_to_index_to_delete()
+
+    def tearDown(self):
+        indexer.stop_workers_pool()
+
+    def test_index_without_stats(self):
+        self.pi.run_workers = mock.Mock()
+        self.pi.index()
+        shas, _, stats = self.pi.run_workers.call_args[0]
+        self.assertSetEqual(set(shas), set(self.shas))
+        self.assertFalse(stats)
+        self.assertTrue(self.pi.is_stats_pending())
+        with patch.object(indexer.index, 'Connector'):
+            rc = indexer.RefsCleaner(mock.MagicMock(), con=mock.MagicMock())
+        rc.remove_from_state(self.pi.ref_id)
+        self.assertFalse(self.pi.is_stats_pending())
+
+    def test_index_with_stats(self):
+        indexer.conf['indexer_two_phase_min_commits'] = 3
+        self.pi.run_workers = mock.Mock()
+        self.pi.index()
+        self.assertTrue(self.pi.run_workers.call_args[0][2])
+        self.assertFalse(self.pi.is_stats_pending())
+
+    def test_backfill_stats(self):
+        self.pi.set_stats_pending(True)
+        unknown = '0' * 40
+        self.pi.c.get_stats_pending.side_effect = [
+            self.shas[::-1] + [unknown], []]
+        with patch.object(indexer, 'Commits'), \
+                patch.object(indexer.index, 'Connector'):
+            self.assertEqual(self.pi.backfill_stats(1), 3)
+        self.pi.c.get_stats_pending.assert_called_with(self.pi.ref_id, 5000)
+        self.assertListEqual(
+            self.pi.c.set_stats.call_args[0][0], [
+                {'sha': self.shas[1], 'line_modifieds': 1,
+                 'files_list': ['f']},
+                {'sha': self.shas[0], 'line_modifieds': 1,
+                 'files_list': ['f']},
+                {'sha': unknown}])
+        self.assertFalse(self.pi.is_stats_pending())
+
+    def test_backfill_stats_budget(self):
+        self.pi.set_stats_pending(True)
+        self.pi.c.get_stats_pending.return_value = self.shas[:1]
+        with patch.object(indexer, 'Commits'), \
+                patch.object(indexer.index, 'Connector'):
+            self.assertEqual(self.pi.backfill_stats(1, budget=1), 1)
+        self.pi.c.get_stats_pending.assert_called_once_with(
+            self.pi.ref_id, 1)
+        # The next runs continue the backfill
+        self.assertTrue(self.pi.is_stats_pending())
+
+
+class TestHistoryHorizon(IndexerTest):
+
+    DAY = 86400
+    START = 1400000000
+
+    def setUp(self):
+        super(TestHistoryHorizon, self).setUp()
+        self.init_git_store()
+        self.upstream = self.init_repo()
+        indexer.conf['indexer_horizon_backfill_days'] = 1
+        # One commit per day
+        self.shas = []
+        for day in range(1, 5):
+            with patch.dict(GIT_ENV, {
+                    'GIT_COMMITTER_DATE': '%s +0000' % (
+                        self.START + day * self.DAY)}):
+                self.shas.append(commit(
+                    self.upstream, 'f', '%s\n' % day, 'Day %s' % day))
+        self.pi = self.get_indexer(self.START + 3 * self.DAY)
+
+    def tearDown(self):
+        indexer.stop_workers_pool()
+
+    def get_indexer(self, index_since):
+        with patch.object(indexer.index, 'Connector'):
+            pi = indexer.RepoIndexer(
+                'p1', 'file://%s' % self.upstream, con=mock.MagicMock(),
+                index_since=index_since)
+        pi.git_init()
+        pi.set_branch('master')
+        pi.c = mock.MagicMock()
+        pi.c.get_commit.return_value = None
+        return pi
+
+    def test_index_since(self):
+        self.assertEqual(self.pi.horizon, self.START + 3 * self.DAY)
+        self.pi.git_fetch_branches(['master'], since=self.pi.horizon)
+        self.assertSetEqual(
+            indexer.get_shallow_commits(self.pi.local), set([self.shas[2]]))
+        self.pi.git_get_commit_obj()
+        # The boundary commit is left to the horizon extension
+        self.assertListEqual(list(self.pi.commits), [self.shas[3]])
+        # The commits older than the horizon are not deleted
+        self.pi.c.get_commits.return_value = [
+            {'_id': sha} for sha in self.shas[2:]]
+        self.pi.get_current_commits_indexed()
+        self.pi.c.get_commits.assert_called_once_with(
+            repos=[self.pi.ref_id], fromdate=self.pi.horizon, scan=True)
+        self.pi.compute_to_index_to_delete()
+        self.assertSetEqual(self.pi.to_index, set())
+        self.assertSetEqual(self.pi.to_delete, set())
+
+    def test_no_commits_since(self):
+        pi = self.get_indexer(self.START + 10 * self.DAY)
+        pi.git_fetch_branches(['master'], since=pi.horizon)
+        self.assertSetEqual(
+            indexer.get_shallow_commits(pi.local), set([self.shas[3]]))
+        pi.git_get_commit_obj()
+        self.assertListEqual(list(pi.commits), [])
+        pi.save_indexed_tip()
+        pi.heads = [[self.shas[3], 'refs/heads/master']]
+        self.assertTrue(pi.is_branch_fully_indexed())
+
+    def test_extend_horizon(self):
+        self.pi.git_fetch_branches(['master'], since=self.pi.horizon)
+        self.pi.save_indexed_tip = mock.Mock()
+        self.pi.run_workers = mock.Mock()
+        self.pi.c.get_commits.return_value = [{'_id': self.shas[3]}]
+        self.pi.c.get_existing_ids.return_value = set()
+        self.assertTrue(self.pi.is_horizon_extensible())
+        since = self.pi.get_extended_horizon()
+        self.assertEqual(self.pi.extend_horizon(1, since), 1)
+        self.assertEqual(self.pi.horizon, self.START + 2 * self.DAY)
+        self.assertListEqual(
+            list(self.pi.run_workers.call_args[0][0]), [self.shas[2]])
+        # The next runs start from the extended horizon
+        self.assertEqual(
+            self.get_indexer(self.START + 3 * self.DAY).horizon,
+            self.START + 2 * self.DAY)
+
+        # Extend up to the first commit
+        indexer.conf['indexer_horizon_backfill_days'] = 10
+        self.pi.c.get_commits.return_value = [
+            {'_id': sha} for sha in self.shas[2:]]
+        self.assertEqual(self.pi.extend_horizon(
+            1, self.pi.get_extended_horizon()), 2)
+        self.assertEqual(self.pi.horizon, 0)
+        self.assertFalse(self.pi.is_horizon_extensible())
+        self.assertSetEqual(
+            indexer.get_shallow_commits(self.pi.local), set())
+
+        with patch.object(indexer.index, 'Connector'):
+            rc = indexer.RefsCleaner(mock.MagicMock(), con=mock.MagicMock())
+        rc.remove_from_state(self.pi.ref_id)
+        self.assertEqual(
+            self.get_indexer(self.START + 3 * self.DAY).horizon,
+            self.START + 3 * self.DAY)
+
+
 class TestRefsClean(TestCase):
 
     @classmethod
@@ -252,6 +700,7 @@ class TestRefsClean(TestCase):
         indexer.conf['db_path'] = tempfile.mkdtemp()
         indexer.conf['db_cache_path'] = tempfile.mkdtemp()
         indexer.conf['elasticsearch_index'] = 'repoxplorertest'
+        indexer.conf['indexer_extract_mode'] = 'show'
         indexer.get_commits_desc = lambda path, shas: []
         cls.con = index.Connector()
         cls.cmts = commits.Commits(cls.con)
@@ -264,19 +713,18 @@ class TestRefsClean(TestCase):
         cls.con.ic.delete(index=cls.con.index)
 
     def setUp(self):
-        self.seen_refs = os.path.join(
-            indexer.conf['db_cache_path'], indexer.SEEN_REFS_CACHED)
-        if os.path.isfile(self.seen_refs):
-            os.unlink(self.seen_refs)
-
-    def tearDown(self):
-        os.unlink(self.seen_refs)
+        self.state = state_store.get_store()
+        for ref in self.state.get_seen_refs():
+            self.state.remove_ref(ref)
 
     def init_fake_process_commits_desc_output(self, pi, repo_commits):
         to_create, _ = pi.compute_to_create_to_update()
         to_create = [
             c for c in repo_commits if c['sha'] in to_create]
-        indexer.process_commits_desc_output = lambda buf, ref_id: to_create
+        # Workers are forked with the fake output
+        indexer.stop_workers_pool()
+        indexer.process_commits_desc_output = (
+            lambda buf, ref_id, extra_parsers=None: to_create)
 
     def test_cleaner(self):
         pi = indexer.RepoIndexer('p1', 'file:///tmp/p1',
@@ -416,6 +864,7 @@ class TestRepoIndexer(TestCase):
         indexer.conf['db_path'] = tempfile.mkdtemp()
         indexer.conf['db_cache_path'] = tempfile.mkdtemp()
         indexer.conf['elasticsearch_index'] = 'repoxplorertest'
+        indexer.conf['indexer_extract_mode'] = 'show'
         indexer.get_commits_desc = lambda path, shas: []
         cls.con = index.Connector()
         cls.cmts = commits.Commits(cls.con)
@@ -428,26 +877,25 @@ class TestRepoIndexer(TestCase):
         cls.con.ic.delete(index=cls.con.index)
 
     def setUp(self):
-        self.seen_refs = os.path.join(
-            indexer.conf['db_cache_path'], indexer.SEEN_REFS_CACHED)
-        if os.path.isfile(self.seen_refs):
-            os.unlink(self.seen_refs)
-
-    def tearDown(self):
-        os.unlink(self.seen_refs)
+        self.state = state_store.get_store()
+        for ref in self.state.get_seen_refs():
+            self.state.remove_ref(ref)
 
     def init_fake_process_commits_desc_output(self, pi, repo_commits):
         to_create, _ = pi.compute_to_create_to_update()
         to_create = [
             c for c in repo_commits if c['sha'] in to_create]
-        indexer.process_commits_desc_output = lambda buf, ref_id: to_create
+        # Workers are forked with the fake output
+        indexer.stop_workers_pool()
+        indexer.process_commits_desc_output = (
+            lambda buf, ref_id, extra_parsers=None: to_create)
 
     def test_init(self):
         pi = indexer.RepoIndexer('p1', 'file:///tmp/p1')
         pi.set_branch('master')
         self.assertEqual(pi.ref_id, 'file:///tmp/p1:p1:master')
         self.assertTrue(os.path.isdir(indexer.conf['git_store']))
-        seen_refs = pickle.load(open(self.seen_refs, 'rb'))
+        seen_refs = self.state.get_seen_refs()
         self.assertTrue(len(seen_refs), 1)
         self.assertIn('file:///tmp/p1:p1:master', seen_refs)
 
@@ -457,7 +905,7 @@ class TestRepoIndexer(TestCase):
         self.assertEqual(pi.ref_id, 'file:///tmp/p1:p1:master')
         self.assertEqual(pi.meta_ref, 'meta_ref: Fedora')
         self.assertTrue(os.path.isdir(indexer.conf['git_store']))
-        seen_refs = pickle.load(open(self.seen_refs, 'rb'))
+        seen_refs = self.state.get_seen_refs()
         # The meta-ref is not added to seen refs store
         self.assertTrue(len(seen_refs), 1)
         self.assertIn('file:///tmp/p1:p1:master', seen_refs)
@@ -492,6 +940,7 @@ class TestRepoIndexer(TestCase):
         pi.get_current_commits_indexed()
         pi.compute_to_index_to_delete()
         self.init_fake_process_commits_desc_output(pi, repo_commits)
+        pi.tip = pi.heads[0][0]
         pi.index()
         # Check
         self.assertDictEqual(
@@ -524,6 +973,7 @@ class TestRepoIndexer(TestCase):
         pi.get_current_commits_indexed()
         pi.compute_to_index_to_delete()
         self.init_fake_process_commits_desc_output(pi, repo_commits)
+        pi.tip = pi.heads[0][0]
         pi.index()
         # Check
         cmts = set([c['_source']['sha'] for c in
@@ -543,6 +993,7 @@ class TestRepoIndexer(TestCase):
         pi.get_current_commits_indexed()
         pi.compute_to_index_to_delete()
         self.init_fake_process_commits_desc_output(pi, repo_commits)
+        pi.tip = pi.heads[0][0]
         pi.index()
         # Check
         self.assertDictEqual(
@@ -580,6 +1031,7 @@ class TestRepoIndexer(TestCase):
         pi2.get_current_commits_indexed()
         pi2.compute_to_index_to_delete()
         self.init_fake_process_commits_desc_output(pi2, repo2_commits)
+        pi2.tip = pi2.heads[0][0]
         pi2.index()
         # Check the commits has been marked belonging to both repos
         cmt = self.cmts.get_commit(repo2_commits[0]['sha'])
@@ -612,6 +1064,7 @@ class TestRepoIndexer(TestCase):
         pi2.get_current_commits_indexed()
         pi2.compute_to_index_to_delete()
         self.init_fake_process_commits_desc_output(pi2, repo2_commits)
+        pi2.tip = pi2.heads[0][0]
         pi2.index()
         # Check the commits has been marked belonging to both repos
         cmt = self.cmts.get_commit(repo2_commits[1]['sha'])
@@ -669,7 +1122,10 @@ class TestRepoIndexer(TestCase):
         to_create, _ = pi.compute_to_create_to_update()
         to_create = [
             c for c in repo_commits if c['sha'] in to_create]
-        indexer.process_commits_desc_output = lambda buf, ref_id: to_create
+        # Workers are forked with the fake output
+        indexer.stop_workers_pool()
+        indexer.process_commits_desc_output = (
+            lambda buf, ref_id, extra_parsers=None: to_create)
         pi.index()
         # Start indexation of tags
         pi.index_tags()
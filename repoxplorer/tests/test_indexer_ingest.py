@@ -0,0 +1,77 @@
+import os
+import mock
+
+from repoxplorer.index.commits import Commits
+from repoxplorer.indexer.git import ingest
+from repoxplorer.indexer.git import scheduler
+from repoxplorer.tests import IndexerTest
+
+
+class TestIngestMode(IndexerTest):
+
+    def setUp(self):
+        super(TestIngestMode, self).setUp()
+        self.con = mock.MagicMock()
+        self.con.index = 'repoxplorertest'
+        self.con.ic.get_settings.return_value = {
+            'repoxplorertest': {
+                'settings': {
+                    'index': {
+                        'number_of_replicas': '1',
+                    }
+                }
+            }
+        }
+        self.con.es.count.side_effect = [
+            {'count': 10}, {'count': 110}]
+        self.settings_path = os.path.join(
+            self.db_cache_path, ingest.INGEST_SETTINGS_CACHED)
+
+    def test_ingest_mode(self):
+        im = ingest.IngestMode(self.con, replicas=0, min_commits=100)
+        im.start()
+        self.con.ic.put_settings.assert_called_once_with(
+            index='repoxplorertest',
+            body={'index': {'refresh_interval': '-1',
+                            'number_of_replicas': 0}})
+        self.assertTrue(os.path.isfile(self.settings_path))
+        report = scheduler.CycleReport()
+        self.assertEqual(im.stop(report), 100)
+        self.con.ic.put_settings.assert_called_with(
+            index='repoxplorertest',
+            body={'index': {'refresh_interval': None,
+                            'number_of_replicas': '1'}})
+        self.assertTrue(self.con.ic.forcemerge.called)
+        self.assertFalse(os.path.isfile(self.settings_path))
+        self.assertEqual(report.counters['ingested_commits'], 100)
+        self.assertIn('forcemerge', report.stages)
+
+    def test_ingest_mode_small_import(self):
+        im = ingest.IngestMode(self.con, min_commits=1000)
+        im.start()
+        self.assertEqual(im.stop(), 100)
+        # The settings are restored without a force merge
+        self.con.ic.put_settings.assert_called_with(
+            index='repoxplorertest',
+            body={'index': {'refresh_interval': None,
+                            'number_of_replicas': '1'}})
+        self.assertFalse(self.con.ic.forcemerge.called)
+
+    def test_ingest_mode_interrupted(self):
+        ingest.IngestMode(self.con).start()
+        # The indexer died before the end of the ingest run
+        self.con.ic.get_settings.return_value['repoxplorertest'][
+            'settings']['index']['refresh_interval'] = '-1'
+        im = ingest.IngestMode(self.con)
+        im.start()
+        self.assertDictEqual(
+            im.original,
+            {'refresh_interval': None, 'number_of_replicas': '1'})
+
+    def test_commits_refresh(self):
+        c = Commits(self.con)
+        c.auto_refresh = False
+        c.refresh()
+        self.assertFalse(self.con.es.indices.refresh.called)
+        c.refresh(force=True)
+        self.assertTrue(self.con.es.indices.refresh.called)
@@ -0,0 +1,129 @@
+import mock
+
+from mock import patch
+
+from elasticsearch.exceptions import ConflictError
+from elasticsearch.exceptions import NotFoundError
+
+from repoxplorer.indexer.git import leases
+from repoxplorer.indexer.git import scheduler
+from repoxplorer.indexer.git import state_store
+from repoxplorer.tests import IndexerTest
+
+
+class FakeES(object):
+    """ Lease documents with the optimistic concurrency control of
+    Elasticsearch
+    """
+    def __init__(self):
+        self.docs = {}
+        self.seq_no = 0
+
+    def get(self, index, doc_type, id):
+        if id not in self.docs:
+            raise NotFoundError(404, 'not_found')
+        return self.docs[id]
+
+    def index(self, index, doc_type, id, body, refresh=False,
+              op_type=None, if_seq_no=None, if_primary_term=None):
+        doc = self.docs.get(id)
+        if op_type == 'create' and doc:
+            raise ConflictError(409, 'version_conflict')
+        if if_seq_no is not None and (
+                not doc or doc['_seq_no'] != if_seq_no):
+            raise ConflictError(409, 'version_conflict')
+        self.seq_no += 1
+        self.docs[id] = {'_id': id, '_source': dict(body),
+                         '_seq_no': self.seq_no, '_primary_term': 1}
+        return {'_seq_no': self.seq_no, '_primary_term': 1}
+
+    def delete(self, index, doc_type, id, if_seq_no, if_primary_term):
+        if self.docs[id]['_seq_no'] != if_seq_no:
+            raise ConflictError(409, 'version_conflict')
+        del self.docs[id]
+
+    def scan(self, es, query, index):
+        kind = query['query']['term']['kind']
+        return [doc for doc in list(self.docs.values())
+                if doc['_source']['kind'] == kind]
+
+
+class TestLeaseManager(IndexerTest):
+
+    def setUp(self):
+        super(TestLeaseManager, self).setUp()
+        self.es = FakeES()
+        self.connector = mock.MagicMock()
+        self.connector.es = self.es
+        self.patcher = patch.object(leases, 'scanner', self.es.scan)
+        self.patcher.start()
+        self.jobs = []
+        for i in range(5):
+            job = scheduler.RepoJob('p%s' % i, 'https://host/p%s' % i)
+            job.add_ref({'name': job.name, 'uri': job.uri,
+                         'branch': 'master', 'parsers': []})
+            self.jobs.append(job)
+
+    def tearDown(self):
+        self.patcher.stop()
+
+    def get_manager(self, node):
+        manager = leases.LeaseManager(self.connector, node=node, ttl=60)
+        manager.heartbeat()
+        return manager
+
+    def expire(self, node):
+        for doc in self.es.docs.values():
+            if doc['_source']['owner'] == node:
+                doc['_source']['expires'] = 0
+
+    def test_share(self):
+        n1 = self.get_manager('n1')
+        self.assertListEqual(n1.select(self.jobs), self.jobs)
+        # A node joins, n1 leaves it its share at the next cycle
+        n2 = self.get_manager('n2')
+        self.assertListEqual(n2.select(self.jobs), [])
+        mine = n1.select(self.jobs)
+        self.assertEqual(len(mine), 3)
+        theirs = n2.select(self.jobs)
+        self.assertEqual(len(theirs), 2)
+        self.assertSetEqual(set(mine) | set(theirs), set(self.jobs))
+        # Stable between cycles
+        self.assertListEqual(n1.select(self.jobs), mine)
+        self.assertListEqual(n2.select(self.jobs), theirs)
+
+    def test_takeover(self):
+        state = state_store.get_store()
+        n1 = self.get_manager('n1')
+        n2 = self.get_manager('n2')
+        mine = n1.select(self.jobs)
+        theirs = n2.select(self.jobs)
+        ref_id = '%s:master' % theirs[0].base_id
+        state.set_indexed_tip(ref_id, 'sha')
+        # n2 crashed, its leases expire
+        self.expire('n2')
+        self.assertListEqual(n1.select(self.jobs), self.jobs)
+        # The refs indexed by another node are compared to the index again
+        self.assertIsNone(state.get_indexed_tip(ref_id))
+        # n2 lost its leases
+        n2.heartbeat()
+        self.assertSetEqual(n2.leased, set())
+        self.assertEqual(len(mine), 3)
+
+    def test_leader(self):
+        n1 = self.get_manager('n1')
+        n2 = self.get_manager('n2')
+        self.assertTrue(n1.is_leader())
+        self.assertFalse(n2.is_leader())
+        self.assertTrue(n1.is_leader())
+        n1.stop()
+        self.assertTrue(n2.is_leader())
+        self.assertListEqual(n2.get_nodes(), ['n2'])
+
+    def test_removed_jobs(self):
+        n1 = self.get_manager('n1')
+        n1.select(self.jobs)
+        self.assertListEqual(n1.select(self.jobs[:2]), self.jobs[:2])
+        self.assertEqual(
+            len(self.es.scan(None, {'query': {'term': {'kind': 'repo'}}},
+                             None)), 2)
@@ -0,0 +1,102 @@
+import os
+import time
+import subprocess
+
+from mock import patch
+
+from repoxplorer.indexer.git import indexer
+from repoxplorer.indexer.git import scheduler
+from repoxplorer.indexer.git import maintenance
+from repoxplorer.tests import IndexerTest
+from repoxplorer.tests import git
+from repoxplorer.tests import commit
+
+
+class TestGitMaintainer(IndexerTest):
+
+    def setUp(self):
+        super(TestGitMaintainer, self).setUp()
+        self.init_git_store()
+        self.upstream = self.init_repo()
+        self.master = commit(self.upstream, 'f', '1\n', 'First commit')
+        git(self.upstream, 'checkout', '-q', '-b', 'devel')
+        self.devel = commit(self.upstream, 'f', '2\n', 'Devel commit')
+        git(self.upstream, 'checkout', '-q', 'master')
+        uri = 'file://%s' % self.upstream
+        with patch.object(indexer.index, 'Connector'):
+            pi = indexer.RepoIndexer('p1', uri)
+        pi.git_init()
+        pi.git_fetch_branches(['master', 'devel'])
+        self.local = pi.local
+        # devel is no longer indexed
+        self.job = scheduler.RepoJob('p1', uri)
+        self.job.add_ref({'name': 'p1', 'uri': uri, 'branch': 'master'})
+        self.maintainer = maintenance.GitMaintainer()
+
+    def exists(self, sha):
+        return subprocess.call(
+            ['git', 'cat-file', '-e', sha], cwd=self.local,
+            stderr=subprocess.DEVNULL) == 0
+
+    def test_run(self):
+        report = scheduler.CycleReport()
+        self.assertEqual(self.maintainer.run([self.job], report), 4)
+        self.assertTrue(os.path.isfile(os.path.join(
+            self.local, 'objects', 'info', 'commit-graphs',
+            'commit-graph-chain')))
+        if maintenance.get_git_version() >= (2, 34):
+            self.assertTrue(os.path.isfile(os.path.join(
+                self.local, 'objects', 'pack', 'multi-pack-index')))
+        self.assertEqual(
+            git(self.local, 'for-each-ref', '--format=%(refname)',
+                'refs/heads/').split(), ['refs/heads/master'])
+        self.assertTrue(self.exists(self.master))
+        self.assertFalse(self.exists(self.devel))
+        self.assertEqual(report.counters['maintenance_tasks'], 4)
+        self.assertNotIn('errors', report.counters)
+        self.assertEqual(report.stages['maintenance'][1], 4)
+        self.assertGreater(report.gauges['git_store_bytes'], 0)
+        summary = self.maintainer.summary()
+        self.assertListEqual(list(summary), [self.local])
+        self.assertSetEqual(
+            set(summary[self.local]['tasks']), set(maintenance.TASKS))
+        # Nothing is due until the intervals are over
+        self.assertListEqual(self.maintainer.get_due_tasks([self.job]), [])
+        self.assertListEqual(
+            self.maintainer.get_due_tasks(
+                [self.job], now=time.time() + 24 * 3600),
+            [(self.job, 'pool'), (self.job, 'commit-graph'),
+             (self.job, 'pack')])
+
+    def test_get_due_tasks(self):
+        indexer.conf['indexer_maintenance_commit_graph_interval'] = 10
+        indexer.conf['indexer_maintenance_pack_interval'] = 100
+        indexer.conf['indexer_maintenance_prune_interval'] = 0
+        indexer.conf['indexer_maintenance_pool_interval'] = 0
+        self.maintainer.save_task(self.local, 'commit-graph', 1000, 1)
+        self.maintainer.save_task(self.local, 'pack', 1000, 1)
+        # The most overdue task first, prune is disabled
+        self.assertListEqual(
+            self.maintainer.get_due_tasks([self.job], now=1200),
+            [(self.job, 'commit-graph'), (self.job, 'pack')])
+        self.assertListEqual(
+            self.maintainer.get_due_tasks([self.job], now=1050),
+            [(self.job, 'commit-graph')])
+        # Repositories not fetched yet are skipped
+        job = scheduler.RepoJob('p2', 'file:///unknown')
+        self.assertListEqual(self.maintainer.get_due_tasks([job]), [])
+
+    def test_run_deadline(self):
+        report = scheduler.CycleReport()
+        self.assertEqual(
+            self.maintainer.run([self.job], report, time.time() - 1), 0)
+        self.assertEqual(self.maintainer.get_state(), {})
+
+    def test_run_failure(self):
+        report = scheduler.CycleReport()
+        with patch.object(maintenance, 'repack') as repack:
+            repack.side_effect = Exception('failure')
+            self.assertEqual(self.maintainer.run([self.job], report), 4)
+        self.assertEqual(report.counters['errors'], 1)
+        # Retried after the interval
+        self.assertIn('pack', self.maintainer.get_state()[self.local])
@@ -0,0 +1,105 @@
+import os
+import json
+import socket
+import urllib.request
+
+from mock import patch
+
+from repoxplorer.indexer.git import indexer
+from repoxplorer.indexer.git import metrics
+from repoxplorer.indexer.git import scheduler
+from repoxplorer.tests import IndexerTest
+from repoxplorer.tests import git
+from repoxplorer.tests import commit
+
+
+class TestMetrics(IndexerTest):
+
+    def setUp(self):
+        super(TestMetrics, self).setUp()
+        self.path = self.mkdtemp()
+        self.registry = metrics.Registry()
+        self.patcher = patch.object(metrics, '_registry', self.registry)
+        self.patcher.start()
+
+    def tearDown(self):
+        self.patcher.stop()
+
+    def test_render(self):
+        metrics.incr('refs_indexed', 2)
+        metrics.incr('failures', stage='fetch')
+        metrics.gauge('repos_due', 3)
+        metrics.observe('stage_seconds', 0.2, stage='fetch')
+        metrics.observe('stage_seconds', 7200, stage='fetch')
+        lines = self.registry.render().splitlines()
+        for line in (
+                '# TYPE repoxplorer_indexer_refs_indexed_total counter',
+                'repoxplorer_indexer_refs_indexed_total 2',
+                'repoxplorer_indexer_failures_total{stage="fetch"} 1',
+                '# TYPE repoxplorer_indexer_repos_due gauge',
+                'repoxplorer_indexer_repos_due 3',
+                '# TYPE repoxplorer_indexer_stage_seconds histogram',
+                'repoxplorer_indexer_stage_seconds_bucket'
+                '{stage="fetch",le="0.1"} 0',
+                'repoxplorer_indexer_stage_seconds_bucket'
+                '{stage="fetch",le="0.5"} 1',
+                'repoxplorer_indexer_stage_seconds_bucket'
+                '{stage="fetch",le="3600"} 1',
+                'repoxplorer_indexer_stage_seconds_bucket'
+                '{stage="fetch",le="+Inf"} 2',
+                'repoxplorer_indexer_stage_seconds_sum{stage="fetch"} 7200.2',
+                'repoxplorer_indexer_stage_seconds_count{stage="fetch"} 2'):
+            self.assertIn(line, lines)
+
+    def test_cycle_report(self):
+        report = scheduler.CycleReport()
+        with report.stage('fetch'):
+            pass
+        try:
+            with report.stage('fetch'):
+                raise Exception('Unable to fetch')
+        except Exception:
+            report.incr('errors')
+        report.gauge('repos_due', 1)
+        report.stop()
+        summary = report.summary()
+        self.assertDictEqual(
+            dict((k, v) for k, v in summary['stages']['fetch'].items()
+                 if k != 'busy_time'),
+            {'count': 2, 'failures': 1})
+        self.assertEqual(
+            self.registry.counters[('failures', (('stage', 'fetch'),))], 1)
+        self.assertEqual(self.registry.counters[('errors', ())], 1)
+        self.assertEqual(
+            self.registry.histograms[
+                ('stage_seconds', (('stage', 'fetch'),))][2], 2)
+        # Files written at the end of the cycle
+        textfile = os.path.join(self.path, 'indexer.prom')
+        summary_file = os.path.join(self.path, 'summary.json')
+        indexer.conf['indexer_metrics_textfile'] = textfile
+        indexer.conf['indexer_metrics_summary'] = summary_file
+        metrics.export(report)
+        self.assertIn('repoxplorer_indexer_cycle_seconds_count 1',
+                      open(textfile).read().splitlines())
+        self.assertDictEqual(
+            json.load(open(summary_file))['counters'], {'errors': 1})
+
+    def test_server(self):
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+        sock.close()
+        metrics.incr('refs_indexed')
+        self.assertEqual(metrics.start_server('127.0.0.1', port), port)
+        try:
+            body = urllib.request.urlopen(
+                'http://127.0.0.1:%s/metrics' % port).read().decode()
+        finally:
+            metrics.stop_server()
+        self.assertIn('repoxplorer_indexer_refs_indexed_total 1', body)
+
+    def test_get_packs_size(self):
+        git(self.path, 'init', '-q', '-b', 'master', '.')
+        self.assertEqual(indexer.get_packs_size(self.path), 0)
+        commit(self.path, 'f', 'a\n' * 1000, 'First commit')
+        self.assertGreater(indexer.get_packs_size(self.path), 0)
@@ -0,0 +1,149 @@
+import threading
+
+from unittest import TestCase
+from multiprocessing.pool import ThreadPool
+
+from elasticsearch import TransportError
+from elasticsearch.helpers import BulkIndexError
+
+from repoxplorer.indexer.git import pipeline
+
+
+class FakeCommits(object):
+    def __init__(self, reject=None, fail=None, overload=0):
+        self.lock = threading.Lock()
+        self.indexed = []
+        self.batches = []
+        self.refreshed = False
+        # shas rejected once with a 429
+        self.reject = set(reject or [])
+        # shas that fail to be indexed
+        self.fail = set(fail or [])
+        # amount of whole requests rejected with a 429
+        self.overload = overload
+
+    def bulk_create(self, sources):
+        with self.lock:
+            self.batches.append(len(sources))
+            if self.overload:
+                self.overload -= 1
+                raise TransportError(429, 'es_rejected_execution_exception')
+            created, rejected, errors = [], [], []
+            for source in sources:
+                if source['sha'] in self.reject:
+                    self.reject.remove(source['sha'])
+                    rejected.append(source)
+                elif source['sha'] in self.fail:
+                    errors.append({'_id': source['sha'], 'status': 400})
+                else:
+                    self.indexed.append(source['sha'])
+                    created.append(source['sha'])
+            return created, rejected, errors
+
+    def refresh(self):
+        self.refreshed = True
+
+
+def extract(shas):
+    return [{'sha': sha} for sha in shas]
+
+
+class TestBulkController(TestCase):
+
+    def test_adapt(self):
+        c = pipeline.BulkController(
+            max_concurrency=4, min_batch=10, max_batch=40,
+            target_latency=1.0)
+        for _ in range(5):
+            c.acquire()
+            c.release(0.1, 10, 0)
+        self.assertEqual(c.concurrency, 4)
+        self.assertEqual(c.batch_size, 40)
+        # Slow bulk
+        c.acquire()
+        c.release(1.5, 10, 0)
+        self.assertEqual(c.concurrency, 2)
+        self.assertEqual(c.batch_size, 20)
+        # Rejected documents
+        c.acquire()
+        c.release(0.1, 5, 5)
+        self.assertEqual(c.concurrency, 1)
+        self.assertEqual(c.batch_size, 10)
+        self.assertEqual(c.stats['rejected'], 5)
+        self.assertEqual(c.stats['bulks'], 7)
+
+
+class TestBulkWriter(TestCase):
+
+    def get_writer(self, commits):
+        controller = pipeline.BulkController(
+            max_concurrency=3, min_batch=5, max_batch=20)
+        return pipeline.BulkWriter(commits, controller=controller,
+                                   initial_backoff=0)
+
+    def test_write(self):
+        shas = ['sha%s' % i for i in range(103)]
+        commits = FakeCommits(reject=shas[10:15], overload=2)
+        writer = self.get_writer(commits)
+        for i in range(0, len(shas), 10):
+            writer.put(extract(shas[i:i + 10]))
+        created = writer.close()
+        self.assertListEqual(sorted(created), sorted(shas))
+        self.assertListEqual(sorted(commits.indexed), sorted(shas))
+        self.assertTrue(commits.refreshed)
+        self.assertLessEqual(max(commits.batches), 20)
+
+    def test_write_errors(self):
+        commits = FakeCommits(fail=['sha1'])
+        writer = self.get_writer(commits)
+        writer.put(extract(['sha0', 'sha1', 'sha2']))
+        with self.assertRaises(BulkIndexError) as ctx:
+            writer.close()
+        self.assertListEqual(
+            [e['_id'] for e in ctx.exception.errors], ['sha1'])
+        self.assertListEqual(sorted(writer.created), ['sha0', 'sha2'])
+
+    def test_on_created(self):
+        created = []
+        writer = pipeline.BulkWriter(
+            FakeCommits(fail=['sha1']),
+            controller=pipeline.BulkController(max_concurrency=2),
+            on_created=created.extend)
+        writer.put(extract(['sha0', 'sha1', 'sha2']))
+        with self.assertRaises(BulkIndexError):
+            writer.close()
+        self.assertListEqual(sorted(created), ['sha0', 'sha2'])
+
+
+class TestPipeline(TestCase):
+
+    def setUp(self):
+        self.pool = ThreadPool(2)
+
+    def tearDown(self):
+        self.pool.terminate()
+
+    def test_run(self):
+        commits = FakeCommits()
+        writer = pipeline.BulkWriter(
+            commits, controller=pipeline.BulkController(max_concurrency=2))
+        options = [['sha%s-%s' % (i, j) for j in range(50)]
+                   for i in range(10)]
+        created = pipeline.run(self.pool, extract, options, writer, 2)
+        self.assertEqual(len(created), 500)
+        self.assertEqual(len(set(commits.indexed)), 500)
+
+    def test_run_failure(self):
+        commits = FakeCommits()
+        writer = pipeline.BulkWriter(
+            commits, controller=pipeline.BulkController(max_concurrency=2))
+
+        def put(cmts):
+            raise Exception('writer failure')
+        writer.put = put
+        options = [['sha%s' % i] for i in range(10)]
+        with self.assertRaises(Exception):
+            pipeline.run(self.pool, extract, options, writer, 2)
+        # The pool is still usable
+        self.assertListEqual(
+            self.pool.map(extract, [['sha']]), [[{'sha': 'sha'}]])
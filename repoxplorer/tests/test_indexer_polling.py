@@ -0,0 +1,99 @@
+from repoxplorer.indexer.git import indexer
+from repoxplorer.indexer.git import polling
+from repoxplorer.indexer.git import scheduler
+from repoxplorer.indexer.git import state_store
+from repoxplorer.tests import IndexerTest
+
+
+class TestPollingSchedule(IndexerTest):
+
+    def setUp(self):
+        super(TestPollingSchedule, self).setUp()
+        indexer.conf['indexer_poll_min_interval'] = 10
+        indexer.conf['indexer_poll_max_interval'] = 100
+        indexer.conf['indexer_poll_backoff'] = 3
+        self.state = state_store.StateStore(':memory:')
+        self.schedule = polling.PollingSchedule(self.state)
+        self.jobs = [self.get_job('p%s' % i) for i in range(3)]
+
+    def tearDown(self):
+        self.state.close()
+
+    def get_job(self, name):
+        job = scheduler.RepoJob(name, 'https://host/%s' % name)
+        for branch in ('master', 'stable'):
+            job.add_ref({'name': name, 'uri': job.uri, 'branch': branch,
+                         'parsers': []})
+        return job
+
+    def test_backoff(self):
+        job = self.jobs[0]
+        ref_id = '%s:master' % job.base_id
+        job.changed = set([ref_id])
+        self.schedule.record([job], now=1000)
+        schedule = self.state.get_schedule()
+        self.assertEqual(schedule[ref_id]['next_due'], 1010)
+        self.assertEqual(schedule[ref_id]['changes'], 1)
+        job.changed = set()
+        intervals = []
+        for now in (1010, 1040, 1130, 1230):
+            self.schedule.record([job], now=now)
+            intervals.append(self.state.get_schedule()[ref_id]['interval'])
+        # Exponential back-off up to the ceiling
+        self.assertListEqual(intervals, [30, 90, 100, 100])
+        entry = self.state.get_schedule()[ref_id]
+        self.assertEqual(entry['polls'], 5)
+        self.assertEqual(entry['changes'], 1)
+        self.assertEqual(entry['last_change'], 1000)
+        # A change brings the ref back to the minimal interval
+        job.changed = set([ref_id])
+        self.schedule.record([job], now=1330)
+        self.assertEqual(self.state.get_schedule()[ref_id]['interval'], 10)
+
+    def test_failed_fetch(self):
+        job = self.jobs[0]
+        ref_id = '%s:master' % job.base_id
+        self.schedule.record([job], now=1000)
+        entry = self.state.get_schedule()[ref_id]
+        # The repository could not be reached, its schedule is kept
+        job.failed = True
+        self.schedule.record([job], now=1010)
+        self.assertDictEqual(self.state.get_schedule()[ref_id], entry)
+        self.assertListEqual(
+            self.schedule.select(self.jobs[:1], now=1010), [job])
+        job.failed = False
+        self.schedule.record([job], now=1010)
+        self.assertEqual(self.state.get_schedule()[ref_id]['interval'], 30)
+
+    def test_select(self):
+        self.jobs[0].changed = set(['%s:master' % self.jobs[0].base_id])
+        self.schedule.record(self.jobs[:2], now=1000)
+        self.schedule.record(self.jobs[1:2], now=1005)
+        # The never polled repository first, then the most overdue
+        self.assertListEqual(
+            self.schedule.select(self.jobs, now=1040),
+            [self.jobs[2], self.jobs[0], self.jobs[1]])
+        # p1 backed off to 30s at its second poll
+        self.assertListEqual(
+            self.schedule.select(self.jobs, now=1020),
+            [self.jobs[2], self.jobs[0]])
+        # A ref just added to a repository makes it due
+        self.jobs[1].add_ref({'name': 'p1', 'uri': self.jobs[1].uri,
+                              'branch': 'new', 'parsers': []})
+        self.assertListEqual(
+            self.schedule.select(self.jobs[1:], now=1012),
+            [self.jobs[1], self.jobs[2]])
+
+    def test_summary(self):
+        ref_id = '%s:master' % self.jobs[0].base_id
+        self.schedule.record(self.jobs[:1], now=1000)
+        self.state.record_run(ref_id, 2.5)
+        summary = self.schedule.summary(self.jobs, now=1004)
+        self.assertEqual(len(summary), 6)
+        self.assertEqual(summary[ref_id]['due_in'], 6)
+        self.assertEqual(summary[ref_id]['last_duration'], 2.5)
+        self.assertIsNone(
+            summary['%s:master' % self.jobs[1].base_id]['due_in'])
+        # Removed refs are removed from the schedule
+        self.state.remove_ref(ref_id)
+        self.assertNotIn(ref_id, self.state.get_schedule())
@@ -0,0 +1,79 @@
+import os
+
+from mock import patch
+
+from repoxplorer.indexer.git import pools
+from repoxplorer.indexer.git import indexer
+from repoxplorer.indexer.git import maintenance
+from repoxplorer.tests import IndexerTest
+from repoxplorer.tests import git
+from repoxplorer.tests import commit
+
+
+def count_objects(path):
+    out = git(path, 'count-objects', '-v')
+    counts = dict(line.split(': ') for line in out.splitlines())
+    return int(counts['count']) + int(counts['in-pack'])
+
+
+class TestObjectsPools(IndexerTest):
+
+    def setUp(self):
+        super(TestObjectsPools, self).setUp()
+        self.init_git_store()
+        self.upstream = self.init_repo()
+        indexer.conf['indexer_extract_mode'] = 'stream'
+        self.shas = [
+            commit(self.upstream, 'f', '1\n', 'First commit'),
+            commit(self.upstream, 'f', '1\n2\n', 'Second commit')]
+
+    def get_indexer(self, name, pool=None):
+        with patch.object(indexer.index, 'Connector'):
+            pi = indexer.RepoIndexer(
+                name, 'file://%s' % self.upstream, pool=pool)
+        pi.git_init()
+        pi.set_branch('master')
+        pi.git_fetch_branch()
+        return pi
+
+    def test_pool(self):
+        fork1 = self.get_indexer('fork1', pool='org/upstream')
+        pool = pools.get_pool_path('org/upstream')
+        self.assertEqual(pools.get_pool(fork1.local), pool)
+        self.assertGreater(count_objects(fork1.local), 0)
+        self.assertEqual(maintenance.pool_objects(fork1.local), pool)
+        self.assertListEqual(
+            git(pool, 'for-each-ref', '--format=%(objectname)').split(),
+            [self.shas[-1]])
+        # The objects are only stored in the pool
+        self.assertEqual(count_objects(fork1.local), 0)
+        self.assertListEqual(
+            indexer.get_all_shas(fork1.local, 'refs/heads/master'),
+            self.shas[::-1])
+
+        # Only the missing objects are fetched by the other members
+        self.shas.append(commit(self.upstream, 'f', '3\n', 'Third'))
+        fork2 = self.get_indexer('fork2', pool='org/upstream')
+        self.assertEqual(count_objects(fork2.local), 3)
+        cmts = list(indexer.iter_commits(
+            fork2.local, [fork2.ref_id], self.shas))
+        self.assertListEqual(
+            [cmt['line_modifieds'] for cmt in cmts], [1, 1, 3])
+
+        # A repository never changes of pool
+        self.assertEqual(pools.join_pool(fork2.local, 'other'), pool)
+
+    def test_auto_pool(self):
+        fork = self.get_indexer('fork')
+        self.assertIsNone(maintenance.pool_objects(fork.local))
+        indexer.conf['indexer_object_pools_auto'] = True
+        pool = maintenance.pool_objects(fork.local)
+        self.assertEqual(
+            pool, pools.get_pool_path('root-%s' % self.shas[0]))
+        self.assertEqual(count_objects(fork.local), 0)
+
+    def test_not_poolable(self):
+        fork = self.get_indexer('fork')
+        self.assertTrue(pools.is_poolable(fork.local))
+        open(os.path.join(fork.local, 'shallow'), 'w').close()
+        self.assertFalse(pools.is_poolable(fork.local))
@@ -0,0 +1,159 @@
+import os
+import time
+import mock
+import shutil
+
+from mock import patch
+
+from repoxplorer.indexer.git import indexer
+from repoxplorer.indexer.git import rebuild
+from repoxplorer.indexer.git import scheduler
+from repoxplorer.indexer.git import state_store
+from repoxplorer.tests import IndexerTest
+from repoxplorer.tests import git
+from repoxplorer.tests import commit
+
+
+class TestRebuild(IndexerTest):
+
+    def setUp(self):
+        super(TestRebuild, self).setUp()
+        self.init_git_store()
+        self.upstream = self.init_repo()
+        indexer.conf['indexer_extract_mode'] = 'stream'
+        self.shas = [
+            commit(self.upstream, 'f', '1\n', 'First commit'),
+            commit(self.upstream, 'f', '1\n2\n', 'Second commit')]
+        git(self.upstream, 'tag', '1.0', self.shas[0])
+        git(self.upstream, 'tag', '-a', '-m', 'Release', '2.0')
+        self.uri = 'file://%s' % self.upstream
+
+    def get_ref(self, branch):
+        return {'name': 'p1', 'uri': self.uri, 'branch': branch,
+                'parsers': [], 'index-tags': True}
+
+    def fetch(self):
+        with patch.object(indexer.index, 'Connector'):
+            pi = indexer.RepoIndexer('p1', self.uri)
+        pi.git_init()
+        pi.git_fetch_branches(['master'], tags=True)
+        return pi.local
+
+    def test_get_local_refs(self):
+        local = self.fetch()
+        refs = [line.split('\t') for line in git(
+            self.upstream, 'ls-remote', '.').splitlines()
+            if not line.endswith('HEAD')]
+        self.assertListEqual(
+            sorted(rebuild.get_local_refs(local)), sorted(refs))
+
+    def test_fetch(self):
+        local = self.fetch()
+        # The rebuild does not need the remote repository
+        shutil.rmtree(self.upstream)
+        state = state_store.StateStore(':memory:')
+        job = rebuild.RebuildJob(
+            'p1', self.uri, con=mock.MagicMock(), state=state)
+        job.add_ref(self.get_ref('master'))
+        job.add_ref(self.get_ref('unknown'))
+        report = scheduler.CycleReport()
+        with patch.object(indexer.index, 'Connector'), \
+                patch.object(indexer, 'run', side_effect=indexer.run) as run:
+            self.assertTrue(job.fetch(report))
+        for command in [c[0][0] for c in run.call_args_list]:
+            self.assertNotIn('ls-remote', command)
+            self.assertNotIn('fetch', command)
+        self.assertEqual(report.counters['refs_missing'], 1)
+        self.assertEqual(len(job.to_index), 1)
+        r = job.to_index[0][1]
+        self.assertEqual(r.local, local)
+        self.assertIsNone(r.catalog)
+        self.assertIs(r.state, state)
+        self.assertSetEqual(
+            set(name for _, name in r.tags),
+            set(['refs/tags/1.0', 'refs/tags/2.0', 'refs/tags/2.0^{}']))
+        r.c = mock.MagicMock()
+        r.c.get_commit.return_value = None
+        r.git_get_commit_obj()
+        self.assertListEqual(list(r.commits), sorted(self.shas))
+
+    def test_fetch_extended_horizon(self):
+        self.fetch()
+        ref = self.get_ref('master')
+        ref['index-since'] = int(time.time()) + 86400
+        ref_id = '%s:p1:master' % self.uri
+        # The live horizon was extended up to the first commit
+        live = state_store.get_store()
+        live.set_horizon(ref_id, 0)
+        with patch.object(rebuild.index, 'Connector'), \
+                patch.object(rebuild, 'Commits'), \
+                patch.object(rebuild, 'Tags'):
+            rebuilder = rebuild.IndexRebuilder(name='repoxplorer-new')
+        job = rebuild.RebuildJob(
+            'p1', self.uri, con=mock.MagicMock(), state=rebuilder.state)
+        job.add_ref(ref)
+        report = scheduler.CycleReport()
+        with patch.object(indexer.index, 'Connector'):
+            self.assertTrue(job.fetch(report))
+        r = job.to_index[0][1]
+        self.assertEqual(r.horizon, 0)
+        r.c = mock.MagicMock()
+        r.c.get_commit.return_value = None
+        r.git_get_commit_obj()
+        # The rebuilt index covers the backfilled history
+        self.assertListEqual(list(r.commits), sorted(self.shas))
+        with patch.object(rebuild, 'swap_alias', return_value=[]):
+            rebuilder.swap()
+        self.assertEqual(live.get_horizon(ref_id), 0)
+
+    def test_fetch_missing_repository(self):
+        job = rebuild.RebuildJob('p1', self.uri)
+        job.add_ref(self.get_ref('master'))
+        report = scheduler.CycleReport()
+        self.assertFalse(job.fetch(report))
+        self.assertEqual(report.counters['repos_missing'], 1)
+
+    def test_swap_alias(self):
+        ic = mock.MagicMock()
+        # The index created before the first rebuild is replaced
+        ic.exists_alias.return_value = False
+        ic.exists.return_value = True
+        self.assertListEqual(
+            rebuild.swap_alias(ic, 'repoxplorer', 'new'), ['repoxplorer'])
+        ic.update_aliases.assert_called_once_with(body={'actions': [
+            {'add': {'index': 'new', 'alias': 'repoxplorer'}},
+            {'remove_index': {'index': 'repoxplorer'}}]})
+        ic.delete.assert_not_called()
+        # The index of the previous rebuild is deleted
+        ic.reset_mock()
+        ic.exists_alias.return_value = True
+        ic.get_alias.return_value = {'old': {'aliases': {'repoxplorer': {}}}}
+        self.assertListEqual(
+            rebuild.swap_alias(ic, 'repoxplorer', 'new'), ['old'])
+        ic.update_aliases.assert_called_once_with(body={'actions': [
+            {'add': {'index': 'new', 'alias': 'repoxplorer'}},
+            {'remove': {'index': 'old', 'alias': 'repoxplorer'}}]})
+        ic.delete.assert_called_once_with(index='old')
+
+    def test_swap(self):
+        with patch.object(rebuild.index, 'Connector'), \
+                patch.object(rebuild, 'Commits'), \
+                patch.object(rebuild, 'Tags'):
+            rebuilder = rebuild.IndexRebuilder(name='repoxplorer-new')
+        live = state_store.get_store()
+        live.set_indexed_tip('ref', 'old')
+        live.set_stats_pending('ref', True)
+        live.add_seen_ref('ref')
+        rebuilder.state.set_indexed_tip('ref', 'new')
+        with patch.object(rebuild, 'swap_alias') as swap_alias:
+            swap_alias.return_value = []
+            rebuilder.swap()
+        self.assertListEqual(
+            [c[0][1:] for c in swap_alias.call_args_list],
+            [(rebuilder.alias, rebuilder.con.index),
+             ('%s-tags' % rebuilder.alias, rebuilder.tags_con.index)])
+        self.assertEqual(live.get_indexed_tip('ref'), 'new')
+        self.assertFalse(os.path.exists(rebuilder.state.path))
+        # No ref of the new index is waiting for its line statistics
+        self.assertFalse(live.is_stats_pending('ref'))
+        self.assertSetEqual(live.get_seen_refs(), set(['ref']))
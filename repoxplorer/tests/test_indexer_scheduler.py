@@ -0,0 +1,306 @@
+import os
+import time
+import mock
+import shutil
+import threading
+
+from unittest import TestCase
+from mock import patch
+
+from repoxplorer.indexer.git import indexer
+from repoxplorer.indexer.git import scheduler
+from repoxplorer.indexer.git import state_store
+from repoxplorer.tests import IndexerTest
+from repoxplorer.tests import git
+from repoxplorer.tests import commit
+
+
+class FakeJob(object):
+    def __init__(self, uri, to_index=True, tracker=None):
+        self.uri = uri
+        self.base_id = uri
+        self.host = scheduler.get_host(uri)
+        self.to_index = to_index
+        self.tracker = tracker
+        self.fetched = False
+        self.indexed = False
+        self.failed = False
+
+    def fetch(self, report):
+        with report.stage('fetch'):
+            self.tracker.enter(self.host)
+            time.sleep(0.01)
+            self.tracker.leave(self.host)
+        self.fetched = True
+        return self.to_index
+
+    def index(self, report):
+        with report.stage('index'):
+            self.indexed = True
+
+
+class HostTracker(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.current = {}
+        self.max = {}
+
+    def enter(self, host):
+        with self.lock:
+            self.current[host] = self.current.get(host, 0) + 1
+            self.max[host] = max(self.max.get(host, 0), self.current[host])
+
+    def leave(self, host):
+        with self.lock:
+            self.current[host] -= 1
+
+
+class TestRepoScheduler(TestCase):
+
+    def test_get_host(self):
+        self.assertEqual(
+            scheduler.get_host('https://github.com/openstack/nova'),
+            'github.com')
+        self.assertEqual(
+            scheduler.get_host('ssh://user@review.test:29418/nova'),
+            'review.test')
+        self.assertEqual(
+            scheduler.get_host('git@github.com:openstack/nova'),
+            'github.com')
+        self.assertEqual(
+            scheduler.get_host('/var/lib/git/nova'), 'localhost')
+        self.assertEqual(
+            scheduler.get_host('file:///var/lib/git/nova'), 'localhost')
+
+    def test_get_since(self):
+        self.assertEqual(scheduler.get_since([20, 10, 30]), 10)
+        # One of the refs needs the full history
+        self.assertIsNone(scheduler.get_since([20, None]))
+        self.assertIsNone(scheduler.get_since([20, 0]))
+        self.assertIsNone(scheduler.get_since([]))
+
+    def test_run(self):
+        tracker = HostTracker()
+        jobs = [FakeJob('https://host%s/repo%s' % (i % 2, i),
+                        to_index=bool(i % 3), tracker=tracker)
+                for i in range(20)]
+        s = scheduler.RepoScheduler(workers=4, max_per_host=1)
+        report = s.run(jobs)
+        self.assertTrue(all(job.fetched for job in jobs))
+        for job in jobs:
+            self.assertEqual(job.indexed, job.to_index)
+        # The per host cap is honored
+        self.assertDictEqual(tracker.max, {'host0': 1, 'host1': 1})
+        summary = report.summary()
+        self.assertEqual(summary['stages']['fetch']['count'], 20)
+        self.assertEqual(
+            summary['stages']['index']['count'],
+            len([job for job in jobs if job.to_index]))
+        self.assertEqual(summary['counters']['repos'], 20)
+        self.assertGreater(summary['wall_time'], 0)
+
+    def test_run_job_failure(self):
+        tracker = HostTracker()
+        jobs = [FakeJob('https://host/repo%s' % i, tracker=tracker)
+                for i in range(3)]
+
+        def fetch(report):
+            raise Exception('fetch failure')
+        jobs[1].fetch = fetch
+        s = scheduler.RepoScheduler(workers=2)
+        s.run(jobs)
+        self.assertTrue(jobs[0].indexed)
+        self.assertFalse(jobs[1].indexed)
+        self.assertTrue(jobs[2].indexed)
+        self.assertListEqual(
+            [job.failed for job in jobs], [False, True, False])
+
+    def test_run_locks(self):
+        # Two schedulers sharing the locks, as the polling cycles and
+        # the push consumer, never process a repository concurrently
+        tracker = HostTracker()
+        indexing = HostTracker()
+        locks = scheduler.RepoLocks()
+        runs = [[FakeJob('https://host/repo%s' % i, tracker=tracker)
+                 for i in range(4)] for _ in range(2)]
+
+        def track(job):
+            def index(report):
+                indexing.enter(job.uri)
+                time.sleep(0.01)
+                indexing.leave(job.uri)
+                job.indexed = True
+            return index
+        for job in runs[0] + runs[1]:
+            job.index = track(job)
+        threads = [threading.Thread(
+            target=scheduler.RepoScheduler(workers=4, locks=locks).run,
+            args=(jobs,)) for jobs in runs]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertTrue(all(job.indexed for job in runs[0] + runs[1]))
+        self.assertEqual(len(indexing.max), 4)
+        self.assertSetEqual(set(indexing.max.values()), set([1]))
+        # The locks are released
+        self.assertFalse(any(
+            lock.locked() for lock in locks.locks.values()))
+
+
+class TestRepoJob(IndexerTest):
+
+    def setUp(self):
+        super(TestRepoJob, self).setUp()
+        self.init_git_store()
+        self.upstream = self.init_repo()
+        self.master = [commit(self.upstream, 'f', '1\n', 'First commit')]
+        git(self.upstream, 'tag', '1.0')
+        git(self.upstream, 'checkout', '-q', '-b', 'stable/1.0')
+        self.stable = self.master + [
+            commit(self.upstream, 'f', '2\n', 'Stable commit')]
+        git(self.upstream, 'checkout', '-q', 'master')
+        self.master.append(commit(self.upstream, 'f', '3\n', 'Master'))
+
+    def get_ref(self, branch):
+        return {'name': 'p1', 'uri': 'file://%s' % self.upstream,
+                'branch': branch, 'parsers': [], 'index-tags': True}
+
+    def test_fetch(self):
+        job = scheduler.RepoJob('p1', 'file://%s' % self.upstream)
+        job.add_ref(self.get_ref('master'))
+        job.add_ref(self.get_ref('stable/1.0'), meta_ref='meta')
+        job.add_ref(self.get_ref('unknown'))
+        report = scheduler.CycleReport()
+        with patch.object(indexer.index, 'Connector'), \
+                patch.object(indexer, 'run', side_effect=indexer.run) as run:
+            self.assertTrue(job.fetch(report))
+        commands = [c[0][0] for c in run.call_args_list]
+        self.assertEqual(
+            len([c for c in commands if 'ls-remote' in c]), 1)
+        self.assertEqual(
+            len([c for c in commands if 'fetch' in c]), 1)
+        self.assertListEqual(
+            [r.branch for _, r in job.to_index], ['master', 'stable/1.0'])
+        self.assertEqual(job.to_index[1][1].meta_ref, 'meta_ref: meta')
+        self.assertSetEqual(
+            job.changed, set(r.ref_id for _, r in job.to_index))
+        local = job.to_index[0][1].local
+        self.assertIn('1.0', git(local, 'tag').split())
+        for (_, r), shas in zip(job.to_index, (self.master, self.stable)):
+            r.c = mock.MagicMock()
+            r.c.get_commit.return_value = None
+            r.git_get_commit_obj()
+            self.assertListEqual(list(r.commits), sorted(shas))
+
+    def get_ref_id(self, branch):
+        return 'file://%s:p1:%s' % (self.upstream, branch)
+
+    def test_fetch_unreachable(self):
+        job = scheduler.RepoJob('p1', 'file://%s' % self.upstream)
+        job.add_ref(self.get_ref('master'))
+        report = scheduler.CycleReport()
+        with patch.object(indexer.index, 'Connector'):
+            self.assertTrue(job.fetch(report))
+        self.assertFalse(job.failed)
+        shutil.rmtree(self.upstream)
+        with patch.object(indexer.index, 'Connector'):
+            self.assertFalse(job.fetch(report))
+        self.assertTrue(job.failed)
+        self.assertSetEqual(job.changed, set())
+        self.assertEqual(report.counters['errors'], 1)
+        os.mkdir(self.upstream)
+
+    def test_fetch_fully_indexed(self):
+        job = scheduler.RepoJob('p1', 'file://%s' % self.upstream)
+        job.add_ref(self.get_ref('master'))
+        job.add_ref(self.get_ref('stable/1.0'))
+        state = state_store.get_store()
+        state.set_indexed_tip(self.get_ref_id('master'), self.master[-1])
+        state.set_indexed_tip(self.get_ref_id('stable/1.0'), self.stable[-1])
+        report = scheduler.CycleReport()
+        with patch.object(indexer.index, 'Connector') as connector, \
+                patch.object(indexer, 'run', side_effect=indexer.run) as run:
+            connector.return_value.es.mget.return_value = self.get_docs(
+                {self.master[-1]: ['master'],
+                 self.stable[-1]: ['stable/1.0']})
+            self.assertFalse(job.fetch(report))
+        commands = [c[0][0] for c in run.call_args_list]
+        self.assertEqual(len([c for c in commands if 'fetch' in c]), 0)
+        self.assertEqual(report.counters['refs_up_to_date'], 2)
+        self.assertSetEqual(job.changed, set())
+        # The indexed tips are checked with a single request
+        self.assertEqual(connector.return_value.es.mget.call_count, 1)
+        self.assertSetEqual(
+            set(connector.return_value.es.mget.call_args[1]['body']['ids']),
+            set([self.master[-1], self.stable[-1]]))
+
+    def get_docs(self, tips):
+        return {'docs': [
+            {'_id': sha, 'found': True,
+             '_source': {'repos': [self.get_ref_id(b) for b in branches]}}
+            for sha, branches in tips.items()]}
+
+    def test_fetch_wiped_index(self):
+        job = scheduler.RepoJob('p1', 'file://%s' % self.upstream)
+        job.add_ref(self.get_ref('master'))
+        job.add_ref(self.get_ref('stable/1.0'))
+        state = state_store.get_store()
+        state.set_indexed_tip(self.get_ref_id('master'), self.master[-1])
+        state.set_indexed_tip(self.get_ref_id('stable/1.0'), self.stable[-1])
+        report = scheduler.CycleReport()
+        # The index was wiped then master only indexed again
+        with patch.object(indexer.index, 'Connector') as connector:
+            connector.return_value.es.mget.return_value = self.get_docs(
+                {self.master[-1]: ['master']})
+            self.assertTrue(job.fetch(report))
+        self.assertSetEqual(
+            job.changed, set([self.get_ref_id('stable/1.0')]))
+        self.assertEqual(report.counters['refs_up_to_date'], 1)
+        # The stale indexed tip is dropped, the ref is fully imported
+        self.assertIsNone(state.get_indexed_tip(
+            self.get_ref_id('stable/1.0')))
+        self.assertEqual(
+            state.get_indexed_tip(self.get_ref_id('master')),
+            self.master[-1])
+
+    def test_fetch_moved(self):
+        job = scheduler.RepoJob('p1', 'file://%s' % self.upstream)
+        for branch in ('master', 'stable/1.0'):
+            job.add_ref(self.get_ref(branch))
+        state = state_store.get_store()
+        # master moved since its last import
+        state.set_indexed_tip(self.get_ref_id('master'), self.master[0])
+        state.set_indexed_tip(self.get_ref_id('stable/1.0'), self.stable[-1])
+        report = scheduler.CycleReport()
+        with patch.object(indexer.index, 'Connector') as connector:
+            connector.return_value.es.mget.return_value = self.get_docs(
+                {self.stable[-1]: ['stable/1.0']})
+            self.assertTrue(job.fetch(report))
+        self.assertSetEqual(job.changed, set([self.get_ref_id('master')]))
+        self.assertEqual(report.counters['refs_up_to_date'], 1)
+        # The import of stable/1.0 did not complete
+        indexer.checkpoints.get_checkpoints().start(
+            self.get_ref_id('stable/1.0'), self.stable[-1], True, [])
+        with patch.object(indexer.index, 'Connector'):
+            self.assertTrue(job.fetch(report))
+        self.assertSetEqual(
+            job.changed, set([self.get_ref_id('master'),
+                              self.get_ref_id('stable/1.0')]))
+
+    def test_fetch_index_since(self):
+        job = scheduler.RepoJob('p1', 'file://%s' % self.upstream)
+        ref = self.get_ref('master')
+        ref['index-since'] = 1
+        job.add_ref(ref)
+        job.add_ref(self.get_ref('stable/1.0'))
+        report = scheduler.CycleReport()
+        with patch.object(indexer.index, 'Connector'), \
+                patch.object(indexer.RepoIndexer,
+                             'git_fetch_branches') as fetch:
+            self.assertTrue(job.fetch(report))
+            # stable/1.0 needs the full history
+            self.assertIsNone(fetch.call_args[1]['since'])
+            job.refs.pop()
+            self.assertTrue(job.fetch(report))
+            self.assertEqual(fetch.call_args[1]['since'], 1)
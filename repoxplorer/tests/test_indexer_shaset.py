@@ -0,0 +1,87 @@
+from unittest import TestCase
+from mock import patch
+
+from repoxplorer.indexer.git import catalog
+from repoxplorer.indexer.git import indexer
+from repoxplorer.indexer.git import shaset
+from repoxplorer.tests import IndexerTest
+from repoxplorer.tests import commit
+
+
+def sha(i):
+    return '%040x' % (i * 7919)
+
+
+class TestShaSet(TestCase):
+
+    def test_from_iterable(self):
+        shas = [sha(i) for i in (5, 3, 9, 3, 1)]
+        s = shaset.ShaSet.from_iterable(shas)
+        self.assertEqual(len(s), 4)
+        self.assertEqual(len(s.data), 4 * shaset.SHA_SIZE)
+        self.assertListEqual(list(s), sorted(set(shas)))
+        self.assertIn(sha(9), s)
+        self.assertNotIn(sha(2), s)
+        self.assertNotIn('not a sha', s)
+        self.assertIs(shaset.ShaSet.from_iterable(s), s)
+        self.assertFalse(shaset.ShaSet.from_iterable([]))
+
+    def test_spilled_runs(self):
+        shas = [sha(i) for i in range(100, 0, -1)] + [sha(50)]
+        with patch.object(shaset, 'spill', side_effect=shaset.spill) as spill:
+            s = shaset.ShaSet.from_iterable(shas, run_size=7)
+        self.assertEqual(spill.call_count, 14)
+        self.assertListEqual(list(s), sorted(set(shas)))
+
+    def test_not_shas(self):
+        # Ids of synthetic commits are kept in a set
+        s = shaset.ShaSet.from_iterable([sha(1), sha(2), '123'])
+        self.assertSetEqual(s, set([sha(1), sha(2), '123']))
+
+    def test_difference_intersection(self):
+        a = shaset.ShaSet.from_iterable(sha(i) for i in range(10))
+        b = shaset.ShaSet.from_iterable(sha(i) for i in range(5, 15))
+        self.assertListEqual(
+            list(a.difference(b)), sorted(sha(i) for i in range(5)))
+        self.assertListEqual(
+            list(a.difference(b, set([sha(0)]))),
+            sorted(sha(i) for i in range(1, 5)))
+        self.assertListEqual(
+            list(a.intersection(b)), sorted(sha(i) for i in range(5, 10)))
+        self.assertListEqual(list(a.difference(['123'])), list(a))
+        self.assertSetEqual(a.difference(a), set())
+
+    def test_chunks(self):
+        s = shaset.ShaSet.from_iterable(sha(i) for i in range(5))
+        self.assertListEqual(
+            list(shaset.chunks(s, 2)),
+            [list(s)[:2], list(s)[2:4], list(s)[4:]])
+        self.assertListEqual(
+            list(shaset.chunks(iter('abcde'), 2)),
+            [['a', 'b'], ['c', 'd'], ['e']])
+
+
+class TestBoundedMemory(IndexerTest):
+
+    def setUp(self):
+        super(TestBoundedMemory, self).setUp()
+        self.repo = self.init_repo()
+        indexer.conf['indexer_extract_mode'] = 'stream'
+        self.shas = [
+            commit(self.repo, 'f', '%s\n' % i, 'Commit %s' % i)
+            for i in range(3)]
+
+    def test_get_shas_set(self):
+        s = indexer.get_shas_set(
+            self.repo, 'refs/heads/master', exclude=self.shas[0])
+        self.assertIsInstance(s, shaset.ShaSet)
+        self.assertListEqual(list(s), sorted(self.shas[1:]))
+        self.assertRaises(
+            Exception, list, indexer.iter_all_shas(self.repo, 'unknown'))
+
+    def test_iter_ref_shas(self):
+        c = catalog.CommitsCatalog()
+        c.add_refs(self.shas, ['r1'])
+        self.assertListEqual(
+            list(c.iter_ref_shas('r1', size=2)), sorted(self.shas))
+        c.close()
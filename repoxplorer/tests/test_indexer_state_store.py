@@ -0,0 +1,123 @@
+import os
+import pickle
+
+from repoxplorer.indexer.git import state_store
+from repoxplorer.tests import IndexerTest
+
+
+class TestStateStore(IndexerTest):
+
+    def setUp(self):
+        super(TestStateStore, self).setUp()
+        self.path = os.path.join(self.db_cache_path, 'state.sqlite')
+        self.store = state_store.StateStore(self.path)
+
+    def tearDown(self):
+        self.store.close()
+
+    def legacy(self, filename):
+        return os.path.join(self.db_cache_path, filename)
+
+    def test_migrate(self):
+        pickle.dump(set(['r1', 'r2']),
+                    open(self.legacy('seen-refs.cached'), 'wb'))
+        store = state_store.get_store()
+        self.assertSetEqual(store.get_seen_refs(), set(['r1', 'r2']))
+        self.assertListEqual(
+            sorted(f for f in os.listdir(self.db_cache_path)
+                   if '.cached' in f), ['seen-refs.cached.migrated'])
+        # The migration only happens once
+        pickle.dump(set(['r3']), open(self.legacy('seen-refs.cached'), 'wb'))
+        store.migrate(self.db_cache_path)
+        self.assertNotIn('r3', store.get_seen_refs())
+        self.assertTrue(os.path.isfile(self.legacy('seen-refs.cached')))
+
+    def test_migrate_unreadable(self):
+        # An unreadable file is kept for inspection
+        open(self.legacy('seen-refs.cached'), 'wb').write(b'garbage')
+        store = state_store.StateStore(self.legacy('other.sqlite'))
+        store.migrate(self.db_cache_path)
+        self.assertSetEqual(store.get_seen_refs(), set())
+        self.assertTrue(os.path.isfile(self.legacy('seen-refs.cached')))
+        store.close()
+
+    def test_flush(self):
+        self.store.add_seen_ref('r1')
+        self.store.record_run('r1', 2.0)
+        other = state_store.StateStore(self.path)
+        # Nothing is written before the flush
+        self.assertSetEqual(other.get_seen_refs(), set())
+        self.assertDictEqual(other.get_runs(), {})
+        self.store.flush()
+        self.assertSetEqual(other.get_seen_refs(), set(['r1']))
+        self.assertEqual(other.get_runs()['r1']['runs'], 1)
+        other.close()
+
+    def test_runs(self):
+        self.store.record_run('r1', 2.0)
+        self.store.record_run('r1', 1.0, error='Fetch failed')
+        self.store.record_run('r1', 3.0, error='Fetch failed')
+        runs = self.store.get_runs()['r1']
+        self.assertEqual(runs['runs'], 3)
+        self.assertEqual(runs['errors'], 2)
+        self.assertEqual(runs['consecutive_errors'], 2)
+        self.assertEqual(runs['last_duration'], 3.0)
+        self.assertEqual(runs['total_duration'], 6.0)
+        self.assertEqual(runs['last_error'], 'Fetch failed')
+        self.store.record_run('r1', 1.0)
+        runs = self.store.get_runs()['r1']
+        self.assertEqual(runs['errors'], 2)
+        self.assertEqual(runs['consecutive_errors'], 0)
+        self.assertIsNone(runs['last_error'])
+
+    def test_remove_ref(self):
+        for ref in ('r1', 'r2'):
+            self.store.add_seen_ref(ref)
+            self.store.set_indexed_tip(ref, 'sha')
+            self.store.set_stats_pending(ref, True)
+            self.store.set_horizon(ref, 1476633000)
+            self.store.record_run(ref, 1.0)
+        self.store.flush()
+        self.store.remove_ref('r1')
+        self.assertSetEqual(self.store.get_seen_refs(), set(['r2']))
+        self.assertIsNone(self.store.get_indexed_tip('r1'))
+        self.assertFalse(self.store.is_stats_pending('r1'))
+        self.assertIsNone(self.store.get_horizon('r1'))
+        self.assertListEqual(list(self.store.get_runs()), ['r2'])
+        self.assertEqual(self.store.get_indexed_tip('r2'), 'sha')
+        self.store.set_indexed_tip('r2', None)
+        self.assertIsNone(self.store.get_indexed_tip('r2'))
+
+    def test_get_indexed_tips(self):
+        for i in range(3):
+            self.store.set_indexed_tip('r%s' % i, 'sha%s' % i)
+        self.assertDictEqual(
+            self.store.get_indexed_tips(['r0', 'r2', 'r3']),
+            {'r0': 'sha0', 'r2': 'sha2'})
+        self.assertDictEqual(self.store.get_indexed_tips([]), {})
+
+    def test_maintenance(self):
+        self.store.set_maintenance('/repo', 'pack', 1476633000, 2.0)
+        self.store.set_maintenance('/repo', 'pack', 1476634000, 1.0)
+        self.store.set_maintenance('/repo', 'prune', 1476633000, 3.0)
+        # Shared with the other indexers
+        other = state_store.StateStore(self.path)
+        self.assertDictEqual(other.get_maintenance(), {'/repo': {
+            'pack': {'last': 1476634000, 'duration': 1.0},
+            'prune': {'last': 1476633000, 'duration': 3.0}}})
+        other.close()
+
+    def test_replace(self):
+        self.store.set_indexed_tip('r1', 'old')
+        self.store.set_indexed_tip('r2', 'old')
+        self.store.set_stats_pending('r1', True)
+        self.store.set_horizon('r1', 1476633000)
+        other = state_store.StateStore(self.path + '.new')
+        other.set_indexed_tip('r1', 'new')
+        self.store.replace(other.path, ('indexed_tips', 'stats_pending'))
+        other.close()
+        self.assertEqual(self.store.get_indexed_tip('r1'), 'new')
+        self.assertIsNone(self.store.get_indexed_tip('r2'))
+        self.assertFalse(self.store.is_stats_pending('r1'))
+        # Tables not replaced are kept
+        self.assertEqual(self.store.get_horizon('r1'), 1476633000)
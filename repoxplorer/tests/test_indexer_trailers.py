@@ -0,0 +1,71 @@
+import re
+
+from unittest import TestCase
+
+from repoxplorer.indexer.git import metadata_re
+from repoxplorer.indexer.git import trailers
+
+
+def parse_commit_msg(msg, extra_parsers):
+    """ Reference implementation trying every regex on every line
+    """
+    metadatas = []
+    lines = msg.split('\n')
+    for line in lines[1:]:
+        for key, parser in metadata_re.METADATA_REs.items():
+            m = parser.match(line)
+            if m:
+                metadatas.append(
+                    (key, m.groups()[0].strip().replace('#', '')))
+        for parser in extra_parsers:
+            m = parser.match(line)
+            if m and m.groups()[0] not in trailers.RESERVED_METADATA_KEYS:
+                metadatas.append(
+                    (m.groups()[0].strip(),
+                     m.groups()[1].strip().replace('#', '')))
+    return lines[0], metadatas
+
+
+class TestTrailersExtractor(TestCase):
+
+    def test_extract(self):
+        parsers = [
+            re.compile(r'.*(blueprint) ([^ .]+).*'),
+            re.compile(r'^(sha): (.*)$'),
+            re.compile(r'(?i)(story)-(\d+)'),
+        ]
+        lines = [
+            'subject', '', 'body: line', 'Signed-of-by: A #1',
+            'Closes-Bug: #42', 'Close: 43', 'Fixes: /path', 'Fixe: x',
+            'Fix:x', 'Related-Bug:', 'Bug: 1', 'uug: 2', 'Depends-On: I1',
+            'Resolves: 3', 'Co-Authored-By: C', 'Story: 4', 'sha: abc',
+            'implement blueprint bp-1.', 'STORY-5', 'Task: 6 blueprint b2',
+        ]
+        msg = '\n'.join(lines)
+        for extra_parsers in ([], parsers):
+            self.assertEqual(
+                trailers.get_extractor(extra_parsers).extract(msg),
+                parse_commit_msg(msg, extra_parsers))
+        _, metadatas = trailers.get_extractor(parsers).extract(msg)
+        self.assertIn(('blueprint', 'bp-1'), metadatas)
+        self.assertIn(('STORY', '5'), metadatas)
+        self.assertIn(('closes-bug', '42'), metadatas)
+        self.assertNotIn(('sha', 'abc'), metadatas)
+
+    def test_get_extractor(self):
+        extractor = trailers.get_extractor([re.compile('(a)(b)')])
+        # Parsers given as patterns or compiled regexes share the
+        # same extractor
+        self.assertIs(trailers.get_extractor(['(a)(b)']), extractor)
+        self.assertIsNot(trailers.get_extractor([]), extractor)
+
+    def test_required_literal(self):
+        for pattern, expected in (
+                (r'.*(blueprint) ([^ .]+).*', 'blueprint'),
+                (r'^Change-Id: (I[0-9a-f]+)', 'Change-Id: '),
+                (r'(?:foo)?(ba)(r)', 'ba'),
+                (r'(a|bc)(d)', 'd'),
+                (r'(?i)(story)-(\d+)', None),
+                (r'(.*)(.*)', None)):
+            self.assertEqual(
+                trailers.required_literal(re.compile(pattern)), expected)
@@ -0,0 +1,154 @@
+import hmac
+import json
+import hashlib
+import urllib.request
+
+from unittest import TestCase
+
+from repoxplorer.indexer.git import scheduler
+from repoxplorer.indexer.git import webhooks
+
+
+def get_job(uri, branches, index_tags=False):
+    job = scheduler.RepoJob('p', uri)
+    for branch in branches:
+        job.add_ref({'name': 'p', 'uri': uri, 'branch': branch,
+                     'parsers': [], 'index-tags': index_tags})
+    return job
+
+
+class TestWebhooks(TestCase):
+
+    def setUp(self):
+        self.queue = webhooks.PushQueue()
+        self.receiver = webhooks.WebhookReceiver(
+            self.queue, host='127.0.0.1', port=0)
+        self.nova = get_job(
+            'https://github.com/openstack/nova', ['master', 'stable'])
+        self.swift = get_job(
+            'ssh://review.test:29418/openstack/swift', ['master'],
+            index_tags=True)
+        self.receiver.set_jobs([self.nova, self.swift])
+
+    def post(self, payload):
+        return self.receiver.handle(
+            {}, json.dumps(payload).encode())
+
+    def test_normalize_uri(self):
+        for uri in ('https://github.com/openstack/nova',
+                    'https://github.com/openstack/nova.git/',
+                    'git@github.com:openstack/nova.git',
+                    'ssh://git@GitHub.com:22/openstack/nova'):
+            self.assertEqual(
+                webhooks.normalize_uri(uri), 'github.com/openstack/nova')
+        self.assertEqual(
+            webhooks.normalize_uri('/var/lib/git/nova'),
+            'localhost/var/lib/git/nova')
+
+    def test_parse_payload(self):
+        self.assertEqual(
+            webhooks.parse_payload({
+                'ref': 'refs/heads/master',
+                'repository': {'clone_url': 'https://h/r.git',
+                               'ssh_url': 'git@h:r.git'}}),
+            (['https://h/r.git', 'git@h:r.git'], None, 'refs/heads/master'))
+        self.assertEqual(
+            webhooks.parse_payload({
+                'ref': 'refs/heads/master',
+                'project': {'git_http_url': 'https://h/r.git'}}),
+            (['https://h/r.git'], None, 'refs/heads/master'))
+        self.assertEqual(
+            webhooks.parse_payload({
+                'type': 'ref-updated',
+                'refUpdate': {'project': 'r', 'refName': 'master'}}),
+            ([], 'r', 'refs/heads/master'))
+        self.assertEqual(
+            webhooks.parse_payload({
+                'type': 'change-merged',
+                'change': {'project': 'r', 'branch': 'stable'}}),
+            ([], 'r', 'refs/heads/stable'))
+        self.assertEqual(
+            webhooks.parse_payload({'uri': 'https://h/r'}),
+            (['https://h/r'], None, None))
+        self.assertRaises(ValueError, webhooks.parse_payload, {'a': 1})
+        self.assertRaises(ValueError, webhooks.parse_payload, [])
+
+    def test_queue(self):
+        self.assertTrue(self.queue.put(self.swift, webhooks.TAG_PRIORITY))
+        self.assertTrue(self.queue.put(self.nova))
+        self.assertFalse(self.queue.put(self.nova))
+        # A higher priority replaces the queued one
+        self.assertTrue(self.queue.put(self.swift))
+        self.assertEqual(len(self.queue), 2)
+        self.assertListEqual(
+            self.queue.get_batch(), [self.nova, self.swift])
+        self.assertListEqual(self.queue.get_batch(timeout=0), [])
+
+    def test_handle(self):
+        code, ret = self.post({
+            'ref': 'refs/heads/stable',
+            'repository': {'ssh_url': 'git@github.com:openstack/nova.git'}})
+        self.assertEqual(code, 202)
+        self.assertListEqual(ret['queued'], [self.nova.base_id])
+        # Already queued
+        code, ret = self.post({'uri': self.nova.uri, 'branch': 'master'})
+        self.assertListEqual(ret['queued'], [])
+        # Not an indexed branch
+        code, ret = self.post({'uri': self.swift.uri, 'branch': 'other'})
+        self.assertListEqual(ret['queued'], [])
+        # Gerrit events carry the project name, tags are only queued
+        # for the refs indexing them
+        code, ret = self.post({
+            'type': 'ref-updated',
+            'refUpdate': {'project': 'openstack/swift',
+                          'refName': 'refs/tags/1.0'}})
+        self.assertListEqual(ret['queued'], [self.swift.base_id])
+        code, ret = self.post({
+            'ref': 'refs/tags/1.0',
+            'repository': {'clone_url': self.nova.uri}})
+        self.assertListEqual(ret['queued'], [])
+        self.assertEqual(self.post({'ref': 'x'})[0], 400)
+        self.assertEqual(self.receiver.handle({}, b'not json')[0], 400)
+
+    def test_handle_copy(self):
+        self.nova.changed.add('r1')
+        self.post({'uri': self.nova.uri})
+        job = self.queue.get_batch(timeout=0)[0]
+        self.assertIsNot(job, self.nova)
+        self.assertEqual(job.base_id, self.nova.base_id)
+        self.assertListEqual(job.refs, self.nova.refs)
+        self.assertSetEqual(job.changed, set())
+
+    def test_secret(self):
+        self.receiver.secret = 'secret'
+        body = json.dumps({'uri': self.nova.uri}).encode()
+        signature = 'sha256=%s' % hmac.new(
+            b'secret', body, hashlib.sha256).hexdigest()
+        self.assertEqual(self.receiver.handle({}, body)[0], 403)
+        self.assertEqual(self.receiver.handle(
+            {'X-Hub-Signature-256': 'sha256=0'}, body)[0], 403)
+        self.assertEqual(self.receiver.handle(
+            {'X-Hub-Signature-256': signature}, body)[0], 202)
+        self.assertEqual(self.receiver.handle(
+            {'X-Gitlab-Token': 'secret'}, body)[0], 202)
+
+    def test_http(self):
+        processed = []
+        consumer = webhooks.PushConsumer(self.queue, processed.extend)
+        self.receiver.start()
+        try:
+            request = urllib.request.Request(
+                'http://127.0.0.1:%s/' % self.receiver.port,
+                data=json.dumps({'uri': self.nova.uri}).encode(),
+                headers={'Content-Type': 'application/json'})
+            response = urllib.request.urlopen(request)
+            self.assertEqual(response.status, 202)
+            self.assertDictEqual(
+                json.loads(response.read()),
+                {'queued': [self.nova.base_id]})
+        finally:
+            self.receiver.stop()
+        self.assertEqual(consumer.consume(timeout=0), 1)
+        self.assertListEqual(
+            [job.base_id for job in processed], [self.nova.base_id])
+        self.assertEqual(consumer.consume(timeout=0), 0)
@@ -30,6 +30,10 @@ setup(
     keywords = "git metrics statistics stats repo repositories elasticsearch",
     url = "https://github.com/morucci/repoxplorer",
     packages=find_packages(),
+    extras_require={
+        # In process commits extraction (indexer_extract_mode 'dulwich')
+        'dulwich': ['dulwich'],
+    },
     include_package_data=True,
     zip_safe=False,
     long_description=read('README.md'),